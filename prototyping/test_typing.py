@@ -1,13 +1,53 @@
-from unittest import TestCase, mock
+import collections
+from array import array
+import sys
+from unittest import TestCase, mock, skipUnless
 
 from typing import Any
-from typing import TypeVar, T, KT, VT, AnyStr
+from typing import TypeVar, T, KT, VT, AnyStr, typevar
 from typing import Union, Optional
 from typing import Tuple
 from typing import Callable
 from typing import Generic
 from typing import Undefined
+from typing import ForwardRef
 from typing import cast
+from typing import cache_info, cache_clear
+from typing import compile_checker, check_many, iter_failures
+from typing import checked_iter
+from typing import validate_parallel
+from typing import typechecked, set_sampling
+from typing import Sampler, EveryNth, FirstThenEveryNth, TimeBudget
+from typing import List, Dict, Set, FrozenSet
+from typing import Iterable, Iterator, Container, Sequence, Mapping
+from typing import MutableMapping, ByteString
+from typing import AsyncIterable, AsyncIterator
+from typing import AbstractSet, KeysView, ItemsView
+from typing import ElementCheck, Shallow, FirstK, RandomK
+from typing import set_element_check, element_check
+from typing import set_instance_memo
+from typing import Protocol
+from typing import set_instrumentation, instrumentation_snapshot
+from typing import format_instrumentation, export_instrumentation
+from typing import set_profiling, profile_report, format_profile_report
+from typing import memory_info
+from typing import encode_type, decode_type
+from typing import encode_type_json, decode_type_json
+
+
+# Without contextvars (before Python 3.7), state is thread-local.
+has_contextvars = sys.version_info >= (3, 7)
+
+
+def run_async(coro):
+    """Run coro in a new event loop, like asyncio.run() (Python 3.7+)."""
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
 
 
 class Employee:
@@ -169,6 +209,55 @@ class TypeVarTests(TestCase):
             self.assertIsInstance(42, T)
         self.assertNotIsInstance(42, T)
 
+    def test_bind_threads(self):
+        import threading
+        types = [int, str, bytes, float, Employee, Manager, tuple, list]
+        errors = []
+        barrier = threading.Barrier(len(types))
+
+        def worker(t, other):
+            try:
+                barrier.wait()
+                for i in range(200):
+                    with T.bind(t):
+                        assert T.__binding__ is t
+                        assert issubclass(t, T)
+                        assert not issubclass(other, T) or \
+                            issubclass(other, t)
+                    assert T.__binding__ is None
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker,
+                                    args=(t, types[i - 1]))
+                   for i, t in enumerate(types)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIsNone(T.__binding__)
+        self.assertNotIsInstance(42, T)
+
+    @skipUnless(has_contextvars, 'bindings are thread-local')
+    def test_bind_asyncio(self):
+        import asyncio
+
+        async def task(t, value):
+            with T.bind(t):
+                for i in range(20):
+                    await asyncio.sleep(0)
+                    assert isinstance(value, T)
+                    assert T.__binding__ is t
+            return T.__binding__
+
+        async def main():
+            return await asyncio.gather(task(int, 42), task(str, ''),
+                                        task(bytes, b''))
+
+        self.assertEqual(run_async(main()), [None, None, None])
+        self.assertIsNone(T.__binding__)
+
 
 class UnionTests(TestCase):
 
@@ -279,6 +368,204 @@ class UnionTests(TestCase):
         with self.assertRaises(TypeError):
             Union[()]
 
+    def test_remove_subclasses(self):
+        from typing import _remove_subclasses
+        import abc
+        import itertools
+
+        def pairwise(params):
+            # The straightforward quadratic algorithm.
+            all_params = set(params)
+            for t1 in params:
+                if t1 is Any:
+                    return (Any,)
+                if any(issubclass(t1, t2) for t2 in all_params - {t1}):
+                    all_params.remove(t1)
+            return tuple(t for t in params if t in all_params)
+
+        class A(metaclass=abc.ABCMeta):
+            pass
+
+        A.register(Manager)
+        types = [int, bool, object, Employee, Manager, Founder,
+                 ManagingFounder, A, Any, T, AnyStr, str, bytes,
+                 Union[int, str], Tuple[int], Tuple[bool]]
+        for params in itertools.permutations(types, 3):
+            self.assertEqual(_remove_subclasses(params), pairwise(params),
+                             params)
+        self.assertEqual(_remove_subclasses(tuple(types)),
+                         pairwise(tuple(types)))
+
+    def test_interned(self):
+        self.assertIs(Union[int, str], Union[int, str])
+        self.assertIs(Union[int, str, int], Union[int, str])
+        self.assertIs(Union[Union[int, str], str], Union[int, str])
+        self.assertIs(Union[Employee, Manager, int], Union[Employee, int])
+        self.assertIs(Union[int, None], Optional[int])
+        # Order is significant for the repr(), so it is kept.
+        self.assertIsNot(Union[int, str], Union[str, int])
+        self.assertEqual(repr(Union[str, int]), 'typing.Union[str, int]')
+
+    def test_not_interned_while_bound(self):
+        # A union normalized under a binding mustn't outlive it.
+        with T.bind(int):
+            Union[int, T]
+            Optional[T]
+        self.assertEqual(repr(Union[int, T]), 'typing.Union[int, ~T]')
+        self.assertIsInstance(42, Union[int, T])
+        self.assertEqual(repr(Optional[T]), 'typing.Union[~T, NoneType]')
+
+    def test_abc_register(self):
+        import abc
+
+        class A(metaclass=abc.ABCMeta):
+            pass
+
+        class B:
+            pass
+
+        u = Union[B, A]
+        self.assertEqual(u.__union_params__, (B, A))
+        A.register(B)
+        self.assertIs(Union[B, A], A)
+        self.assertIs(Union[A, B], A)
+
+    def test_interned_by_identity(self):
+        # Equal but distinct classes must not share a cache entry.
+        def make():
+            class A(Generic[T]):
+                pass
+            return A
+        A1, A2 = make(), make()
+        self.assertEqual(A1, A2)
+        self.assertIsNot(A1, A2)
+        self.assertIs(Union[A1, int].__union_params__[0], A1)
+        self.assertIs(Union[A2, int].__union_params__[0], A2)
+
+    def test_doc(self):
+        # Parameterizations share the docstring rather than copy it.
+        self.assertIs(Union[int, str].__doc__, Union.__doc__)
+        self.assertIs(Tuple[int].__doc__, Tuple.__doc__)
+        self.assertIs(List[int].__doc__, List.__doc__)
+
+    def test_cache_info(self):
+        cache_clear()
+        self.assertEqual(cache_info()['union'].currsize, 0)
+        u = Union[int, Employee]
+        info = cache_info()['union']
+        self.assertEqual(info.hits, 0)
+        self.assertGreater(info.misses, 0)
+        self.assertIs(Union[int, Employee], u)
+        self.assertEqual(cache_info()['union'].hits, info.hits + 1)
+        self.assertEqual(cache_info()['union'].misses, info.misses)
+
+
+class TypeCacheTests(TestCase):
+
+    def setUp(self):
+        from typing import _TypeCache, _caches
+        self.cache = _TypeCache('test', maxsize=2)
+        self.addCleanup(_caches.pop, 'test')
+
+    def test_lru(self):
+        c = self.cache
+        self.assertIsNone(c.get((int,)))
+        self.assertEqual(c.add((int,), 'int'), 'int')
+        self.assertEqual(c.add((str,), 'str'), 'str')
+        self.assertEqual(c.get((int,)), 'int')
+        c.add((float,), 'float')  # Evicts str, the least recently used.
+        self.assertIsNone(c.get((str,)))
+        self.assertEqual(c.get((int,)), 'int')
+        self.assertEqual(c.get((float,)), 'float')
+        self.assertEqual(c.info(), (3, 2, 1, 2, 2))
+
+    def test_first_add_wins(self):
+        c = self.cache
+        self.assertEqual(c.add((int, str), 'first'), 'first')
+        self.assertEqual(c.add((int, str), 'second'), 'first')
+        self.assertIsNone(c.get((str, int)))
+
+    def test_weak_keys(self):
+        c = self.cache
+
+        class C:
+            pass
+        c.add((C,), 'C')
+        self.assertEqual(c.info().currsize, 1)
+        del C
+        import gc
+        gc.collect()
+        c.get((int,))
+        self.assertEqual(c.info().currsize, 0)
+
+    def test_weak_values(self):
+        import gc
+        import weakref
+        from typing import _TypeCache, _caches
+        c = _TypeCache('test weak', maxsize=2, weak_values=True)
+        self.addCleanup(_caches.pop, 'test weak')
+
+        class C:
+            pass
+
+        class Value:
+            pass
+        # A value may refer to its key, but not the other way around.
+        value = Value()
+        value.key = C
+        c.add((C,), value)
+        r = weakref.ref(C)
+        del C
+        del value
+        # Unreferenced values are kept until a full collection.
+        self.assertEqual(c.info().currsize, 1)
+        self.assertIsNotNone(r())
+        gc.collect()
+        self.assertIsNone(r())
+        # Values referenced elsewhere stay cached.
+        value = Value()
+        c.add((int,), value)
+        gc.collect()
+        self.assertIs(c.get((int,)), value)
+
+
+class SubclassMemoTests(TestCase):
+
+    def test_memoized(self):
+        u = Union[int, Employee]
+        self.assertTrue(issubclass(Manager, u))
+        hits = cache_info()['subclass'].hits
+        self.assertTrue(issubclass(Manager, u))
+        self.assertFalse(issubclass(str, u))
+        self.assertFalse(issubclass(str, u))
+        self.assertEqual(cache_info()['subclass'].hits, hits + 2)
+
+    def test_abc_register(self):
+        import abc
+
+        class A(metaclass=abc.ABCMeta):
+            pass
+
+        class B:
+            pass
+
+        u = Union[int, A]
+        t = Tuple[A]
+        self.assertFalse(issubclass(B, u))
+        self.assertFalse(issubclass(Tuple[B], t))
+        A.register(B)
+        self.assertTrue(issubclass(B, u))
+        self.assertTrue(issubclass(Tuple[B], t))
+
+    def test_bindings_not_memoized(self):
+        u = Union[T, str]
+        self.assertFalse(issubclass(int, u))
+        with T.bind(int):
+            self.assertTrue(issubclass(int, u))
+            self.assertTrue(issubclass(int, T))
+        self.assertFalse(issubclass(int, u))
+        self.assertFalse(issubclass(int, T))
+
 
 class TypeVarUnionTests(TestCase):
 
@@ -385,6 +672,13 @@ class TupleTests(TestCase):
         with self.assertRaises(TypeError):
             issubclass(42, Tuple[int])
 
+    def test_cached(self):
+        self.assertIs(Tuple[int, str], Tuple[int, str])
+        self.assertIs(Tuple[()], Tuple[()])
+        self.assertIs(Tuple[None], Tuple[type(None)])
+        self.assertIsNot(Tuple[int, str], Tuple[str, int])
+        self.assertIsNot(Tuple[int], Tuple[int, int])
+
 
 class CallableTests(TestCase):
 
@@ -507,6 +801,45 @@ class CallableTests(TestCase):
         self.assertIsInstance(C.smethod, ct)
         self.assertIsInstance(C.imethod, Callable[[Any, int], int])
 
+    def test_with_kwonly_args(self):
+        c = Callable[[int], int]
+
+        def flub(a: int, *, b: int) -> int:
+            return a
+
+        self.assertNotIsInstance(flub, c)
+
+    def test_with_builtins(self):
+        self.assertIsInstance(len, Callable[[Any], int])
+        self.assertNotIsInstance(len, Callable[[Any, Any], int])
+        # Bound builtin methods don't count self.  (Before Python 3.7,
+        # builtin methods have no signature.)
+        if [].append.__text_signature__ is not None:
+            self.assertIsInstance([].append, Callable[[int], None])
+            self.assertIsInstance(str.join, Callable[[str, list], str])
+        self.assertNotIsInstance(max, Callable[[int, int], int])
+
+    def test_signature_cached(self):
+        c = Callable[[int], int]
+
+        def flub(a: int) -> int:
+            return a
+
+        self.assertIsInstance(flub, c)
+        hits = cache_info()['signature'].hits
+        self.assertIsInstance(flub, c)
+        self.assertNotIsInstance(flub, Callable[[str], int])
+        self.assertEqual(cache_info()['signature'].hits, hits + 2)
+
+    def test_unused_annotations(self):
+        # Only the annotations that are needed must be types.
+        def flub(a: int, b: 'str' = '') -> int:
+            return a
+
+        self.assertIsInstance(flub, Callable[[int], int])
+        with self.assertRaises(TypeError):
+            isinstance(flub, Callable[[int, str], int])
+
     def test_cannot_subclass(self):
         with self.assertRaises(TypeError):
 
@@ -518,6 +851,22 @@ class CallableTests(TestCase):
             class C(Callable[[int], int]):
                 pass
 
+    def test_cached(self):
+        self.assertIs(Callable[[int], str], Callable[[int], str])
+        self.assertIs(Callable[[None], None],
+                      Callable[[type(None)], type(None)])
+        self.assertIsNot(Callable[[int], str], Callable[[str], int])
+        self.assertIsNot(Callable[[int, str], int], Callable[[int], str])
+        self.assertIsNot(Callable[[], int], Callable[[int], int])
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            Callable[int, str]
+        with self.assertRaises(TypeError):
+            Callable[[42], str]
+        with self.assertRaises(TypeError):
+            Callable[[int], 42]
+
     def test_cannot_instantiate(self):
         with self.assertRaises(TypeError):
             Callable()
@@ -628,6 +977,41 @@ class GenericTests(TestCase):
         assert A[T] == A[T]
         assert A[T] != B[T]
 
+    def test_cached(self):
+        self.assertIs(SimpleMapping[str, int], SimpleMapping[str, int])
+        self.assertIs(Generic[T], Generic[T])
+        self.assertIsNot(Generic[KT], Generic[VT])
+        X = SimpleMapping[AnyStr, str]
+        self.assertIs(X[str, str], X[str, str])
+        self.assertIsNot(X[str, str], SimpleMapping[str, str])
+        # A cached parameterization doesn't bypass validation.
+        with self.assertRaises(TypeError):
+            X[int, str]
+
+    def test_cache_does_not_pin(self):
+        import gc
+        import weakref
+
+        class C(Generic[T]):
+            pass
+        C[int]
+        r = weakref.ref(C)
+        del C
+        gc.collect()
+        self.assertIsNone(r())
+        # Nor through cached types that refer to the class.
+
+        class C:
+            pass
+        Tuple[C]
+        Union[C, int]
+        Callable[[C], int]
+        List[C]
+        r = weakref.ref(C)
+        del C
+        gc.collect()
+        self.assertIsNone(r())
+
 
 class UndefinedTest(TestCase):
 
@@ -690,3 +1074,1718 @@ class ForwardRefTest(TestCase):
         t = Node[int]
         ann = t.add_left.__annotations__
         assert ann['node'] == Optional[Node[T]]
+
+    def test_forward_ref(self):
+        ref = ForwardRef('LaterClass')
+        self.assertEqual(repr(ref), "ForwardRef('LaterClass')")
+        self.assertIs(ForwardRef('LaterClass'), ref)
+        u = Optional[ref]  # Doesn't need LaterClass yet.
+        t = Tuple[ref, int]
+        with self.assertRaises(NameError):
+            isinstance(42, ref)
+        global LaterClass
+
+        class LaterClass(Employee):
+            pass
+
+        self.addCleanup(globals().pop, 'LaterClass')
+        self.assertIs(ref.__forward_value__, LaterClass)
+        self.assertIsInstance(LaterClass(), ref)
+        self.assertNotIsInstance(Employee(), ref)
+        self.assertIsInstance(None, u)
+        self.assertIsInstance(LaterClass(), u)
+        self.assertIsInstance((LaterClass(), 42), t)
+        self.assertNotIsInstance((Manager(), 42), t)
+        self.assertTrue(issubclass(LaterClass, ref))
+        self.assertTrue(issubclass(ref, ref))
+        self.assertFalse(issubclass(Employee, ref))
+
+    def test_forward_ref_globals(self):
+        ref = ForwardRef('X', {'X': int})
+        self.assertIsNot(ref, ForwardRef('X'))
+        self.assertIsInstance(42, ref)
+        self.assertIsInstance(42, ForwardRef('int'))
+        with self.assertRaises(TypeError):
+            isinstance(42, ForwardRef('42'))
+        with self.assertRaises(TypeError):
+            ForwardRef(int)
+
+    def test_forward_ref_typechecked(self):
+        @typechecked
+        def flub(a: 'Employee') -> 'Optional[Manager]':
+            return a if isinstance(a, Manager) else None
+
+        self.assertIsInstance(flub(Manager()), Manager)
+        self.assertIsNone(flub(Employee()))
+        with self.assertRaises(TypeError):
+            flub(42)
+
+    def test_forward_ref_typechecked_later(self):
+        @typechecked
+        def flub(a: 'LaterNode'):
+            pass
+
+        global LaterNode
+
+        class LaterNode:
+            pass
+
+        self.addCleanup(globals().pop, 'LaterNode')
+        flub(LaterNode())
+        with self.assertRaises(TypeError):
+            flub(42)
+
+    @skipUnless(sys.version_info >= (3, 7), 'needs PEP 563')
+    def test_postponed_annotations(self):
+        source = ('from __future__ import annotations\n'
+                  'from typing import T, AnyStr, List, typechecked\n'
+                  '@typechecked\n'
+                  'def ident(a: T) -> T:\n'
+                  '    return a\n'
+                  '@typechecked\n'
+                  'def first(a: AnyStr, b: AnyStr) -> List[AnyStr]:\n'
+                  '    return [a]\n')
+        namespace = {'__name__': __name__}
+        exec(source, namespace)
+        ident, first = namespace['ident'], namespace['first']
+        self.assertEqual(ident.__annotations__['a'], 'T')
+        self.assertEqual(ident(1), 1)
+        self.assertEqual(first('a', 'b'), ['a'])
+        with self.assertRaises(TypeError):
+            first('a', b'b')
+
+    def test_cache_invalidated(self):
+
+        class Node(Generic[T]):
+            pass  # Forward reference
+
+        t = Node[int]
+        assert not hasattr(t, 'label')
+
+        class Node(Generic[T]):
+            label = None
+
+        assert Node[int] is not t
+        assert Node[int].label is None
+
+
+class CompileCheckerTests(TestCase):
+
+    def assertSameAsIsinstance(self, tp, values):
+        check = compile_checker(tp)
+        for v in values:
+            self.assertEqual(check(v), isinstance(v, tp), (tp, v))
+
+    values = [42, 3.14, '', b'', None, (), (42,), (42, ''), (42, None),
+              (42, '', 3.14), ((42, ''), None), Employee(), Manager(),
+              len, lambda x: x]
+
+    def test_simple(self):
+        for tp in [int, object, Any, Employee, Manager, type(None)]:
+            self.assertSameAsIsinstance(tp, self.values)
+
+    def test_union(self):
+        for tp in [Union[int, str], Optional[str], Union[int, Employee],
+                   Union[Tuple[int, str], None], Union[int, AnyStr]]:
+            self.assertSameAsIsinstance(tp, self.values)
+
+    def test_tuple(self):
+        for tp in [Tuple, Tuple[()], Tuple[int], Tuple[int, str],
+                   Tuple[int, Optional[str]], Tuple[Tuple[int, str], Any],
+                   Tuple[Tuple[int, str], None]]:
+            self.assertSameAsIsinstance(tp, self.values)
+
+    def test_callable(self):
+        for tp in [Callable, Callable[[Any], int], Callable[[int], int]]:
+            self.assertSameAsIsinstance(tp, self.values)
+
+    def test_typevar(self):
+        self.assertSameAsIsinstance(T, self.values)
+        self.assertSameAsIsinstance(AnyStr, self.values)
+        check = compile_checker(Tuple[T, T])
+        self.assertFalse(check((42, 42)))
+        with T.bind(int):
+            self.assertTrue(check((42, 42)))
+            self.assertFalse(check((42, '')))
+
+    def test_generic(self):
+        self.assertSameAsIsinstance(SimpleMapping[str, int],
+                                    self.values + [MySimpleMapping()])
+
+    def test_cached(self):
+        self.assertIs(compile_checker(Tuple[int, str]),
+                      compile_checker(Tuple[int, str]))
+        self.assertIs(compile_checker(None), compile_checker(type(None)))
+
+    def test_cache_does_not_pin(self):
+        import gc
+        import weakref
+
+        class C:
+            pass
+        # The checker's globals refer to the type and to C.
+        compile_checker(C)
+        compile_checker(Tuple[int, Optional[C]])
+        r = weakref.ref(C)
+        del C
+        gc.collect()
+        self.assertIsNone(r())
+
+    def test_flattened(self):
+        # No typing metaclass is dispatched to.
+        from typing import TupleMeta, UnionMeta
+        check = compile_checker(Tuple[int, Union[str, None]])
+        fail = mock.Mock(side_effect=AssertionError)
+        with mock.patch.object(TupleMeta, '__instancecheck__', fail), \
+                mock.patch.object(UnionMeta, '__instancecheck__', fail):
+            self.assertTrue(check((1, None)))
+            self.assertFalse(check((1, 2)))
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            compile_checker(42)
+
+
+class CheckManyTests(TestCase):
+
+    def test_basics(self):
+        count, failures = check_many(int, [1, 'a', 2, None])
+        self.assertEqual(count, 4)
+        self.assertEqual(list(failures), [1, 3])
+        self.assertEqual(check_many(int, []), (0, array('q')))
+        self.assertEqual(check_many(int, iter(range(10))),
+                         (10, array('q')))
+
+    def test_typing_types(self):
+        values = [(1, 'a'), (1, None), ('a', 1), 42, (1, 'a', 2)]
+        tp = Tuple[int, Optional[str]]
+        count, failures = check_many(tp, values)
+        self.assertEqual(count, len(values))
+        self.assertEqual(list(failures),
+                         [i for i, v in enumerate(values)
+                          if not isinstance(v, tp)])
+
+    def test_bitmask(self):
+        values = [1, 'a', 2, None, 3, 4, 5, 6, 'b', 7]
+        count, failures = check_many(int, values, bitmask=True)
+        self.assertEqual(count, 10)
+        self.assertEqual(failures, bytearray([0b00001010, 0b00000001]))
+        self.assertEqual(check_many(int, range(8), bitmask=True),
+                         (8, bytearray([0])))
+        self.assertEqual(check_many(int, [], bitmask=True), (0, bytearray()))
+
+    def test_iter_failures(self):
+        values = iter([1, 'a', 2, None])
+        failures = iter_failures(int, values)
+        self.assertEqual(next(failures), (1, 'a'))
+        self.assertEqual(next(values), 2)  # Consumed lazily.
+        self.assertEqual(list(failures), [(2, None)])
+
+    def test_checked_iter(self):
+        values = iter([1, 2, 'a', 3, None])
+        checked = checked_iter(int, values)
+        self.assertIs(iter(checked), checked)
+        self.assertEqual(next(checked), 1)
+        self.assertEqual(list(values), [2, 'a', 3, None])  # Consumed lazily.
+        values = iter([1, 2, 'a', 3, None])
+        checked = checked_iter(int, values)
+        self.assertEqual([next(checked), next(checked)], [1, 2])
+        with self.assertRaisesRegex(TypeError, "value 2 must be int, got 'a'"):
+            next(checked)
+        self.assertEqual(next(checked), 3)
+        with self.assertRaisesRegex(TypeError, 'value 4 '):
+            list(checked)
+        self.assertEqual(list(checked_iter(Optional[int], [1, None])),
+                         [1, None])
+        with self.assertRaises(TypeError):
+            checked_iter(42, [])
+
+    def test_parallel(self):
+        values = [(1, 'a'), (1, None), ('a', 1), 42, (1, 'a', 2)] * 20
+        tp = Tuple[int, Optional[str]]
+        expected = check_many(tp, values)
+        for chunksize in [1, 7, 1000]:
+            self.assertEqual(validate_parallel(tp, iter(values), workers=2,
+                                               chunksize=chunksize),
+                             expected)
+        self.assertEqual(validate_parallel(tp, values, workers=1), expected)
+        self.assertEqual(validate_parallel(int, [], workers=2),
+                         (0, array('q')))
+
+    def test_parallel_like_caller(self):
+        # Workers use the caller's element checks and bindings, even if
+        # they don't inherit its state (as with fork).
+        import multiprocessing
+        spawn = multiprocessing.get_context('spawn')
+        with mock.patch('multiprocessing.get_context', return_value=spawn):
+            self.check_parallel_like_caller()
+
+    def check_parallel_like_caller(self):
+        values = [[1, 'a'], ['a', 1], 1, 'a'] * 5
+        with element_check(Shallow()):
+            expected = check_many(List[int], values)
+            self.assertEqual(validate_parallel(List[int], values, workers=2,
+                                               chunksize=3),
+                             expected)
+        self.assertNotEqual(check_many(List[int], values), expected)
+        with T.bind(int):
+            expected = check_many(T, values)
+            self.assertEqual(validate_parallel(T, values, workers=2),
+                             expected)
+        self.assertNotEqual(check_many(T, values), expected)
+
+    def test_parallel_errors(self):
+        with self.assertRaises(ValueError):
+            validate_parallel(int, [], workers=0)
+        with self.assertRaises(ValueError):
+            validate_parallel(int, [], chunksize=0)
+
+
+class TypecheckedTests(TestCase):
+
+    def test_basics(self):
+        @typechecked
+        def flub(a: int, b: str, c) -> str:
+            return b * a
+
+        self.assertEqual(flub(2, 'x', None), 'xx')
+        self.assertEqual(flub(a=2, b='x', c=None), 'xx')
+        with self.assertRaises(TypeError):
+            flub('x', 'x', None)
+        with self.assertRaises(TypeError):
+            flub(2, b=2, c=None)
+        self.assertEqual(flub.__name__, 'flub')
+
+    def test_return(self):
+        @typechecked
+        def flub(a) -> Optional[int]:
+            return a
+
+        self.assertEqual(flub(42), 42)
+        self.assertIsNone(flub(None))
+        with self.assertRaises(TypeError):
+            flub('')
+
+    def test_defaults(self):
+        @typechecked
+        def flub(a: int = None, *, b: str = None):
+            return a, b
+
+        self.assertEqual(flub(), (None, None))
+        self.assertEqual(flub(1, b=''), (1, ''))
+        with self.assertRaises(TypeError):
+            flub('')
+        with self.assertRaises(TypeError):
+            flub(b=1)
+
+    def test_varargs(self):
+        @typechecked
+        def flub(*args: int, **kwds: Tuple[int, str]):
+            return args, kwds
+
+        self.assertEqual(flub(1, 2, x=(1, '')), ((1, 2), {'x': (1, '')}))
+        with self.assertRaises(TypeError):
+            flub(1, '')
+        with self.assertRaisesRegex(TypeError, "argument 'x' must be"):
+            flub(x=(1, 2))
+
+    def test_type_vars(self):
+        @typechecked
+        def add(a: T, b: T) -> T:
+            return a + b
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(add('a', 'b'), 'ab')
+        with self.assertRaises(TypeError):
+            add(1, '')
+        self.assertNotIsInstance(42, T)  # Unbound after the call.
+
+        @typechecked
+        def concat(a: AnyStr, b: AnyStr) -> AnyStr:
+            return a + b
+
+        self.assertEqual(concat(b'a', b'b'), b'ab')
+        with self.assertRaises(TypeError):
+            concat(1, 2)
+        with self.assertRaises(TypeError):
+            concat('a', b'b')
+
+        class MyStr(str):
+            pass
+        # Bound to the constraint, str.
+        self.assertEqual(concat(MyStr('a'), 'b'), 'ab')
+        self.assertEqual(concat('a', MyStr('b')), 'ab')
+        self.assertIsNone(AnyStr.__binding__)
+
+    def test_type_var_argument_order(self):
+        @typechecked
+        def add(a: T, b: T, *args: T) -> T:
+            return a + b
+
+        # T is bound to the type both arguments are instances of.
+        self.assertEqual(add(1, True), 2)
+        self.assertEqual(add(True, 1), 2)
+        self.assertEqual(add(True, 1, 1, False), 2)
+        msg = r"argument 'b' must be bool \(~T, bound by argument 'a'\)"
+        with self.assertRaisesRegex(TypeError, msg):
+            add(True, '')
+        with self.assertRaisesRegex(TypeError, r"must be ~T \(~T is int\)"):
+            add(True, 1, '')
+
+    def test_unbindable_type_vars(self):
+        @typechecked
+        def first(t: Tuple[T, AnyStr]) -> T:
+            return t[0]
+
+        self.assertEqual(first((1, '')), 1)
+        with self.assertRaises(TypeError):
+            first((1, 2))
+
+        @typechecked
+        def flub(a: List[AnyStr], b: Dict[KT, List[T]]):
+            pass
+
+        flub(['', b''], {1: ['']})
+        with self.assertRaises(TypeError):
+            flub([1], {})
+
+    def test_method(self):
+        class C:
+            @typechecked
+            def meth(self, a: int) -> int:
+                return a
+
+        self.assertEqual(C().meth(42), 42)
+        with self.assertRaises(TypeError):
+            C().meth('')
+
+    def test_name_clash(self):
+        @typechecked
+        def flub(_tcfunc: int, _tc1: int) -> int:
+            return _tcfunc + _tc1
+
+        self.assertEqual(flub(1, 2), 3)
+
+        @typechecked
+        def flob(type: str, a: T, b: T) -> T:
+            return a
+
+        self.assertEqual(flob('', 1, 2), 1)
+        with self.assertRaises(TypeError):
+            flob('', 1, '')
+
+    def test_generator(self):
+        @typechecked
+        def gen(items: Iterable[Any]) -> Iterator[int]:
+            for item in items:
+                received = yield item
+                if received is not None:
+                    yield received
+
+        checked = gen(iter([1, 'a']))
+        self.assertIsInstance(checked, collections.abc.Generator)
+        self.assertEqual(next(checked), 1)
+        with self.assertRaisesRegex(TypeError,
+                                    "gen\\(\\): yielded value 1 must be int"):
+            next(checked)
+        checked.close()
+        checked = gen([1, 2])
+        self.assertEqual(next(checked), 1)
+        self.assertEqual(checked.send(3), 3)
+        self.assertEqual(next(checked), 2)
+        with self.assertRaises(TypeError):
+            checked.send('a')
+        self.assertEqual(list(checked), [])
+
+    def test_generator_type_var(self):
+        @typechecked
+        def repeat(a: T, b: Any) -> Iterable[T]:
+            yield a
+            yield b
+
+        self.assertEqual(list(repeat(1, 2)), [1, 2])
+        with self.assertRaises(TypeError):
+            list(repeat(1, ''))
+
+    def test_generator_unchecked(self):
+        def gen() -> Iterator:
+            yield ''
+
+        def other() -> List[int]:
+            yield ''
+
+        # Only Iterator[T] and Iterable[T] check the values yielded.
+        self.assertEqual(list(typechecked(gen)()), [''])
+        with self.assertRaises(TypeError):
+            typechecked(other)()
+
+    def test_iterator_argument(self):
+        @typechecked
+        def total(rows: Iterator[int], start: Iterator[int] = None) -> int:
+            return sum(rows)
+
+        self.assertEqual(total(iter([1, 2])), 3)
+        self.assertEqual(total(iter([1, 2]), None), 3)
+        with self.assertRaisesRegex(TypeError, "total\\(\\): value 1 of "
+                                    "argument 'rows' must be int"):
+            total(iter([1, 'a']))
+        with self.assertRaises(TypeError):
+            total([1, 2])
+
+        @typechecked
+        def append(a: T, rows: Iterator[T]) -> List[T]:
+            return [a] + list(rows)
+
+        self.assertEqual(append(1, iter([2])), [1, 2])
+        with self.assertRaises(TypeError):
+            append(1, iter(['']))
+
+        @typechecked
+        def same(rows: Iterator) -> Iterator:
+            return rows
+
+        # Iterators of anything are passed as they are.
+        it = iter([''])
+        self.assertIs(same(it), it)
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            @typechecked
+            def flub(a: 42):
+                pass
+
+
+class SamplingTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(set_sampling, None)
+        self.addCleanup(set_sampling, None, module=__name__)
+
+        @typechecked
+        def flub(a: int) -> int:
+            return a
+
+        self.flub = flub
+
+    def count_checked(self, func, calls=10):
+        # Bad calls that got through weren't checked.
+        checked = 0
+        for i in range(calls):
+            try:
+                func('')
+            except TypeError:
+                checked += 1
+        return checked
+
+    def test_default(self):
+        self.assertEqual(self.count_checked(self.flub), 10)
+
+    def test_every_nth(self):
+        set_sampling(EveryNth(3), func=self.flub)
+        self.assertEqual(self.count_checked(self.flub), 4)
+        with self.assertRaises(ValueError):
+            EveryNth(0)
+
+    def test_first_then_every_nth(self):
+        set_sampling(FirstThenEveryNth(5, 100), func=self.flub)
+        self.assertEqual(self.count_checked(self.flub, 200), 7)
+
+    def test_time_budget(self):
+        now = [0.0]
+        budget = TimeBudget(0.5, clock=lambda: now[0])
+        set_sampling(budget, func=self.flub)
+        self.assertEqual(self.flub(1), 1)
+        budget.record(1.0)  # Pretend the checks were slow.
+        self.assertEqual(self.count_checked(self.flub), 0)
+        now[0] = 1.5  # Next second; the clock is consulted again soon.
+        self.assertGreater(self.count_checked(self.flub, 50), 40)
+
+    def test_time_budget_backoff(self):
+        looks = []
+
+        def clock():
+            looks.append(None)
+            return 0.0
+
+        budget = TimeBudget(0.5, clock=clock)
+        set_sampling(budget, func=self.flub)
+        self.flub(1)
+        budget.record(1.0)
+        del looks[:]
+        # Each look lets twice as many calls through unchecked.
+        self.assertEqual(self.count_checked(self.flub, 100000), 0)
+        self.assertLessEqual(len(looks), 17)
+
+    def test_time_budget_rate_drop(self):
+        now = [0.0]
+        budget = TimeBudget(0.5, clock=lambda: now[0])
+        set_sampling(budget, func=self.flub)
+        self.flub(1)
+        budget.record(1.0)
+        for i in range(20000):  # A burst of calls, over budget.
+            now[0] = i / 20000
+            self.assertEqual(self.count_checked(self.flub, 1), 0)
+        # Then a call every 0.1 seconds: checking resumes soon after
+        # the second is over.
+        for i in range(1, 10):
+            now[0] = 1.0 + i / 10
+            if self.count_checked(self.flub, 1):
+                break
+        else:
+            self.fail("not checked again")
+
+    def test_module_and_default(self):
+        set_sampling(EveryNth(1000))
+        self.assertEqual(self.count_checked(self.flub), 1)
+        set_sampling(Sampler(), module=__name__)
+        self.assertEqual(self.count_checked(self.flub), 10)
+        set_sampling(EveryNth(1000), func=self.flub)
+        self.assertEqual(self.count_checked(self.flub), 1)
+        set_sampling(None, func=self.flub)
+        set_sampling(None, module=__name__)
+        self.assertEqual(self.count_checked(self.flub), 0)
+
+    def test_new_functions_follow_module(self):
+        set_sampling(EveryNth(1000), module=__name__)
+
+        @typechecked
+        def flob(a: int):
+            pass
+
+        self.assertEqual(self.count_checked(flob), 1)
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            set_sampling(3)
+        with self.assertRaises(TypeError):
+            set_sampling(None, func=len)
+
+
+class AsyncTypecheckedTests(TestCase):
+
+    def run_async(self, coro):
+        return run_async(coro)
+
+    def test_coroutine(self):
+        @typechecked
+        async def flub(a: int) -> int:
+            return a
+
+        self.assertEqual(self.run_async(flub(42)), 42)
+        # Arguments are checked at call time, before anything is awaited.
+        with self.assertRaises(TypeError):
+            flub('')
+
+        @typechecked
+        async def flob(a: int) -> int:
+            return str(a)
+
+        with self.assertRaisesRegex(TypeError, 'return value'):
+            self.run_async(flob(42))
+
+    def test_coroutine_type_var(self):
+        @typechecked
+        async def same(a: T, b: T) -> T:
+            return b
+
+        self.assertEqual(self.run_async(same(1, 2)), 2)
+        with self.assertRaises(TypeError):
+            self.run_async(same(1, ''))
+
+    def test_coroutine_unchecked(self):
+        async def flub(a):
+            return a
+
+        # Without a return annotation, the coroutine itself is returned.
+        coro = typechecked(flub)(42)
+        self.assertIs(coro.cr_code, flub.__code__)
+        self.assertEqual(self.run_async(coro), 42)
+
+    def test_coroutine_same_task(self):
+        import asyncio
+        if hasattr(asyncio, 'current_task'):
+            current_task = asyncio.current_task
+        else:
+            current_task = asyncio.Task.current_task  # Python 3.6.
+
+        @typechecked
+        async def task() -> asyncio.Task:
+            return current_task()
+
+        async def main():
+            return await task() is current_task()
+
+        self.assertTrue(self.run_async(main()))
+
+    def test_async_generator(self):
+        @typechecked
+        async def gen(items: List[Any]) -> AsyncIterator[int]:
+            for item in items:
+                received = yield item
+                if received is not None:
+                    yield received
+
+        async def collect(agen):
+            return [item async for item in agen]
+
+        self.assertEqual(self.run_async(collect(gen([1, 2]))), [1, 2])
+        with self.assertRaisesRegex(TypeError, 'yielded value'):
+            self.run_async(collect(gen([1, ''])))
+
+        async def send():
+            agen = gen([1])
+            self.assertIsInstance(agen, AsyncIterator)
+            self.assertEqual(await agen.__anext__(), 1)
+            with self.assertRaises(TypeError):
+                await agen.asend('')
+            await agen.aclose()
+
+        self.run_async(send())
+
+    def test_async_generator_throw(self):
+        @typechecked
+        async def gen() -> AsyncIterable[int]:
+            try:
+                yield 1
+            except ValueError:
+                yield 'caught'
+
+        async def throw():
+            agen = gen()
+            await agen.__anext__()
+            with self.assertRaisesRegex(TypeError, 'yielded value'):
+                await agen.athrow(ValueError)
+            await agen.aclose()
+
+        self.run_async(throw())
+
+    def test_sampling(self):
+        self.addCleanup(set_sampling, None)
+
+        @typechecked
+        async def flub(a: int) -> int:
+            return str(a)
+
+        set_sampling(EveryNth(2), func=flub)
+        with self.assertRaises(TypeError):
+            self.run_async(flub(1))
+        # Unsampled calls return the coroutine itself.
+        coro = flub(1)
+        self.assertIs(coro.cr_code, flub.__wrapped__.__code__)
+        self.assertEqual(self.run_async(coro), '1')
+
+class CollectionTests(TestCase):
+
+    def test_repr(self):
+        self.assertEqual(repr(List), 'typing.List[~T]')
+        self.assertEqual(repr(Dict[str, int]), 'typing.Dict[str, int]')
+
+    def test_instance(self):
+        self.assertIsInstance([], List)
+        self.assertIsInstance([1, 2], List[int])
+        self.assertNotIsInstance([1, ''], List[int])
+        self.assertNotIsInstance((1, 2), List[int])
+        self.assertIsInstance((1, 2), Sequence[int])
+        self.assertIsInstance({1}, Set[int])
+        self.assertNotIsInstance({1}, FrozenSet[int])
+        self.assertIsInstance(frozenset([1]), AbstractSet[int])
+        self.assertIsInstance({'': 1}, Dict[str, int])
+        self.assertNotIsInstance({'': ''}, Mapping[str, int])
+        self.assertNotIsInstance({1: 1}, MutableMapping[str, int])
+        self.assertIsInstance({'': 1}.keys(), KeysView[str])
+        self.assertNotIsInstance({'': 1}.items(), ItemsView[str, str])
+
+    def test_nested(self):
+        self.assertIsInstance({'': [(1, None)]},
+                              Dict[str, List[Tuple[int, Optional[str]]]])
+        self.assertNotIsInstance({'': [(1, 2)]},
+                                 Dict[str, List[Tuple[int, Optional[str]]]])
+        self.assertIsInstance([1, ''], List[Union[int, str]])
+
+    def test_type_var_elements(self):
+        # The type variables of Dict itself accept anything.
+        self.assertIsInstance({1: ''}, Dict)
+        # Others are checked, as in Tuple.
+        self.assertIsInstance([b'a'], List[AnyStr])
+        self.assertNotIsInstance([1], List[AnyStr])
+        self.assertNotIsInstance((1,), Tuple[AnyStr])
+        self.assertNotIsInstance({1: ''}, Dict[KT, VT])
+        self.assertNotIsInstance((1, ''), Tuple[KT, VT])
+        self.assertIsInstance({}, Dict[KT, VT])
+        with T.bind(str):
+            self.assertIsInstance(['a'], List[T])
+            self.assertNotIsInstance([1], List[T])
+            self.assertNotIsInstance((1,), Tuple[T])
+
+    def test_iterators_not_consumed(self):
+        it = iter([1, 2])
+        self.assertIsInstance(it, Iterator[str])
+        self.assertIsInstance(it, Iterable[str])
+        self.assertEqual(list(it), [1, 2])
+
+    def test_subclass(self):
+        self.assertTrue(issubclass(list, List))
+        self.assertTrue(issubclass(list, List[int]))
+        self.assertTrue(issubclass(list, Sequence))
+        self.assertTrue(issubclass(List, Sequence))
+        self.assertTrue(issubclass(List[int], Sequence[int]))
+        self.assertTrue(issubclass(List[bool], Sequence[int]))
+        self.assertFalse(issubclass(List[int], Sequence[str]))
+        self.assertFalse(issubclass(List, Sequence[int]))
+        self.assertTrue(issubclass(Dict[str, int], Mapping[str, int]))
+        self.assertFalse(issubclass(tuple, List))
+        self.assertFalse(issubclass(Sequence, List))
+
+    def test_subclass_other_abc(self):
+        # The parameters are mapped through the bases.
+        self.assertTrue(issubclass(Dict[str, int], Iterable[str]))
+        self.assertTrue(issubclass(Dict[bool, int], Container[int]))
+        self.assertTrue(issubclass(Mapping[str, int], Container[str]))
+        self.assertTrue(issubclass(Mapping[str, int], Iterable[str]))
+        self.assertTrue(issubclass(FrozenSet[int], Iterable[int]))
+        self.assertFalse(issubclass(Dict[str, int], Iterable[int]))
+        self.assertFalse(issubclass(Mapping[str, int], Container[bytes]))
+        self.assertFalse(issubclass(Dict, Iterable[str]))
+        self.assertTrue(issubclass(dict, Iterable[str]))
+
+    def test_byte_string(self):
+        import typing
+        # Not generic, and its elements are never checked.
+        self.assertIsNone(ByteString.__parameters__)
+        self.assertEqual(repr(ByteString), 'typing.ByteString')
+        self.assertIsInstance(b'ab', ByteString)
+        self.assertIsInstance(bytearray(b'ab'), ByteString)
+        self.assertNotIsInstance('ab', ByteString)
+        self.assertTrue(issubclass(ByteString, Sequence[int]))
+        self.assertFalse(issubclass(ByteString, Sequence[str]))
+        with mock.patch.object(typing, 'compile_checker',
+                               side_effect=AssertionError):
+            self.assertIsInstance(bytes(100), ByteString)
+
+    def test_user_subclass(self):
+
+        class MyList(List[int]):
+            pass
+
+        self.assertNotIsInstance([], MyList)
+        self.assertIsInstance(MyList(), List)
+        self.assertTrue(issubclass(MyList, Sequence[int]))
+        self.assertTrue(issubclass(MyList, Iterable[int]))
+        self.assertFalse(issubclass(MyList, Iterable[str]))
+
+    def test_element_checks(self):
+        values = [1] * 10 + ['']
+        self.assertNotIsInstance(values, List[int])
+        with element_check(Shallow()):
+            self.assertIsInstance(values, List[int])
+        with element_check(FirstK(10)):
+            self.assertIsInstance(values, List[int])
+        with element_check(FirstK(11)):
+            self.assertNotIsInstance(values, List[int])
+        with element_check(ElementCheck()):
+            self.assertNotIsInstance(values, List[int])
+        self.assertNotIsInstance(values, List[int])
+
+    def test_first_k_mapping(self):
+        with element_check(FirstK(1)):
+            self.assertIsInstance({'': 1, 1: 1}, Dict[str, int])
+            self.assertNotIsInstance({1: 1, '': 1}, Dict[str, int])
+
+    def test_random_k(self):
+        import random
+        values = list(range(100))
+        check = RandomK(3, random.Random(42))
+        with element_check(check):
+            self.assertIsInstance(values, List[int])
+            values[0] = ''
+            # A sample of 3 out of 100 usually misses values[0].
+            results = set()
+            for i in range(100):
+                results.add(isinstance(values, List[int]))
+            self.assertEqual(results, {True, False})
+            # Everything is checked when there are no more than k.
+            self.assertNotIsInstance(['', 1], List[int])
+            self.assertNotIsInstance({'', 1}, Set[int])
+        self.assertEqual(repr(check), 'RandomK(3)')
+
+    def test_set_element_check(self):
+        self.addCleanup(set_element_check, None)
+        set_element_check(Shallow())
+        self.assertIsInstance([''], List[int])
+        with element_check(ElementCheck()):
+            self.assertNotIsInstance([''], List[int])
+        set_element_check(None)
+        self.assertNotIsInstance([''], List[int])
+
+    def test_element_check_threads(self):
+        import threading
+        results = []
+        with element_check(Shallow()):
+            thread = threading.Thread(
+                target=lambda: results.append(isinstance([''], List[int])))
+            thread.start()
+            thread.join()
+        self.assertEqual(results, [False])
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            set_element_check(3)
+        with self.assertRaises(TypeError):
+            element_check(None)
+        with self.assertRaises(ValueError):
+            FirstK(-1)
+        with self.assertRaises(TypeError):
+            List[int, str]
+
+    def test_compile_checker(self):
+        check = compile_checker(Dict[str, List[int]])
+        self.assertTrue(check({'': [1]}))
+        self.assertFalse(check({'': ['']}))
+
+
+class SupportsClose(Protocol):
+
+    def close(self):
+        pass
+
+
+class SupportsAbs(Protocol[T]):
+
+    def __abs__(self) -> T:
+        pass
+
+
+class SupportsCloseAndAbs(SupportsClose, SupportsAbs[T], Protocol):
+    pass
+
+
+class Closer:
+
+    def close(self):
+        pass
+
+
+class ProtocolTests(TestCase):
+
+    def setUp(self):
+        cache_clear()
+
+    def test_structural(self):
+        self.assertIsInstance(Closer(), SupportsClose)
+        self.assertNotIsInstance(Closer(), SupportsAbs)
+        self.assertIsInstance(-1, SupportsAbs)
+        self.assertIsInstance(-1, SupportsAbs[int])
+        self.assertNotIsInstance('', SupportsAbs)
+        self.assertTrue(issubclass(Closer, SupportsClose))
+        self.assertFalse(issubclass(object, SupportsClose))
+
+    def test_inherited_members(self):
+
+        class AbsCloser(Closer):
+
+            def __abs__(self):
+                return self
+
+        self.assertIsInstance(AbsCloser(), SupportsCloseAndAbs)
+        self.assertNotIsInstance(Closer(), SupportsCloseAndAbs)
+        self.assertNotIsInstance(-1, SupportsCloseAndAbs)
+
+    def test_none_member(self):
+
+        class NoClose(Closer):
+            close = None
+
+        self.assertNotIsInstance(NoClose(), SupportsClose)
+
+    def test_super_in_member(self):
+
+        class SupportsSuperClose(Protocol):
+            def close(self):
+                return super().close()
+
+        self.assertEqual(SupportsSuperClose.__protocol_members__, {'close'})
+        self.assertIsInstance(Closer(), SupportsSuperClose)
+
+    def test_explicit_subclass(self):
+
+        class MyCloser(SupportsClose):
+            pass
+
+        self.assertIsInstance(MyCloser(), SupportsClose)
+        # MyCloser is not a protocol itself.
+        self.assertNotIsInstance(Closer(), MyCloser)
+        self.assertIsInstance(MyCloser(), MyCloser)
+
+    def test_cached(self):
+        closer = Closer()
+        self.assertIsInstance(closer, SupportsClose)
+        with mock.patch.object(type(SupportsClose), '_conforms') as conforms:
+            self.assertIsInstance(closer, SupportsClose)
+            self.assertTrue(issubclass(Closer, SupportsClose))
+        self.assertFalse(conforms.called)
+        info = cache_info()['protocol']
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+    def test_generic_class_mutation(self):
+
+        class Node(Generic[T]):
+            pass
+
+        class Leaf(Node):
+            pass
+
+        self.assertNotIsInstance(Leaf(), SupportsClose)
+        Node.close = lambda self: None
+        self.assertIsInstance(Leaf(), SupportsClose)
+        del Node.close
+        self.assertNotIsInstance(Leaf(), SupportsClose)
+
+    def test_mutation_in_union(self):
+
+        class Node(Generic[T]):
+            pass
+
+        u = Union[int, SupportsClose]
+        t = Tuple[SupportsClose]
+        self.assertFalse(issubclass(Node, u))
+        self.assertFalse(issubclass(Tuple[Node], t))
+        Node.close = lambda self: None
+        self.assertTrue(issubclass(Node, u))
+        self.assertTrue(issubclass(Tuple[Node], t))
+        del Node.close
+        self.assertFalse(issubclass(Node, u))
+
+        class Closing(Generic[T]):
+            def close(self):
+                pass
+
+        # Normalized using conformance, so the union must be rebuilt.
+        self.assertIs(Union[Closing, SupportsClose], SupportsClose)
+        Closing.close = None
+        self.assertEqual(Union[Closing, SupportsClose].__union_params__,
+                         (Closing, SupportsClose))
+        self.assertIsInstance(Closing(), Union[Closing, SupportsClose])
+
+    def test_protocol_mutation_in_union(self):
+
+        class SupportsFlush(Protocol):
+
+            def flush(self):
+                pass
+
+        class Flusher:
+
+            def flush(self):
+                pass
+
+        u = Union[int, SupportsFlush]
+        self.assertTrue(issubclass(Flusher, u))
+        SupportsFlush.close = lambda self: None
+        self.assertFalse(issubclass(Flusher, u))
+
+    def test_class_creation_does_not_invalidate(self):
+        import typing
+        List  # Built lazily.
+        with mock.patch.object(typing, '_invalidate_conformance') as inv:
+
+            class Node(Generic[T]):
+                pass
+            Node[int]
+            List[bytearray]
+        self.assertFalse(inv.called)
+
+    def test_plain_class_mutation(self):
+
+        class Thing:
+            pass
+
+        self.assertNotIsInstance(Thing(), SupportsClose)
+        Thing.close = lambda self: None
+        cache_clear()
+        self.assertIsInstance(Thing(), SupportsClose)
+
+    def test_protocol_mutation(self):
+
+        class SupportsFlush(Protocol):
+
+            def flush(self):
+                pass
+
+        class Flusher:
+
+            def flush(self):
+                pass
+
+        self.assertIsInstance(Flusher(), SupportsFlush)
+        SupportsFlush.close = lambda self: None
+        self.assertNotIsInstance(Flusher(), SupportsFlush)
+        del SupportsFlush.close
+        self.assertIsInstance(Flusher(), SupportsFlush)
+
+    def test_equal_protocols(self):
+        # Distinct protocols can compare equal; both are invalidated.
+        def make():
+            class SupportsFlush(Protocol):
+                def flush(self):
+                    pass
+            return SupportsFlush
+
+        class Flusher:
+
+            def flush(self):
+                pass
+
+        P1, P2 = make(), make()
+        self.assertEqual(P1, P2)
+        self.assertTrue(issubclass(Flusher, P1))
+        self.assertTrue(issubclass(Flusher, P2))
+        P2.close = lambda self: None
+        self.assertTrue(issubclass(Flusher, P1))
+        self.assertFalse(issubclass(Flusher, P2))
+
+    def test_class_lifetime(self):
+        import gc
+
+        class Thing:
+            def close(self):
+                pass
+
+        self.assertIsInstance(Thing(), SupportsClose)
+        self.assertEqual(cache_info()['protocol'].currsize, 1)
+        del Thing
+        gc.collect()
+        self.assertEqual(cache_info()['protocol'].currsize, 0)
+
+    def test_not_a_class(self):
+        with self.assertRaises(TypeError):
+            issubclass(42, SupportsClose)
+
+
+class InstanceMemoTests(TestCase):
+
+    def setUp(self):
+        set_instance_memo(100)
+        self.addCleanup(set_instance_memo, 0)
+        cache_clear()
+
+    def info(self):
+        return cache_info()['instance']
+
+    def test_off_by_default(self):
+        set_instance_memo(0)
+        value = (1, 'a')
+        self.assertIsInstance(value, Tuple[int, str])
+        self.assertEqual(self.info().currsize, 0)
+
+    def test_memoized(self):
+        from typing import TupleMeta
+        value = tuple(range(100))
+        tp = Tuple[(int,) * 100]
+        self.assertIsInstance(value, tp)
+        with mock.patch.object(TupleMeta, '_check_instance') as check:
+            self.assertIsInstance(value, tp)
+            self.assertIsInstance(value, tp)
+        self.assertFalse(check.called)
+        self.assertEqual(self.info().hits, 2)
+        # Equal, but not the same tuple.
+        self.assertIsInstance(tuple(range(100)), tp)
+        self.assertEqual(self.info().currsize, 2)
+
+    def test_frozenset(self):
+        value = frozenset(range(10))
+        self.assertIsInstance(value, FrozenSet[int])
+        self.assertIsInstance(value, FrozenSet[int])
+        self.assertEqual(self.info().hits, 1)
+        self.assertNotIsInstance({1}, FrozenSet[int])
+        self.assertEqual(self.info().currsize, 1)
+
+    def test_failures_not_memoized(self):
+        value = (1, 'a')
+        self.assertNotIsInstance(value, Tuple[int, int])
+        self.assertNotIsInstance(value, Tuple[int, int])
+        self.assertEqual(self.info().currsize, 0)
+
+    def test_mutable_elements(self):
+        value = ([1],)
+        self.assertIsInstance(value, Tuple[List[int]])
+        value[0].append('')
+        self.assertNotIsInstance(value, Tuple[List[int]])
+        self.assertEqual(self.info().currsize, 0)
+
+    def test_type_vars(self):
+        value = (1,)
+        with T.bind(int):
+            self.assertIsInstance(value, Tuple[T])
+        self.assertNotIsInstance(value, Tuple[T])
+        self.assertEqual(self.info().currsize, 0)
+
+    def test_partial_element_checks(self):
+        value = (frozenset([1, 2, 3]),)
+        with element_check(Shallow()):
+            self.assertIsInstance(value, Tuple[FrozenSet[str]])
+        self.assertEqual(self.info().currsize, 0)
+        self.assertNotIsInstance(value, Tuple[FrozenSet[str]])
+
+    def test_tuple_subclass(self):
+        Point = collections.namedtuple('Point', 'x y')
+        self.assertIsInstance(Point(1, 2), Tuple[int, int])
+        self.assertEqual(self.info().currsize, 0)
+
+    def test_eviction(self):
+        set_instance_memo(2)
+        values = [(i,) for i in range(3)]
+        for value in values:
+            self.assertIsInstance(value, Tuple[int])
+        self.assertEqual(self.info().currsize, 2)
+        self.assertEqual(self.info().evictions, 1)
+        set_instance_memo(0)
+        self.assertEqual(self.info().currsize, 0)
+
+    def test_compiled(self):
+        set_instance_memo(0)
+        check = compile_checker(Tuple[int, Optional[str]])
+        set_instance_memo(100)
+        value = (1, None)
+        self.assertTrue(check(value))
+        self.assertTrue(check(value))
+        self.assertEqual(self.info().hits, 1)
+        self.assertFalse(check((1, 2)))
+
+    def test_typechecked(self):
+
+        @typechecked
+        def flob(a: Tuple[int, int]) -> Tuple[int, int]:
+            return a
+
+        value = (1, 2)
+        flob(value)
+        flob(value)
+        self.assertEqual(self.info().hits, 3)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            set_instance_memo(-1)
+        with self.assertRaises(ValueError):
+            set_instance_memo(None)
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        instrumentation_snapshot(reset=True)
+        self.addCleanup(instrumentation_snapshot, reset=True)
+        self.addCleanup(set_instrumentation, False)
+
+    def test_off_by_default(self):
+        from typing import UnionMeta
+        original = UnionMeta.__dict__['__instancecheck__']
+        self.assertIsInstance(42, Union[int, str])
+        snapshot = instrumentation_snapshot()
+        self.assertFalse(snapshot['enabled'])
+        self.assertEqual(snapshot['metaclasses'], {})
+        set_instrumentation(True)
+        self.assertIsNot(UnionMeta.__dict__['__instancecheck__'], original)
+        set_instrumentation(False)
+        self.assertIs(UnionMeta.__dict__['__instancecheck__'], original)
+
+    def test_counts(self):
+        set_instrumentation(True)
+        tp = Union[int, Tuple[int, str]]
+        self.assertIsInstance(42, tp)
+        self.assertIsInstance((42, ''), tp)
+        self.assertTrue(issubclass(int, tp))
+        set_instrumentation(False)
+        self.assertIsInstance(42, tp)  # Not counted.
+        snapshot = instrumentation_snapshot()
+        union = snapshot['metaclasses']['UnionMeta']
+        self.assertEqual(union['instancecheck']['calls'], 2)
+        self.assertEqual(union['subclasscheck']['calls'], 1)
+        self.assertGreater(union['instancecheck']['seconds'], 0)
+        entry = snapshot['types'][repr(Tuple[int, str])]
+        self.assertEqual(entry['metaclass'], 'TupleMeta')
+        self.assertEqual(entry['instancecheck']['calls'], 1)
+        self.assertEqual(snapshot['types'][repr(tp)]['instancecheck'],
+                         union['instancecheck'])
+
+    def test_super_counted_once(self):
+
+        class MyCloser(SupportsClose):
+            pass
+
+        class MyOtherCloser(MyCloser):
+            pass
+
+        set_instrumentation(True)
+        self.assertIsInstance(MyOtherCloser(), MyCloser)
+        snapshot = instrumentation_snapshot()
+        self.assertEqual(
+            snapshot['metaclasses']['ProtocolMeta']['instancecheck'],
+            snapshot['types'][repr(MyCloser)]['instancecheck'])
+        self.assertNotIn('GenericMeta', snapshot['metaclasses'])
+        self.assertEqual(
+            snapshot['types'][repr(MyCloser)]['instancecheck']['calls'], 1)
+
+    def test_reset(self):
+        set_instrumentation(True)
+        isinstance(42, Optional[int])
+        self.assertTrue(instrumentation_snapshot(reset=True)['types'])
+        self.assertFalse(instrumentation_snapshot()['types'])
+
+    def test_untracked(self):
+        import typing
+        set_instrumentation(True)
+        with mock.patch.object(typing, '_MAX_TYPE_STATS', 1):
+            isinstance(42, Optional[int])
+            isinstance(42, Optional[str])
+        snapshot = instrumentation_snapshot()
+        self.assertEqual(len(snapshot['types']), 1)
+        self.assertEqual(snapshot['untracked_calls'], 1)
+        self.assertEqual(
+            snapshot['metaclasses']['UnionMeta']['instancecheck']['calls'], 2)
+
+    def test_caches(self):
+        cache_clear()
+        Union[int, str]  # Misses twice: as given, and normalized.
+        Union[int, str]
+        stats = instrumentation_snapshot()['caches']['union']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(stats['hit_rate'], 1 / 3)
+
+    def test_check_cache_hits(self):
+        u = Union[int, Employee]
+        cache_clear()
+        set_instrumentation(True)
+        self.assertTrue(issubclass(Manager, u))  # Memoized.
+        self.assertTrue(issubclass(Manager, u))
+        snapshot = instrumentation_snapshot()
+        stats = snapshot['metaclasses']['UnionMeta']['subclasscheck']
+        self.assertEqual((stats['cache_hits'], stats['cache_misses']),
+                         (1, 1))
+        self.assertEqual(stats['cache_hit_rate'], 0.5)
+        self.assertEqual(snapshot['types'][repr(u)]['subclasscheck'], stats)
+        self.assertIn('typing_check_cache_hits_total{metaclass="UnionMeta",'
+                      'method="subclasscheck"} 1\n',
+                      format_instrumentation(snapshot))
+
+    def test_format(self):
+        set_instrumentation(True)
+        isinstance(42, Optional[int])
+        text = format_instrumentation()
+        self.assertIn('# TYPE typing_checks_total counter\n', text)
+        self.assertIn('typing_checks_total{metaclass="UnionMeta",'
+                      'method="instancecheck"} 1\n', text)
+        self.assertIn('typing_untracked_calls_total 0\n', text)
+        snapshot = {'metaclasses': {}, 'caches': {}, 'untracked_calls': 0,
+                    'types': {'a"b\\c': {'metaclass': 'M',
+                                           'instancecheck': {
+                                               'calls': 1, 'seconds': 0.5}}}}
+        self.assertIn('{type="a\\"b\\\\c",metaclass="M",'
+                      'method="instancecheck"} 1\n',
+                      format_instrumentation(snapshot))
+
+    def test_export(self):
+        import os
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'typing.prom')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        export_instrumentation(path)
+        with open(path) as f:
+            self.assertIn('typing_cache_hits_total', f.read())
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['typing.prom'])
+
+
+class BenchmarkTests(TestCase):
+
+    def test_micro_benchmarks_run(self):
+        from bench_typing import micro_benchmarks
+        names = set()
+        for name, func in micro_benchmarks():
+            func()
+            names.add(name)
+        for tp in ['Any', 'TypeVar', 'Union', 'Optional', 'Tuple',
+                   'Callable', 'Generic', 'Undefined']:
+            self.assertIn(tp + '.isinstance', names)
+            self.assertIn(tp + '.repr', names)
+
+    def test_memory(self):
+        from bench_typing import bench_memory
+        results = dict(bench_memory(number=10))
+        self.assertIn('Union', results)
+        self.assertIn('Generic', results)
+        self.assertTrue(all(size > 0 for size in results.values()))
+
+    def test_json_and_compare(self):
+        import os
+        import tempfile
+        from bench_typing import results_to_json, load_results
+        from bench_typing import compare_results
+        results = {'Any.repr': 100.0, 'Any.hash': 50.0}
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(results_to_json(results))
+        baseline = load_results(path)
+        self.assertEqual(baseline, results)
+        current = {'Any.repr': 130.0, 'Any.hash': 50.0, 'Any.eq': 1.0}
+        self.assertEqual(compare_results(baseline, current),
+                         [('Any.hash', 50.0, 50.0, 1.0, False),
+                          ('Any.repr', 100.0, 130.0, 1.3, True)])
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(set_profiling, False)
+
+        @typechecked
+        def flub(a: int, *args: str) -> int:
+            return a
+
+        self.flub = flub
+
+    def test_off(self):
+        set_profiling(True)
+        set_profiling(False)
+        for name, check, func, label, typ in self.flub.__check_state__.checks:
+            self.assertIs(self.flub.__globals__[name], check)
+
+    def test_call_sites(self):
+        import sys
+        set_profiling(True)
+        for i in range(3):
+            self.flub(1, 'a', 'b')
+            first_line = sys._getframe().f_lineno - 1
+        self.flub(1)
+        second_line = sys._getframe().f_lineno - 1
+        with self.assertRaises(TypeError):
+            self.flub('')
+        report = profile_report()
+        self.assertEqual(sum(e.calls for e in report), 3 * 4 + 2 + 1)
+        entries = {(e.lineno, e.argument): e for e in report}
+        self.assertEqual(entries[first_line, 'args'].calls, 6)
+        self.assertEqual(entries[second_line, 'return'].calls, 1)
+        entry = entries[first_line, 'a']
+        self.assertEqual(entry.filename, __file__)
+        self.assertEqual(entry.caller.split('.')[-1], 'test_call_sites')
+        self.assertEqual(entry.function.split('.')[-1], 'flub')
+        self.assertEqual(entry.type, 'int')
+        self.assertEqual(entry.error, 0)
+        self.assertGreater(entry.seconds, 0)
+        self.assertEqual(report, sorted(report, key=lambda e: -e.seconds))
+        self.assertEqual(len(profile_report(2)), 2)
+
+    def test_bounded(self):
+        set_profiling(True, capacity=2)
+        self.flub(1)
+        self.assertEqual([e.error for e in profile_report()], [0, 0])
+        self.flub(1, 'a')
+        report = profile_report()
+        self.assertEqual(len(report), 2)
+        # The 'args' entry replaced one of the others.
+        self.assertTrue(any(e.error > 0 for e in report))
+
+    def test_space_saving(self):
+        import random
+        from typing import _Profiler
+        # Compare with a straightforward version.
+        rng = random.Random(0)
+        profiler = _Profiler(10)
+        expected = {}
+        for i in range(2000):
+            key, elapsed = (rng.randrange(30),), rng.randrange(1, 100)
+            profiler.record(key, elapsed)
+            entry = expected.get(key)
+            if entry is None:
+                seconds = 0
+                if len(expected) == 10:
+                    smallest = min(expected,
+                                   key=lambda k: (expected[k][1], k))
+                    seconds = expected.pop(smallest)[1]
+                entry = expected[key] = [0, seconds, seconds]
+            entry[0] += 1
+            entry[1] += elapsed
+        self.assertEqual(profiler._data, expected)
+        self.assertEqual(len(profiler._heap), 10)
+
+    def test_new_functions(self):
+        set_profiling(True)
+
+        @typechecked
+        def flob(a: Optional[int]):
+            pass
+
+        flob(None)
+        self.assertEqual([(e.argument, e.type) for e in profile_report()],
+                         [('a', repr(Optional[int]))])
+
+    def test_async_call_sites(self):
+        import asyncio
+        import sys
+
+        @typechecked
+        async def flob(a: T) -> T:
+            return a
+
+        @typechecked
+        def gen(n: int) -> Iterator[int]:
+            yield from range(n)
+
+        async def main():
+            await flob(1)
+            line = sys._getframe().f_lineno - 1
+            return line
+
+        set_profiling(True)
+        await_line = run_async(main())
+        for item in gen(2):
+            yield_line = sys._getframe().f_lineno - 1
+        entries = {e.argument: e for e in profile_report()}
+        self.assertEqual(set(entries), {'a', 'return', 'n', 'yield'})
+        self.assertEqual(entries['return'].lineno, await_line)
+        self.assertEqual(entries['return'].caller.split('.')[-1], 'main')
+        self.assertEqual(entries['return'].filename, __file__)
+        self.assertEqual(entries['yield'].lineno, yield_line)
+        self.assertEqual(entries['yield'].calls, 2)
+        self.assertEqual(entries['yield'].caller.split('.')[-1],
+                         'test_async_call_sites')
+
+    def test_kept_after_off(self):
+        set_profiling(True)
+        self.flub(1)
+        set_profiling(False)
+        self.flub(1)
+        self.assertEqual(sum(e.calls for e in profile_report()), 2)
+        set_profiling(True)
+        self.assertEqual(profile_report(), [])
+
+    def test_format(self):
+        set_profiling(True)
+        self.flub(1)
+        text = format_profile_report()
+        self.assertIn('flub(a: int)', text)
+        self.assertEqual(len(text.splitlines()), 3)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            set_profiling(True, capacity=0)
+
+
+class MemoryInfoTests(TestCase):
+
+    def test_kinds(self):
+        info = memory_info()
+        self.assertEqual(set(info), {'UnionMeta', 'TupleMeta', 'CallableMeta',
+                                     'GenericMeta', 'TypeVar'})
+        for kind in info.values():
+            self.assertGreater(kind.count, 0)
+            self.assertGreaterEqual(kind.size,
+                                    kind.namespace_size + kind.abc_cache_size)
+        self.assertGreater(info['GenericMeta'].abc_cache_size, 0)
+
+    def test_growth(self):
+        before = memory_info()
+        classes = [type('C%d' % i, (), {}) for i in range(10)]
+        types = [Tuple[c, int] for c in classes]
+        types += [Union[c, int] for c in classes]
+        types += [TypeVar('X', c) for c in classes]
+        after = memory_info()
+        for kind in ['TupleMeta', 'UnionMeta', 'TypeVar']:
+            self.assertEqual(after[kind].count, before[kind].count + 10)
+            self.assertGreater(after[kind].size, before[kind].size)
+        self.assertEqual(after['CallableMeta'], before['CallableMeta'])
+
+
+class EncodingTests(TestCase):
+
+    def round_trip(self, tp):
+        result = decode_type(encode_type(tp))
+        # Equal but for new type variables.
+        self.assertEqual(repr(decode_type_json(encode_type_json(tp))),
+                         repr(result))
+        return result
+
+    def test_round_trip(self):
+        for tp in [int, Any, Union, Tuple, Employee, T, AnyStr, type(None),
+                   Union[int, str, None], Optional[Tuple[int, Employee]],
+                   Tuple[()], Tuple[int, Union[str, bytes]],
+                   Callable[[int, str], None], List[int],
+                   Dict[str, List[Manager]], Mapping[KT, VT],
+                   Generic[T], SupportsClose]:
+            self.assertIs(self.round_trip(tp), tp)
+
+    def test_type_vars(self):
+        X = TypeVar('X', int, str)
+        tp = self.round_trip(Callable[[X, List[X]], X])
+        Y = tp.__result__
+        self.assertIsNot(Y, X)
+        self.assertEqual(Y.__name__, 'X')
+        self.assertEqual(Y.__constraints__, (int, str))
+        self.assertIs(tp.__args__[0], Y)
+        self.assertEqual(tp, Callable[[Y, List[Y]], Y])
+
+    def test_union_order(self):
+        u = Union[int, Employee, str]
+        data = encode_type(List[u])
+        cache_clear()
+        tp = decode_type(data)
+        self.assertEqual(tp.__parameters__[0].__union_params__,
+                         (int, Employee, str))
+        self.assertIs(Union[int, Employee, str], tp.__parameters__[0])
+
+    def test_cached_union_not_checked(self):
+        import typing
+        u = Union[int, Employee, str]
+        data = encode_type(u)
+        with mock.patch.object(typing, '_remove_subclasses',
+                               side_effect=AssertionError):
+            self.assertIs(decode_type(data), u)
+
+    def test_unnormalized_union(self):
+        cache_clear()
+        for bad in ['{"version": 1, "names": ["builtins:int", '
+                    '"builtins:bool"], "code": [4, 2, 0, 0, 0, 1]}',
+                    '{"version": 1, "names": ["builtins:int"], '
+                    '"code": [4, 2, 0, 0, 0, 0]}']:
+            with self.assertRaises(ValueError):
+                decode_type_json(bad)
+        self.assertIs(Union[int, bool], int)
+        self.assertIs(Union[bool, int], int)
+
+    def test_compact(self):
+        self.assertLess(len(encode_type(Tuple[int, int, int, int])), 30)
+
+    def test_cannot_encode(self):
+        class Local:
+            pass
+        with self.assertRaises(TypeError):
+            encode_type(Local)
+        with self.assertRaises(TypeError):
+            encode_type(Tuple[Local])
+        with self.assertRaises(TypeError):
+            encode_type(42)
+        with self.assertRaises(TypeError):
+            encode_type(ForwardRef('int'))
+
+    def test_malformed(self):
+        data = encode_type(Tuple[int, str])
+        for bad in [b'', b'XYZ' + data[3:], data[:3] + b'\x09' + data[4:],
+                    data[:-1], data + b'\x00', data[:4] + b'\x05',
+                    data[:-3] + b'\x7f\x00\x00']:
+            with self.assertRaises(ValueError):
+                decode_type(bad)
+        with self.assertRaises(ValueError):
+            decode_type(encode_type(int).replace(b'int', b'nix'))
+        for bad in ['[]', '{"version": 2, "names": [], "code": [1]}',
+                    '{"version": 1, "names": [], "code": ["1"]}',
+                    '{"version": 1, "names": [], "code": [4, 1, 1]}']:
+            with self.assertRaises(ValueError):
+                decode_type_json(bad)
+
+
+def check_in_worker(tp, value):
+    return isinstance(value, tp), tp
+
+
+# Module level, so that they can be pickled by name.
+X = TypeVar('X')
+Z = typevar('Z')
+
+
+class Node(Generic[X]):
+    pass
+
+
+class PickleTests(TestCase):
+
+    def test_round_trip(self):
+        import pickle
+        for tp in [Any, Union, Tuple, Callable, Optional, Generic, List, T,
+                   AnyStr, X, Z, Node, Employee, Union[int, Employee],
+                   Optional[Tuple[int]], Tuple[()], Tuple[int, str],
+                   Callable[[int, str], None], List[int],
+                   Dict[str, List[Manager]], Node[X], Node[int],
+                   Mapping[KT, VT], Generic[T], ForwardRef('Employee')]:
+            for proto in range(pickle.HIGHEST_PROTOCOL + 1):
+                self.assertIs(pickle.loads(pickle.dumps(tp, proto)), tp)
+
+    def test_recipe(self):
+        import pickle
+        u = Union[int, Employee]
+        data = pickle.dumps(u)
+        cache_clear()
+        # The result is interned again.
+        self.assertIs(pickle.loads(data), Union[int, Employee])
+
+    def test_not_picklable(self):
+        import pickle
+        Y = TypeVar('Y')
+        class C(Generic[Y]):
+            pass
+        for tp in [Y, C, C[int], Tuple[C]]:
+            # Local objects raise AttributeError on some versions.
+            with self.assertRaises((pickle.PicklingError, AttributeError)):
+                pickle.dumps(tp)
+        with self.assertRaises(TypeError):
+            pickle.dumps(ForwardRef('int', {}))
+
+    def test_process_pool(self):
+        import concurrent.futures
+        cases = [(Tuple[int, str], (1, 'a')),
+                 (Union[int, Employee], 'x'),
+                 (List[int], [1, 2]),
+                 (Dict[str, List[Manager]], {'a': [Manager()]}),
+                 (Callable[[int], None], len)]
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            results = list(pool.map(check_in_worker, *zip(*cases)))
+        for (tp, value), (result, returned) in zip(cases, results):
+            self.assertEqual(result, isinstance(value, tp))
+            self.assertIs(returned, tp)
+
+
+class ImportTests(TestCase):
+
+    def run_fresh(self, code):
+        import os
+        import subprocess
+        import sys
+        import typing
+        return subprocess.check_output(
+            [sys.executable, '-c', code % {'typing': typing.__name__}],
+            cwd=os.path.dirname(os.path.abspath(typing.__file__)),
+            universal_newlines=True)
+
+    def test_no_heavy_imports(self):
+        out = self.run_fresh('import sys, %(typing)s; '
+                             'print("inspect" in sys.modules)')
+        self.assertEqual(out.strip(), 'False')
+
+    @skipUnless(sys.version_info >= (3, 7), 'needs module __getattr__()')
+    def test_lazy_members(self):
+        out = self.run_fresh('import %(typing)s as t; '
+                             'print("AnyStr" in vars(t), repr(t.AnyStr), '
+                             '"AnyStr" in vars(t), "AnyStr" in dir(t))')
+        self.assertEqual(out.split(), ['False', '~AnyStr', 'True', 'True'])
+
+    def test_star_import(self):
+        out = self.run_fresh('from %(typing)s import *; '
+                             'print(repr(AnyStr), List.__name__, '
+                             'Iterator.__name__)')
+        self.assertEqual(out.split(), ['~AnyStr', 'List', 'Iterator'])
+
+    def test_all(self):
+        import types
+        import typing
+        public = {name for name in dir(typing) if not name.startswith('_')
+                  and not isinstance(getattr(typing, name), types.ModuleType)}
+        self.assertEqual(set(typing.__all__), public)
+
+    def test_missing_attribute(self):
+        import typing
+        with self.assertRaises(AttributeError):
+            typing.NoSuchThing
+
+    @skipUnless(sys.version_info >= (3, 7), 'lazy members need 3.7')
+    def test_import_time_budget(self):
+        from bench_typing import measure_import_time, IMPORT_TIME_BUDGET
+        self.assertLess(measure_import_time(), IMPORT_TIME_BUDGET)
@@ -6,20 +6,20 @@
 # [done] Tuple
 # [done] Callable
 # [done] Generic
-# Protocol (similar to Generic, but for structural matching)
-# All the collections ABCs (with Set renamed to AbstractSet):
-#   Hashable, Iterable, Iterator,
+# [done] Protocol (similar to Generic, but for structural matching)
+# [done] All the collections ABCs (with Set renamed to AbstractSet):
+#   Hashable, Iterable, Iterator, AsyncIterable, AsyncIterator,
 #   Sized, Container, *Abstract*Set, MutableSet, Mapping, MutableMapping,
 #   MappingView, KeysView, ItemsView, ValuesView,
 #   Sequence, MutableSequence
 #   ByteString
-# List, Dict, Set; FrozenSet?
+# [done] List, Dict, Set; FrozenSet
 # Other things from mypy's typing.py:
 # - [done] Undefined
 # - IO, BinaryIO, TextIO (?)
 # - Match, Pattern (?)
 # - [done] cast
-# - forwardref
+# - [done] forwardref (ForwardRef)
 # - overload
 # - [done] typevar (alias for TypeVar)
 # Even more things from mypy's typing.py (that aren't in its __all__)
@@ -29,11 +29,123 @@
 # Docstrings.
 # Make it pep8-clean.
 
+__all__ = [
+    # Special types and their metaclasses.
+    'Any', 'TypeVar', 'Union', 'Optional', 'Tuple', 'Callable', 'Generic',
+    'Protocol', 'ForwardRef', 'Final',
+    'TypingMeta', 'AnyMeta', 'UnionMeta', 'OptionalMeta', 'TupleMeta',
+    'CallableMeta', 'GenericMeta', 'ProtocolMeta', 'VarBinding',
+    # Predefined type variables.  AnyStr is built lazily, like the
+    # collection types below; star-imports build them all.
+    'T', 'KT', 'VT', 'AnyStr',
+    # Collection types.
+    'Hashable', 'Sized', 'Iterable', 'Iterator', 'AsyncIterable',
+    'AsyncIterator', 'Container', 'AbstractSet', 'MutableSet', 'Mapping',
+    'MutableMapping', 'MappingView', 'KeysView', 'ItemsView', 'ValuesView',
+    'Sequence', 'MutableSequence', 'ByteString', 'List', 'Dict', 'Set',
+    'FrozenSet',
+    # Helpers from mypy's typing.py.
+    'Undefined', 'cast', 'typevar',
+    # Checking values.
+    'compile_checker', 'check_many', 'iter_failures', 'checked_iter',
+    'validate_parallel', 'CheckResult',
+    'ElementCheck', 'Shallow', 'FirstK', 'RandomK', 'set_element_check',
+    'element_check', 'set_instance_memo',
+    'typechecked', 'set_sampling', 'Sampler', 'EveryNth',
+    'FirstThenEveryNth', 'TimeBudget',
+    # Encoding types.
+    'encode_type', 'decode_type', 'encode_type_json', 'decode_type_json',
+    # Monitoring.
+    'cache_info', 'cache_clear', 'CacheInfo', 'memory_info', 'MemoryInfo',
+    'set_instrumentation', 'instrumentation_snapshot',
+    'format_instrumentation', 'export_instrumentation',
+    'set_profiling', 'profile_report', 'format_profile_report',
+    'ProfileEntry',
+]
+
+# Imports are kept cheap; see the import time budget in
+# bench_typing.py.  Heavier modules (inspect) are imported where used.
+
+import _thread
 import abc
+import array
+import collections
 import collections.abc
-import inspect
+import copyreg
+import functools
+import gc
+import heapq
+import itertools
+import operator
 import sys
+import time
 import types
+import weakref
+
+try:
+    from contextvars import ContextVar as _ContextVar
+except ImportError:  # Python 3.6.
+
+    class _ContextVar:
+        """Thread-local stand-in for contextvars.ContextVar.
+
+        Without contextvars, state "local to the context" is local to
+        the thread, so e.g. asyncio tasks of one thread share it.
+        """
+
+        _missing = object()
+
+        def __init__(self, name, *, default):
+            self.name = name
+            self._default = default
+            self._local = _thread._local()
+
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+
+        def set(self, value):
+            token = getattr(self._local, 'value', self._missing)
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            if token is self._missing:
+                del self._local.value
+            else:
+                self._local.value = token
+
+
+# Module attributes that are only built when first accessed, by name.
+# See __getattr__() below and _lazy().
+_lazy_members = {}
+_lazy_lock = _thread.RLock()
+
+
+def _lazy(func):
+    """Decorator registering func to build the module attribute
+    func.__name__ (without leading underscores) on first access.
+    """
+    _lazy_members[func.__name__.lstrip('_')] = func
+    return func
+
+
+def __getattr__(name):
+    # Only called for names not (yet) in the module's globals.
+    with _lazy_lock:
+        if name in globals():
+            return globals()[name]  # Built by another thread.
+        try:
+            factory = _lazy_members[name]
+        except KeyError:
+            raise AttributeError("module %r has no attribute %r" %
+                                 (__name__, name)) from None
+        value = globals()[name] = factory()
+        del _lazy_members[name]
+        return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_members))
 
 
 class TypingMeta(type):
@@ -53,7 +165,15 @@ class TypingMeta(type):
         if not _root:
             raise TypeError("Cannot subclass %s" %
                             (', '.join(map(_type_repr, bases)) or '()'))
-        return super().__new__(cls, name, bases, namespace)
+        # type.__new__() makes a private C copy of the docstring, once
+        # per class; for parameterized types, which reuse the namespace
+        # of the type being subscripted, that is often the largest part
+        # of the class.  Setting it afterwards shares the string.
+        doc = namespace.pop('__doc__', None)
+        self = super().__new__(cls, name, bases, namespace)
+        if doc is not None:
+            type.__setattr__(self, '__doc__', doc)
+        return self
 
     def __init__(self, *args, **kwds):
         pass
@@ -61,6 +181,11 @@ class TypingMeta(type):
     def __repr__(self):
         return '%s.%s' % (self.__module__, self.__qualname__)
 
+    def __reduce__(self):
+        # Pickle by name, like other classes.  Subclasses override this
+        # for types made by subscription; see also _pickle_by_recipe().
+        return self.__qualname__
+
 
 class Final:
     """Mix-in class to prevent instantiation."""
@@ -103,6 +228,235 @@ def _type_repr(obj):
         return repr(obj)
 
 
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+# All caches created below, by name; see cache_info() and cache_clear().
+_caches = {}
+
+
+class _KeyRef(weakref.ref):
+    """Weak reference to a key object of a _TypeCache entry.
+
+    It carries the entry's key itself, so that a single callback (the
+    bound append() of the cache's list of pending removals) serves all
+    entries, instead of a closure per entry.
+    """
+
+    __slots__ = ['key']
+
+
+class _TypeCache:
+    """Bounded, thread-safe LRU cache of typing objects.
+
+    Keys are tuples of objects (usually types) compared by identity,
+    so e.g. two distinct but equal unions never share an entry.  The
+    key objects are only held through weak references; an entry whose
+    key objects have died is dropped.  At most maxsize values are
+    kept, the least recently used one is evicted first.
+
+    Each entry is a single tuple holding the weak references followed
+    by the value; the cache is meant to hold many small entries, so
+    they are kept as compact as possible.
+
+    Values that refer to their key objects (e.g. Tuple[C] refers to C)
+    would keep them alive if they were held strongly.  With
+    weak_values=True, entries instead hold a weak reference to the
+    value.  The values used since the last full garbage collection are
+    also held strongly, so that unreferenced values survive between
+    uses, but only until the start of the next full collection.
+    """
+
+    def __init__(self, name, maxsize, weak_values=False):
+        self.name = name
+        self.maxsize = maxsize
+        self.weak_values = weak_values
+        # The values held strongly, by key, if weak_values is set.
+        # Outside of the lock, it is only ever replaced, not mutated;
+        # see _release_values().
+        self._recent = {}
+        self._data = collections.OrderedDict()
+        self._lock = _thread.allocate_lock()
+        # Weakref callbacks may run at any point (e.g. in the middle
+        # of a lookup, from the garbage collector), so they only
+        # record the dead reference here; its entry is removed under
+        # the lock.
+        self._pending_removals = []
+        self._remove = self._pending_removals.append
+        self.hits = self.misses = self.evictions = 0
+        _caches[name] = self
+
+    def _purge(self):
+        while self._pending_removals:
+            ref = self._pending_removals.pop()
+            entry = self._data.get(ref.key)
+            if entry is not None and any(r is ref for r in entry[:-1]):
+                del self._data[ref.key]
+
+    def get(self, objs, default=None):
+        """Return the value stored for the tuple objs, or default."""
+        key = tuple(map(id, objs))
+        with self._lock:
+            if self._pending_removals:
+                self._purge()
+            entry = self._data.get(key)
+            if entry is not None:
+                # A dead reference means the id has been reused.
+                for r in entry[:-1]:
+                    if r() is None:
+                        break
+                else:
+                    value = entry[-1]
+                    if self.weak_values:
+                        value = value()
+                        if value is None:
+                            self.misses += 1
+                            return default
+                        self._recent[key] = value
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def add(self, objs, value):
+        """Store value for the tuple objs and return the cached value.
+
+        If another thread stored a value for the same key in the
+        meantime, that value is kept and returned instead, so that
+        all callers agree on a single canonical object.
+        """
+        key = tuple(map(id, objs))
+        with self._lock:
+            if self._pending_removals:
+                self._purge()
+            entry = self._data.get(key)
+            if entry is not None and all(r() is not None
+                                         for r in entry[:-1]):
+                existing = entry[-1]
+                if self.weak_values:
+                    existing = existing()
+                    if existing is not None:
+                        self._recent[key] = existing
+                if existing is not None:
+                    self._data.move_to_end(key)
+                    return existing
+            entry = []
+            for o in objs:
+                ref = _KeyRef(o, self._remove)
+                ref.key = key
+                entry.append(ref)
+            if self.weak_values:
+                entry.append(weakref.ref(value))
+                self._recent[key] = value
+            else:
+                entry.append(value)
+            self._data[key] = tuple(entry)
+            if len(self._data) > self.maxsize:
+                old_key, _ = self._data.popitem(last=False)
+                self._recent.pop(old_key, None)
+                self.evictions += 1
+            return value
+
+    def _release_values(self):
+        """Stop holding the values strongly, if weak_values is set.
+
+        This is called by the garbage collector, possibly while this
+        thread holds the lock, so it can't take the lock; it replaces
+        the dict of strong references instead of clearing it.
+        """
+        self._recent = {}
+
+    def invalidate(self, obj):
+        """Drop every entry whose key contains obj."""
+        with self._lock:
+            for key, entry in list(self._data.items()):
+                if any(r() is obj for r in entry[:-1]):
+                    del self._data[key]
+                    self._recent.pop(key, None)
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._data))
+
+    def clear(self, stats=True):
+        """Drop all entries, and reset the statistics unless told not to."""
+        with self._lock:
+            self._data.clear()
+            self._recent = {}
+            del self._pending_removals[:]
+            if stats:
+                self.hits = self.misses = self.evictions = 0
+
+
+def _release_cache_values(phase, info):
+    """Garbage collector callback letting cached values be collected.
+
+    At the start of each full collection, the values of the caches
+    with weak_values are only held weakly, so that they and the key
+    objects they refer to can be collected.  Values that are still in
+    use elsewhere stay cached.
+    """
+    if phase == 'start' and info['generation'] == 2:
+        for cache in list(_caches.values()):
+            if isinstance(cache, _TypeCache) and cache.weak_values:
+                cache._release_values()
+
+
+gc.callbacks.append(_release_cache_values)
+
+
+# Results of the __subclasscheck__() methods of typing metaclasses, and
+# the abc cache token they were computed with.
+_subclass_memo = _TypeCache('subclass', maxsize=4096)
+_subclass_memo_token = abc.get_cache_token()
+
+
+def _memoize_subclasscheck(func):
+    """Decorator memoizing a metaclass __subclasscheck__() method.
+
+    The memo is dropped whenever a class is registered with an ABC,
+    since that can change the answers.  Type variable bindings can
+    change them too, so the memo is bypassed in any context where a
+    type variable is bound; results stored outside of such contexts
+    don't depend on bindings.
+    """
+
+    @functools.wraps(func)
+    def __subclasscheck__(self, cls):
+        global _subclass_memo_token
+        if _type_var_bindings.get() or not isinstance(cls, type):
+            return func(self, cls)
+        token = abc.get_cache_token()
+        if token != _subclass_memo_token:
+            _subclass_memo.clear(stats=False)
+            _subclass_memo_token = token
+        result = _subclass_memo.get((self, cls))
+        if result is None:
+            result = _subclass_memo.add((self, cls), func(self, cls))
+        return result
+
+    return __subclasscheck__
+
+
+def cache_info():
+    """Return a dict mapping cache names to CacheInfo tuples.
+
+    The caches are internal to this module; this is meant for
+    monitoring and tuning.  Each CacheInfo reports the number of
+    hits, misses and evictions since the last cache_clear(), the
+    maximum size and the current size.
+    """
+    return {name: cache.info() for name, cache in _caches.items()}
+
+
+def cache_clear():
+    """Empty all caches and reset their statistics."""
+    for cache in _caches.values():
+        cache.clear()
+
+
 class AnyMeta(TypingMeta):
     """Metaclass for Any."""
 
@@ -184,32 +538,53 @@ class TypeVar(TypingMeta, metaclass=TypingMeta, _root=True):
           assert not isinstance(b'', AnyStr)
           assert not issubclass(bytes, AnyStr)
 
+    Bindings are local to the current thread and asyncio Task (they
+    are stored in a context variable), so concurrent code can bind the
+    same type variable to different types.  The current binding, or
+    None, is available as T.__binding__.
     """
 
     def __new__(cls, name, *constraints):
-        self = super().__new__(cls, name, (Final,), {}, _root=True)
+        # Like a class, a type variable belongs to the module defining
+        # it, so that it can be pickled by name.
+        namespace = {'__module__': sys._getframe(1).f_globals.get('__name__')}
+        self = super().__new__(cls, name, (Final,), namespace, _root=True)
         msg = "TypeVar(name, constraint, ...): constraints must be types."
         self.__constraints__ = tuple(_type_check(t, msg) for t in constraints)
-        self.__binding__ = None
+        # An item for each binding active in any context.  While this
+        # is empty, there is no need to look at the context variable.
+        # Appending and popping are atomic, so this needs no lock.
+        self._active_bindings = []
         return self
 
     def __repr__(self):
         return '~' + self.__name__
 
+    @property
+    def __binding__(self):
+        if not self._active_bindings:
+            return None
+        return _type_var_bindings.get().get(self)
+
     def __instancecheck__(self, instance):
-        if self.__binding__ is not None:
-            return isinstance(instance, self.__binding__)
-        elif not self.__constraints__:
+        if self._active_bindings:
+            binding = _type_var_bindings.get().get(self)
+            if binding is not None:
+                return isinstance(instance, binding)
+        if not self.__constraints__:
             return False
         else:
             return isinstance(instance, Union[self.__constraints__])
 
+    @_memoize_subclasscheck
     def __subclasscheck__(self, cls):
         if cls is self:
             return True
-        elif self.__binding__ is not None:
-            return issubclass(cls, self.__binding__)
-        elif not self.__constraints__:
+        if self._active_bindings:
+            binding = _type_var_bindings.get().get(self)
+            if binding is not None:
+                return issubclass(cls, binding)
+        if not self.__constraints__:
             return False
         else:
             return issubclass(cls, Union[self.__constraints__])
@@ -217,47 +592,61 @@ class TypeVar(TypingMeta, metaclass=TypingMeta, _root=True):
     def bind(self, binding):
         binding = _type_check(binding, "TypeVar.bind(t): t must be a type.")
         if self.__constraints__:
-            best = None
-            for t in self.__constraints__:
-                if (issubclass(binding, t) and
-                    (best is None or issubclass(t, best))):
-                    best = t
-            if best is None:
-                raise TypeError(
-                    "TypeVar.bind(t): t must match one of the constraints.")
-            binding = best
+            binding = self._constraint_for(binding)
         return VarBinding(self, binding)
 
+    def _constraint_for(self, binding):
+        """Return the most specific constraint binding is a subclass of."""
+        best = None
+        for t in self.__constraints__:
+            if (issubclass(binding, t) and
+                (best is None or issubclass(t, best))):
+                best = t
+        if best is None:
+            raise TypeError(
+                "TypeVar.bind(t): t must match one of the constraints.")
+        return best
+
     def _bind(self, binding):
-        old_binding = self.__binding__
-        self.__binding__ = binding
-        return old_binding
+        bindings = _type_var_bindings.get()
+        if bindings:
+            bindings = dict(bindings)
+            bindings[self] = binding
+        else:
+            bindings = {self: binding}
+        self._active_bindings.append(None)
+        return _type_var_bindings.set(bindings)
+
+    def _unbind(self, token):
+        _type_var_bindings.reset(token)
+        self._active_bindings.pop()
 
-    def _unbind(self, binding, old_binding):
-        assert self.__binding__ is binding, (self.__binding__,
-                                             binding, old_binding)
-        self.__binding__ = old_binding
+
+# The bindings of the current context, as a dict mapping type
+# variables to types.  The dicts are never modified, only replaced.
+_type_var_bindings = _ContextVar('_type_var_bindings', default={})
 
 
 # Compatibility for for mypy's typevar().
 def typevar(name, values=()):
-    return TypeVar(name, *values)
+    var = TypeVar(name, *values)
+    var.__module__ = sys._getframe(1).f_globals.get('__name__')
+    return var
 
 
 class VarBinding:
-    """TypeVariable binding returned by TypeVar.bind()."""
+    """TypeVariable binding returned by TypeVar.bind().
 
-    # TODO: This is not thread-safe.  We could solve this in one of
-    # two ways: by using a lock or by using thread-local state.  But
-    # either of these feels overly heavy, and still doesn't work
-    # e.g. in an asyncio Task.
+    Entering it binds the variable in the current context only (see
+    TypeVar); it must be exited in the same context.
+    """
 
     def __init__(self, var, binding):
         assert isinstance(var, TypeVar), (var, binding)
         assert isinstance(binding, type), (var, binding)
         self._var = var
         self._binding = binding
-        self._old_binding = None
+        self._token = None
         self._entered = False
 
     def __enter__(self):
@@ -278,15 +667,93 @@ class VarBinding:
             #     with T.bind(<some_other_type>):
             #         ...
             raise TypeError("Cannot reuse variable binding recursively.")
-        self._old_binding = self._var._bind(self._binding)
+        self._token = self._var._bind(self._binding)
         self._entered = True
+        return self
 
     def __exit__(self, *args):
         try:
-            self._var._unbind(self._binding, self._old_binding)
+            assert self._var.__binding__ is self._binding, (
+                self._var.__binding__, self._binding)
+            self._var._unbind(self._token)
         finally:
             self._entered = False
-            self._old_binding = None
+            self._token = None
+
+
+class ForwardRef(TypingMeta, metaclass=TypingMeta, _root=True):
+    """Forward reference to a type, given as a string.
+
+    Usage::
+
+      class Node:
+          def add_left(self, node: Optional[ForwardRef('Node')]):
+              ...
+
+    The string is evaluated in the globals of the module creating the
+    reference (or in the given globals dict), but only when it is
+    first needed: by isinstance(x, ref), issubclass(cls, ref) or
+    ref.__forward_value__.  The resulting type is remembered, so
+    later checks cost about as much as checking the type itself.
+
+    References with the same string and module are the same object.
+    """
+
+    def __new__(cls, arg, globals=None):
+        if not isinstance(arg, str):
+            raise TypeError("ForwardRef(arg): arg must be a string." +
+                            " Got %.100r." % (arg,))
+        if globals is None:
+            globals = sys._getframe(1).f_globals
+        key = (arg, globals.get('__name__'), id(globals))
+        self = _forward_refs.get(key)
+        if self is not None and self.__forward_globals__ is globals:
+            return self
+        self = super().__new__(cls, 'ForwardRef', (Final,), {}, _root=True)
+        self.__forward_arg__ = arg
+        self.__forward_globals__ = globals
+        self._value = None
+        _forward_refs[key] = self
+        return self
+
+    def __repr__(self):
+        return 'ForwardRef(%r)' % (self.__forward_arg__,)
+
+    def __reduce__(self):
+        module = self.__forward_globals__.get('__name__')
+        if getattr(sys.modules.get(module), '__dict__',
+                   None) is not self.__forward_globals__:
+            raise TypeError("Cannot pickle %r: its globals aren't those of "
+                            "a module" % (self,))
+        return _forward_ref_in, (self.__forward_arg__, module)
+
+    @property
+    def __forward_value__(self):
+        """The referenced type, evaluated on first use."""
+        value = self._value
+        if value is None:
+            value = eval(self.__forward_arg__, self.__forward_globals__)
+            msg = ("ForwardRef(%r): the reference must evaluate to a type." %
+                   (self.__forward_arg__,))
+            value = self._value = _type_check(value, msg)
+        return value
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self.__forward_value__)
+
+    def __subclasscheck__(self, cls):
+        if cls is self:
+            return True
+        return issubclass(cls, self.__forward_value__)
+
+
+_forward_refs = weakref.WeakValueDictionary()
+
+
+def _forward_ref_in(arg, module):
+    """Unpickle ForwardRef(arg) made in the module named module."""
+    __import__(module)
+    return ForwardRef(arg, vars(sys.modules[module]))
 
 
 # Some unconstrained type variables.  These are used by the container types.
@@ -296,7 +763,46 @@ VT = TypeVar('VT')  # Value type.
 
 # A useful type variable with constraints.  This represents string types.
 # TODO: What about bytearray, memoryview?
-AnyStr = TypeVar('AnyStr', bytes, str)
+@_lazy
+def _AnyStr():
+    return TypeVar('AnyStr', bytes, str)
+
+
+def _remove_subclasses(params):
+    """Return the params that aren't a subclass of another one.
+
+    The params must be distinct types.  They are considered in order
+    and each one is dropped if it is a subclass of some other param
+    that hasn't been dropped yet; so if two params are subclasses of
+    each other, the first one is dropped.  As a special case, if Any
+    is reached, (Any,) is returned.
+
+    Most classes have a metaclass that doesn't override
+    __subclasscheck__(), so that issubclass(t1, t2) is true exactly if
+    t2 is in t1.__mro__.  Such t2 are found by looking up t1's MRO in
+    a set, which is linear in the number of params for common
+    hierarchies.  Only the remaining ("special") params, such as ABCs
+    and typing types, are checked with issubclass().
+
+    Forward references are never treated as superclasses, since that
+    would force their evaluation.
+    """
+    alive = set(map(id, params))
+    special = []
+    for t in params:
+        if type(t).__subclasscheck__ is not type.__subclasscheck__:
+            special.append(t)
+    nominal_alive = alive - set(map(id, special))
+    special = [t for t in special if not isinstance(t, ForwardRef)]
+    for t1 in params:
+        if t1 is Any:
+            return (Any,)
+        if (any(id(t2) in nominal_alive for t2 in t1.__mro__[1:]) or
+                any(t2 is not t1 and id(t2) in alive and issubclass(t1, t2)
+                    for t2 in special)):
+            alive.remove(id(t1))
+            nominal_alive.discard(id(t1))
+    return tuple(t for t in params if id(t) in alive)
 
 
 class UnionMeta(TypingMeta):
@@ -329,20 +835,36 @@ class UnionMeta(TypingMeta):
         # E.g. Union[int, Employee, Manager] == Union[int, Employee].
         # If Any or object is present it will be the sole survivor.
         # If both Any and object are present, Any wins.
-        all_params = set(params)
-        for t1 in params:
-            if t1 is Any:
-                return Any
-            if any(issubclass(t1, t2) for t2 in all_params - {t1}):
-                all_params.remove(t1)
+        params = _remove_subclasses(params)
         # It's not a union if there's only one type left.
-        if len(all_params) == 1:
-            return all_params.pop()
+        if len(params) == 1:
+            return params[0]
+        return cls._intern(name, bases, namespace, params)
+
+    @classmethod
+    def _intern(cls, name, bases, namespace, params):
+        """Return the union of params, which must be normalized.
+
+        Different spellings of a union (e.g. Union[int, str, int] and
+        Union[int, str]) share a single class.  Normalized params are
+        also valid raw params, so the key space is shared with
+        __getitem__().  While a type variable is bound, params may
+        have been normalized using the binding, so the cache isn't
+        used at all.
+        """
+        bound = _type_var_bindings.get()
+        if not bound:
+            _check_union_cache_token()
+            self = _union_cache.get(params)
+            if self is not None:
+                return self
         # Create a new class with these params.
-        self = super().__new__(cls, name, bases, namespace, _root=True)
-        self.__union_params__ = tuple(t for t in params if t in all_params)
-        self.__union_set_params__ = frozenset(self.__union_params__)
-        return self
+        self = TypingMeta.__new__(cls, name, bases, namespace, _root=True)
+        self.__union_params__ = params
+        self.__union_set_params__ = frozenset(params)
+        if bound:
+            return self
+        return _union_cache.add(params, self)
 
     def __repr__(self):
         r = super().__repr__()
@@ -351,6 +873,11 @@ class UnionMeta(TypingMeta):
                                      for t in self.__union_params__))
         return r
 
+    def __reduce__(self):
+        if self.__union_params__ is None:
+            return super().__reduce__()
+        return operator.getitem, (Union, self.__union_params__)
+
     def __getitem__(self, parameters):
         if self.__union_params__ is not None:
             raise TypeError(
@@ -359,8 +886,21 @@ class UnionMeta(TypingMeta):
             raise TypeError("Cannot take a Union of no types.")
         if not isinstance(parameters, tuple):
             parameters = (parameters,)
-        return self.__class__(self.__name__, self.__bases__,
-                              dict(self.__dict__), parameters, _root=True)
+        parameters = tuple(type(None) if p is None else p
+                           for p in parameters)
+        if (not all(isinstance(p, type) for p in parameters) or
+                _type_var_bindings.get()):
+            # Let the constructor report the error, or normalize the
+            # parameters under the current bindings without caching.
+            return self.__class__(self.__name__, self.__bases__,
+                                  dict(self.__dict__), parameters, _root=True)
+        _check_union_cache_token()
+        union = _union_cache.get(parameters)
+        if union is None:
+            union = self.__class__(self.__name__, self.__bases__,
+                                   dict(self.__dict__), parameters, _root=True)
+            union = _union_cache.add(parameters, union)
+        return union
 
     def __eq__(self, other):
         if not isinstance(other, UnionMeta):
@@ -373,6 +913,7 @@ class UnionMeta(TypingMeta):
     def __instancecheck__(self, instance):
         return any(isinstance(instance, t) for t in self.__union_params__)
 
+    @_memoize_subclasscheck
     def __subclasscheck__(self, cls):
         if self.__union_params__ is None:
             return isinstance(cls, UnionMeta)
@@ -390,6 +931,25 @@ class UnionMeta(TypingMeta):
             return any(issubclass(cls, t) for t in self.__union_params__)
 
 
+# Interned Union[...] results, keyed by raw and by normalized parameters,
+# and the abc cache token they were normalized with.
+_union_cache = _TypeCache('union', maxsize=1024, weak_values=True)
+_union_cache_token = abc.get_cache_token()
+
+
+def _check_union_cache_token():
+    """Drop the interned unions if a class was registered with an ABC.
+
+    Registering can make a union member a subclass of another one, so
+    the union would be normalized differently.
+    """
+    global _union_cache_token
+    token = abc.get_cache_token()
+    if token != _union_cache_token:
+        _union_cache.clear(stats=False)
+        _union_cache_token = token
+
+
 class Union(Final, metaclass=UnionMeta, _root=True):
     """Union type; Union[X, Y] means either X or Y.
 
@@ -440,6 +1000,12 @@ class Union(Final, metaclass=UnionMeta, _root=True):
     - You cannot write Union[X][Y] (what would it mean?).
 
     - You can use Optional[X] as a shorthand for Union[X, None].
+
+    - Unions are interned: repeating a subscription returns the same
+      class object, e.g.::
+
+        Union[int, str] is Union[int, str]
+        Union[int, str, int] is Union[int, str]
     """
 
     # Unsubscripted Union type has params set to None.
@@ -472,6 +1038,7 @@ class TupleMeta(TypingMeta):
     def __new__(cls, name, bases, namespace, parameters=None, _root=False):
         self = super().__new__(cls, name, bases, namespace, _root=_root)
         self.__tuple_params__ = parameters
+        self.__memo_safe__ = None  # Computed when needed.
         return self
 
     def __repr__(self):
@@ -481,6 +1048,11 @@ class TupleMeta(TypingMeta):
                 ', '.join(_type_repr(p) for p in self.__tuple_params__))
         return r
 
+    def __reduce__(self):
+        if self.__tuple_params__ is None:
+            return super().__reduce__()
+        return operator.getitem, (Tuple, self.__tuple_params__)
+
     def __getitem__(self, parameters):
         if self.__tuple_params__ is not None:
             raise TypeError("Cannot re-parameterize %r" % (self,))
@@ -488,10 +1060,20 @@ class TupleMeta(TypingMeta):
             parameters = (parameters,)
         msg = "Class[arg, ...]: each arg must be a type."
         parameters = tuple(_type_check(p, msg) for p in parameters)
-        return self.__class__(self.__name__, self.__bases__,
-                              dict(self.__dict__), parameters, _root=True)
+        key = (self,) + parameters
+        tp = _param_cache.get(key)
+        if tp is None:
+            tp = self.__class__(self.__name__, self.__bases__,
+                                dict(self.__dict__), parameters, _root=True)
+            tp = _param_cache.add(key, tp)
+        return tp
 
     def __instancecheck__(self, t):
+        if _instance_memo.maxsize and self.__tuple_params__ is not None:
+            return _instance_memo.check(t, self)
+        return self._check_instance(t)
+
+    def _check_instance(self, t):
         if not isinstance(t, tuple):
             return False
         if self.__tuple_params__ is None:
@@ -500,6 +1082,7 @@ class TupleMeta(TypingMeta):
                 all(isinstance(x, p)
                     for x, p in zip(t, self.__tuple_params__)))
 
+    @_memoize_subclasscheck
     def __subclasscheck__(self, cls):
         if not isinstance(cls, type):
             return super().__subclasscheck__(cls)  # To TypeError.
@@ -518,6 +1101,12 @@ class TupleMeta(TypingMeta):
                                     self.__tuple_params__)))
 
 
+# Shared cache of Tuple[...], Callable[...] and Generic[...] results.
+# The first key item is the class being subscripted.
+_param_cache = _TypeCache('parameterization', maxsize=1024,
+                          weak_values=True)
+
+
 class Tuple(Final, metaclass=TupleMeta, _root=True):
     """Tuple type; Tuple[X, Y] is the cross-product type of X and Y.
 
@@ -529,6 +1118,111 @@ class Tuple(Final, metaclass=TupleMeta, _root=True):
     """
 
 
+# Marker for a missing annotation in a _SignatureSummary.
+_empty = object()
+
+_SignatureSummary = collections.namedtuple(
+    '_SignatureSummary',
+    ['min_args', 'max_args', 'kwonly_required',
+     'arg_types', 'vararg_type', 'return_type'])
+_SignatureSummary.__doc__ = """What Callable[...] instance checks need to know.
+
+min_args and max_args bound the number of positional arguments
+(including self/cls for methods).  kwonly_required is true if some
+keyword-only argument has no default.  arg_types holds the annotation
+of each positional argument and vararg_type that of *args (Any if not
+annotated); return_type is the return annotation or _empty.  The
+annotations are stored as found; the checker insists they are types
+only when it uses them.
+"""
+
+
+def _summarize(args, varargs, ndefaults, kwonly_required, annotations):
+    """Build a _SignatureSummary from getfullargspec()-style data."""
+    arg_types = tuple(annotations.get(name, Any) for name in args)
+    if varargs:
+        max_args = sys.maxsize
+        vararg_type = annotations.get(varargs, Any)
+    else:
+        max_args = len(args)
+        vararg_type = None
+    return _SignatureSummary(len(args) - ndefaults, max_args,
+                             kwonly_required, arg_types, vararg_type,
+                             annotations.get('return', _empty))
+
+
+def _summarize_argspec(func):
+    import inspect
+    try:
+        (args, varargs, varkw, defaults, kwonlyargs, kwonlydefaults,
+         annotations) = inspect.getfullargspec(func)
+    except TypeError:
+        return None
+    kwonly_required = bool(kwonlyargs) and (
+        not kwonlydefaults or len(kwonlydefaults) < len(kwonlyargs))
+    return _summarize(args, varargs, len(defaults or ()), kwonly_required,
+                      annotations)
+
+
+def _summarize_text_signature(func):
+    import inspect
+    # Builtins aren't weakly referenceable, but all builtins sharing a
+    # __text_signature__ (and boundness) have the same summary.
+    key = (func.__text_signature__,
+           getattr(func, '__self__', None) is not None)
+    sig = _text_signature_cache.get(key)
+    if sig is None:
+        try:
+            parameters = inspect.signature(func).parameters.values()
+        except (TypeError, ValueError):
+            return None
+        P = inspect.Parameter
+        args = []
+        varargs = None
+        ndefaults = 0
+        kwonly_required = False
+        annotations = {}
+        for p in parameters:
+            if p.kind in (P.POSITIONAL_ONLY, P.POSITIONAL_OR_KEYWORD):
+                args.append(p.name)
+                if p.default is not P.empty:
+                    ndefaults += 1
+            elif p.kind == P.VAR_POSITIONAL:
+                varargs = p.name
+            elif p.kind == P.KEYWORD_ONLY and p.default is P.empty:
+                kwonly_required = True
+            if p.annotation is not P.empty:
+                annotations[p.name] = p.annotation
+        sig = _summarize(args, varargs, ndefaults, kwonly_required,
+                         annotations)
+        _text_signature_cache[key] = sig
+    return sig
+
+
+def _signature_summary(func):
+    """Return a _SignatureSummary for a callable, or None if unknown.
+
+    Summaries of Python functions are cached per function object
+    (weakly, like all _TypeCache keys); a function's annotations and
+    defaults are assumed not to change once it has been checked.
+    Builtins use their __text_signature__, which getfullargspec()
+    cannot always handle (e.g. it doesn't drop self for bound builtin
+    methods).  Other callables are inspected every time.
+    """
+    if isinstance(func, types.FunctionType):
+        sig = _signature_cache.get((func,))
+        if sig is None:
+            sig = _signature_cache.add((func,), _summarize_argspec(func))
+        return sig
+    if getattr(func, '__text_signature__', None):
+        return _summarize_text_signature(func)
+    return _summarize_argspec(func)
+
+
+_signature_cache = _TypeCache('signature', maxsize=1024)
+_text_signature_cache = {}
+
+
 class CallableMeta(TypingMeta):
     """Metaclass for Callable."""
 
@@ -538,8 +1232,8 @@ class CallableMeta(TypingMeta):
             pass  # Must be 'class Callable'.
         else:
             if not isinstance(args, list):
-                TypeError("Callable[args, result]: args must be a list." +
-                          " Got %.100r." % (args,))
+                raise TypeError("Callable[args, result]: args must be a "
+                                "list. Got %.100r." % (args,))
             msg = "Callable[[arg, ...], result]: each arg must be a type."
             args = tuple(_type_check(arg, msg) for arg in args)
             msg = "Callable[args, result]: result must be a type."
@@ -558,6 +1252,12 @@ class CallableMeta(TypingMeta):
                                    _type_repr(self.__result__))
         return r
 
+    def __reduce__(self):
+        if self.__args__ is None and self.__result__ is None:
+            return super().__reduce__()
+        return operator.getitem, (Callable, (list(self.__args__),
+                                             self.__result__))
+
     def __getitem__(self, parameters):
         if self.__args__ is not None or self.__result__ is not None:
             raise TypeError("This Callable type is already parameterized.")
@@ -565,9 +1265,23 @@ class CallableMeta(TypingMeta):
             raise TypeError(
                 "Callable must be used as Callable[[arg, ...], result].")
         args, result = parameters
-        return self.__class__(self.__name__, self.__bases__,
-                              dict(self.__dict__), _root=True,
-                              args=args, result=result)
+        if not isinstance(args, list):
+            raise TypeError("Callable[args, result]: args must be a list." +
+                            " Got %.100r." % (args,))
+        key = tuple(type(None) if t is None else t
+                    for t in [self, result] + args)
+        if not all(isinstance(t, type) for t in key):
+            # Let the constructor report the error.
+            return self.__class__(self.__name__, self.__bases__,
+                                  dict(self.__dict__), _root=True,
+                                  args=args, result=result)
+        tp = _param_cache.get(key)
+        if tp is None:
+            tp = self.__class__(self.__name__, self.__bases__,
+                                dict(self.__dict__), _root=True,
+                                args=args, result=result)
+            tp = _param_cache.add(key, tp)
+        return tp
 
     def __eq__(self, other):
         if not isinstance(other, CallableMeta):
@@ -586,48 +1300,45 @@ class CallableMeta(TypingMeta):
         assert self.__args__ is not None
         assert self.__result__ is not None
         my_args, my_result = self.__args__, self.__result__
-        # Would it be better to use Signature objects?
-        try:
-            (args, varargs, varkw, defaults, kwonlyargs, kwonlydefaults,
-             annotations) = inspect.getfullargspec(instance)
-        except TypeError:
-            return False  # We can't find the signature.  Give up.
-        if kwonlyargs and (not kwonlydefaults or
-                           len(kwonlydefaults) < len(kwonlyargs)):
-            return False
         if isinstance(instance, types.MethodType):
-            # For methods, getfullargspec() includes self/cls,
-            # but it's not part of the call signature, so drop it.
-            del args[0]
-        min_call_args = len(args)
-        if defaults:
-            min_call_args -= len(defaults)
-        if varargs:
-            max_call_args = 999999999
-            if len(args) < len(my_args):
-                args += [varargs] * (len(my_args) - len(args))
+            # The signature includes self/cls, but it's not part of
+            # the call signature, so skip it.
+            offset = 1
+            sig = _signature_summary(instance.__func__)
         else:
-            max_call_args = len(args)
-        if not min_call_args <= len(my_args) <= max_call_args:
+            offset = 0
+            sig = _signature_summary(instance)
+        if sig is None:
+            return False  # We can't find the signature.  Give up.
+        if sig.kwonly_required:
+            return False
+        if not (sig.min_args - offset <= len(my_args) <=
+                sig.max_args - offset):
             return False
         msg = ("When testing isinstance(<callable>, Callable[...], " +
-               "<calleble>'s annotations must be types.")
-        for my_arg_type, name in zip(my_args, args):
-            if name in annotations:
-                annot_type = _type_check(annotations[name], msg)
+               "<callable>'s annotations must be types.")
+        arg_types = sig.arg_types
+        for i, my_arg_type in enumerate(my_args, offset):
+            if i < len(arg_types):
+                annot_type = arg_types[i]
             else:
-                annot_type = Any
+                annot_type = sig.vararg_type
+            if not isinstance(annot_type, type):
+                annot_type = _type_check(annot_type, msg)
             if not issubclass(my_arg_type, annot_type):
                 return False
             # TODO: If mutable type, check invariance?
-        if 'return' in annotations:
-            annot_return_type = _type_check(annotations['return'], msg)
+        annot_return_type = sig.return_type
+        if annot_return_type is not _empty:
+            if not isinstance(annot_return_type, type):
+                annot_return_type = _type_check(annot_return_type, msg)
             # Note contravariance here!
             if not issubclass(annot_return_type, my_result):
                 return False
         # Can't find anything wrong...
         return True
 
+    @_memoize_subclasscheck
     def __subclasscheck__(self, cls):
         # Compute issubclass(cls, self).
         if not isinstance(cls, CallableMeta):
@@ -650,6 +1361,64 @@ class Callable(Final, metaclass=CallableMeta, _root=True):
     """
 
 
+# Attributes the metaclasses set on classes for their own use.
+_bookkeeping_attrs = frozenset([
+    '__parameters__', '__extra__', '__element_checkers__', '__memo_safe__',
+    '__origin__',
+    '__protocol_members__', '__conformance__',
+])
+
+
+def _is_bookkeeping(name):
+    """Return whether setting the class attribute name is bookkeeping.
+
+    This includes what abc.ABCMeta sets on each new class (_abc_impl
+    and __abstractmethods__), which doesn't change conformance.
+    """
+    return (name in _bookkeeping_attrs or name.startswith('_abc_') or
+            name == '__abstractmethods__')
+
+
+# Class attributes that don't make a protocol member.
+_non_members = _bookkeeping_attrs | frozenset([
+    '__module__', '__qualname__', '__doc__', '__dict__', '__weakref__',
+    '__slots__', '__annotations__', '__abstractmethods__', '__elements__',
+    '__init__', '__new__', '__init_subclass__', '__subclasshook__',
+    '__firstlineno__', '__static_attributes__', '__classcell__',
+])
+
+# All protocol classes (including parameterized ones), by id, since
+# distinct generic classes can be equal.
+_protocols = weakref.WeakValueDictionary()
+
+
+def _invalidate_conformance(cls):
+    """Forget which protocols cls and its subclasses conform to."""
+    keys = set()
+    todo = [cls]
+    while todo:
+        c = todo.pop()
+        if id(c) not in keys:
+            keys.add(id(c))
+            todo.extend(type.__subclasses__(c))
+    for protocol in list(_protocols.values()):
+        conformance = protocol.__conformance__
+        for key in keys:
+            conformance.pop(key, None)
+    _forget_protocol_subclasses()
+
+
+def _forget_protocol_subclasses():
+    """Drop results that may depend on conformance to protocols.
+
+    These are the memoized subclass checks (e.g. of unions and tuples
+    containing a protocol) and the interned unions, which were
+    normalized using issubclass().
+    """
+    _subclass_memo.clear(stats=False)
+    _union_cache.clear(stats=False)
+
+
 class GenericMeta(TypingMeta, abc.ABCMeta):
     """Metaclass for generic types."""
 
@@ -659,7 +1428,16 @@ class GenericMeta(TypingMeta, abc.ABCMeta):
     # TODO: Somehow repr() of a subclass parameterized comes out with
     # module=typing.
 
-    def __new__(cls, name, bases, namespace, parameters=None):
+    # How a collection type's elements are found: None (they aren't
+    # checked), 'iter' (iterating over it), 'items' (the keys and
+    # values of a mapping) or 'pairs' (iterating over key, value
+    # pairs).
+    __elements__ = None
+
+    def __new__(cls, name, bases, namespace, parameters=None, extra=None):
+        if extra is None:
+            # Parameterizations copy the namespace of their origin.
+            extra = namespace.get('__extra__')
         if parameters is None:
             # Extract parameters from direct base classes.  Only
             # direct bases are considered and only those that are
@@ -700,9 +1478,14 @@ class GenericMeta(TypingMeta, abc.ABCMeta):
                 self = overriding
                 for k, v in namespace.items():
                     setattr(self, k, v)
+                # Parameterizations copied the old namespace.
+                _param_cache.invalidate(self)
                 return self
         self = super().__new__(cls, name, bases, namespace, _root=True)
         self.__parameters__ = parameters
+        self.__extra__ = extra
+        self.__element_checkers__ = None  # Not copied; see below.
+        self.__memo_safe__ = None
         return self
 
     def __repr__(self):
@@ -721,6 +1504,15 @@ class GenericMeta(TypingMeta, abc.ABCMeta):
     def __hash__(self):
         return hash((self.__name__, self.__parameters__))
 
+    def __reduce__(self):
+        # A parameterization has the name of the class it was made
+        # from, which is pickled by name.
+        origin = _find_name('%s:%s' % (self.__module__, self.__qualname__))
+        if (origin is self or self.__parameters__ is None or
+                not isinstance(origin, GenericMeta)):
+            return super().__reduce__()
+        return operator.getitem, (origin, self.__parameters__)
+
     def __getitem__(self, params):
         if not isinstance(params, tuple):
             params = (params,)
@@ -728,6 +1520,11 @@ class GenericMeta(TypingMeta, abc.ABCMeta):
             raise TypeError("Cannot have empty parameter list")
         msg = "Parameters to generic types must be types."
         params = tuple(_type_check(p, msg) for p in params)
+        # A cached entry implies these parameters were accepted before.
+        key = (self,) + params
+        tp = _param_cache.get(key)
+        if tp is not None:
+            return tp
         if self.__parameters__ is None:
             for p in params:
                 if not isinstance(p, TypeVar):
@@ -745,9 +1542,107 @@ class GenericMeta(TypingMeta, abc.ABCMeta):
                     raise TypeError(
                         "Cannot substitute %s for %s in %s" %
                         (_type_repr(new), _type_repr(old), self))
-        return self.__class__(self.__name__, self.__bases__,
-                              dict(self.__dict__),
-                              parameters=params)
+        namespace = dict(self.__dict__)
+        # The class it was subscripted from, e.g. List for List[int].
+        namespace['__origin__'] = self.__dict__.get('__origin__', self)
+        tp = self.__class__(self.__name__, self.__bases__, namespace,
+                            parameters=params)
+        return _param_cache.add(key, tp)
+
+    # A generic collection type such as List (see below) stands for a
+    # runtime class, its __extra__; for other generic classes that is
+    # None.  Instances of that class are instances of the collection
+    # type, and their elements are checked against the parameters,
+    # using the current element check (see ElementCheck).  Subclasses
+    # of a collection type that aren't collection types themselves
+    # (e.g. class MyList(List[int])) behave like other generic
+    # classes.
+
+    def __instancecheck__(self, instance):
+        extra = self.__extra__
+        if extra is None:
+            return super().__instancecheck__(instance)
+        if _instance_memo.maxsize and extra is frozenset:
+            return _instance_memo.check(instance, self)
+        return self._check_instance(instance)
+
+    def _check_instance(self, instance):
+        extra = self.__extra__
+        if (not isinstance(instance, extra) and
+                not super().__instancecheck__(instance)):
+            return False
+        return self._check_elements(instance)
+
+    def __subclasscheck__(self, cls):
+        extra = self.__extra__
+        if extra is not None and isinstance(cls, type):
+            cls_extra = _collection_extra(cls)
+            if cls_extra is not None and issubclass(cls_extra, extra):
+                if not isinstance(cls, GenericMeta):
+                    # Like Tuple: a plain list class is a subclass of
+                    # List[int], as far as we can tell.
+                    return True
+                return self._covers_parameters(cls)
+        return super().__subclasscheck__(cls)
+
+    def _element_checkers(self):
+        """Return checkers for the elements' parameters, or ()."""
+        params = self.__parameters__
+        if self.__elements__ is None or params is None:
+            return ()
+        if '__origin__' not in self.__dict__:
+            # The type variables of e.g. List itself accept anything;
+            # those given by subscription (e.g. List[T]) are checked.
+            params = tuple(Any if isinstance(p, TypeVar) else p
+                           for p in params)
+        if all(p is Any for p in params):
+            return ()
+        return tuple(map(compile_checker, params))
+
+    def _check_elements(self, instance):
+        checkers = self.__element_checkers__
+        if checkers is None:
+            checkers = self.__element_checkers__ = self._element_checkers()
+        if not checkers:
+            return True
+        strategy = _element_check_override.get() or _default_element_check
+        if self.__elements__ == 'items':
+            elements = strategy.select(instance.items())
+        else:
+            elements = strategy.select(instance)
+        if self.__elements__ == 'iter':
+            return all(map(checkers[0], elements))
+        check_key, check_value = checkers
+        for key, value in elements:
+            if not (check_key(key) and check_value(value)):
+                return False
+        return True
+
+    def _covers_parameters(self, cls):
+        params = self.__parameters__
+        if params is None or all(isinstance(p, TypeVar) for p in params):
+            return True
+        cls_params = _parameters_as(cls, self.__extra__)
+        if cls_params is None:
+            # Like a plain class, as far as we can tell.
+            return True
+        if len(cls_params) != len(params):
+            return False
+        # Like Tuple, this is covariant.
+        return all(issubclass(c, p) for c, p in zip(cls_params, params))
+
+    # Mutating a generic class may change which protocols it conforms
+    # to (see ProtocolMeta).
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if _protocols and not _is_bookkeeping(name):
+            _invalidate_conformance(self)
+
+    def __delattr__(self, name):
+        super().__delattr__(name)
+        if _protocols and not _is_bookkeeping(name):
+            _invalidate_conformance(self)
 
 
 class Generic(metaclass=GenericMeta):
@@ -779,6 +1674,500 @@ class Generic(metaclass=GenericMeta):
     """
 
 
+class ElementCheck:
+    """Policy for checking the elements of collections in isinstance().
+
+    For example, isinstance(x, List[int]) first checks that x is a
+    list, then checks elements of x for being ints.  This base class
+    checks all of them, which for a large collection is slow;
+    subclasses check some of them (Shallow, FirstK, RandomK).  Their
+    select() method returns the elements to check, given an iterable
+    collection (a mapping's items view, for mappings).
+
+    Set the policy for all checks with set_element_check(), or for
+    some of them with a with statement::
+
+      with element_check(FirstK(10)):
+          assert isinstance(payload, Dict[str, List[int]])
+    """
+
+    def select(self, collection):
+        return collection
+
+    def __repr__(self):
+        return '%s()' % self.__class__.__name__
+
+
+class Shallow(ElementCheck):
+    """Only check the type of the collection, not its elements."""
+
+    def select(self, collection):
+        return ()
+
+
+class FirstK(ElementCheck):
+    """Check the first k elements (in iteration order)."""
+
+    def __init__(self, k):
+        if k < 0:
+            raise ValueError("FirstK(k): k must not be negative.")
+        self.k = k
+
+    def select(self, collection):
+        return itertools.islice(collection, self.k)
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.k)
+
+
+class RandomK(ElementCheck):
+    """Check k randomly chosen elements.
+
+    Only sequences can be sampled without iterating over all of their
+    elements; for other collections (sets, mappings) this checks the
+    first k elements, like FirstK.  Use a random.Random instance with
+    a known seed as rng to make the choice reproducible.
+    """
+
+    def __init__(self, k, rng=None):
+        if k < 0:
+            raise ValueError("RandomK(k): k must not be negative.")
+        if rng is None:
+            import random
+            rng = random.Random()
+        self.k = k
+        self.rng = rng
+
+    def select(self, collection):
+        if not isinstance(collection, collections.abc.Sequence):
+            return itertools.islice(collection, self.k)
+        n = len(collection)
+        if n <= self.k:
+            return collection
+        return [collection[i] for i in self.rng.sample(range(n), self.k)]
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.k)
+
+
+_default_element_check = ElementCheck()
+_element_check_override = _ContextVar('_element_check_override',
+                                      default=None)
+
+
+def set_element_check(strategy):
+    """Set the element check policy used by default (see ElementCheck).
+
+    Pass None to restore the default, which checks all elements.
+    """
+    global _default_element_check
+    if strategy is None:
+        strategy = ElementCheck()
+    elif not isinstance(strategy, ElementCheck):
+        raise TypeError("set_element_check(strategy): strategy must be an "
+                        "ElementCheck or None.  Got %.100r." % (strategy,))
+    _default_element_check = strategy
+
+
+class element_check:
+    """Context manager using an element check policy (see ElementCheck).
+
+    The policy applies in the current context only (like type variable
+    bindings), so other threads and tasks are not affected.
+    """
+
+    def __init__(self, strategy):
+        if not isinstance(strategy, ElementCheck):
+            raise TypeError("element_check(strategy): strategy must be an "
+                            "ElementCheck.  Got %.100r." % (strategy,))
+        self.strategy = strategy
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_element_check_override.set(self.strategy))
+        return self.strategy
+
+    def __exit__(self, *args):
+        _element_check_override.reset(self._tokens.pop())
+
+
+def _collection_extra(cls):
+    """Return the runtime class a class stands for, if any.
+
+    That is the class itself, except for generic classes, where it is
+    the __extra__ of the nearest collection type in its MRO.
+    """
+    if not isinstance(cls, GenericMeta):
+        return cls
+    for base in cls.__mro__:
+        extra = base.__dict__.get('__extra__')
+        if extra is not None:
+            return extra
+    return None
+
+
+def _parameters_as(cls, extra):
+    """Return the parameters of the generic class cls, as seen by a base.
+
+    That base is the collection type standing for extra.  For example,
+    Dict[str, int] is a Mapping[str, int] and an Iterable[str].  The
+    parameters are substituted through the bases of cls, which are
+    parameterized with the type variables of its origin.  Return None
+    if no base stands for extra.
+    """
+    if cls.__dict__.get('__extra__') is extra:
+        return cls.__parameters__
+    # The parameters of the origin of cls, as in GenericMeta.__new__().
+    origin_params = []
+    for base in cls.__bases__:
+        if isinstance(base, GenericMeta) and base.__parameters__:
+            for p in base.__parameters__:
+                if p not in origin_params:
+                    origin_params.append(p)
+    cls_params = cls.__parameters__ or ()
+    for base in cls.__bases__:
+        if not isinstance(base, GenericMeta):
+            continue
+        params = _parameters_as(base, extra)
+        if params is None:
+            continue
+        if len(origin_params) != len(cls_params):
+            return params
+        result = []
+        for p in params:
+            for old, new in zip(origin_params, cls_params):
+                if p is old:
+                    p = new
+                    break
+            result.append(p)
+        return tuple(result)
+    return None
+
+
+def _collection(name, bases, extra, elements=None):
+    """Register the generic collection type name, built on first use.
+
+    The bases are names of collection types (or Generic), or (name,
+    parameters) pairs for parameterized bases.  Instances of extra
+    are instances of the new type.
+    """
+    def build():
+        resolved = []
+        for base in bases:
+            if isinstance(base, tuple):
+                base, params = base
+                resolved.append(__getattr__(base)[params])
+            else:
+                resolved.append(__getattr__(base))
+        namespace = {
+            '__module__': __name__,
+            '__qualname__': name,
+            '__doc__': 'Generic version of %s.%s.' % (extra.__module__,
+                                                      extra.__qualname__),
+            '__elements__': elements,
+        }
+        tp = GenericMeta(name, tuple(resolved), namespace, extra=extra)
+        if tp.__parameters__ and not any(isinstance(p, TypeVar)
+                                         for p in tp.__parameters__):
+            # Like ByteString, a Sequence[int]: it isn't generic itself.
+            tp.__parameters__ = None
+        return tp
+    _lazy_members[name] = build
+
+
+_abc = collections.abc
+_collection('Hashable', [], _abc.Hashable)
+_collection('Sized', [], _abc.Sized)
+# Iterating over an iterator (or some iterables) consumes it, so
+# their elements aren't checked.
+_collection('Iterable', [('Generic', T)], _abc.Iterable)
+_collection('Iterator', [('Iterable', T)], _abc.Iterator)
+_collection('AsyncIterable', [('Generic', T)], _abc.AsyncIterable)
+_collection('AsyncIterator', [('AsyncIterable', T)], _abc.AsyncIterator)
+_collection('Container', [('Generic', T)], _abc.Container)
+_collection('AbstractSet', ['Sized', ('Iterable', T), ('Container', T)],
+            _abc.Set, 'iter')
+_collection('MutableSet', [('AbstractSet', T)], _abc.MutableSet, 'iter')
+_collection('Mapping', ['Sized', ('Iterable', KT), ('Container', KT),
+                        ('Generic', (KT, VT))],
+            _abc.Mapping, 'items')
+_collection('MutableMapping', [('Mapping', (KT, VT))],
+            _abc.MutableMapping, 'items')
+_collection('MappingView', ['Sized', ('Iterable', T)],
+            _abc.MappingView, 'iter')
+_collection('KeysView', [('MappingView', KT), ('AbstractSet', KT)],
+            _abc.KeysView, 'iter')
+_collection('ItemsView', ['Sized', ('Generic', (KT, VT))],
+            _abc.ItemsView, 'pairs')
+_collection('ValuesView', [('MappingView', VT)], _abc.ValuesView, 'iter')
+_collection('Sequence', ['Sized', ('Iterable', T), ('Container', T)],
+            _abc.Sequence, 'iter')
+_collection('MutableSequence', [('Sequence', T)],
+            _abc.MutableSequence, 'iter')
+# The elements of byte strings are always ints.
+_collection('ByteString', [('Sequence', int)], _abc.ByteString)
+_collection('List', [('MutableSequence', T)], list, 'iter')
+_collection('Dict', [('MutableMapping', (KT, VT))], dict, 'items')
+_collection('Set', [('MutableSet', T)], set, 'iter')
+_collection('FrozenSet', [('AbstractSet', T)], frozenset, 'iter')
+del _abc
+
+
+class _ProtocolStats:
+    """Statistics of the protocol conformance caches, for cache_info()."""
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = self.misses = 0
+        _caches[name] = self
+
+    def info(self):
+        size = sum(len(p.__conformance__) for p in list(_protocols.values()))
+        return CacheInfo(self.hits, self.misses, 0, None, size)
+
+    def clear(self, stats=True):
+        for protocol in list(_protocols.values()):
+            protocol.__conformance__.clear()
+        if stats:
+            self.hits = self.misses = 0
+
+
+_protocol_stats = _ProtocolStats('protocol')
+
+
+class ProtocolMeta(GenericMeta):
+    """Metaclass for Protocol and protocol classes.
+
+    A protocol class is one that lists Protocol (or Protocol[...])
+    among its bases.  Its members are the attributes defined in its
+    body (and those of the protocols it extends).  A class conforms to
+    it if the class (or one of its bases) defines all of them, with
+    values other than None.  This is checked only once per class: the
+    answer is cached until the class (or a base) is changed.
+
+    Assignments to attributes of classes with a typing metaclass (such
+    as generic classes and protocols) are noticed; after changing the
+    attributes of other classes, call cache_clear().
+    """
+
+    def __init__(self, name, bases, namespace, parameters=None, extra=None):
+        # Parameterizations copy the members of their origin.
+        members = namespace.get('__protocol_members__')
+        if members is None and any(b.__dict__.get('__protocol_root__')
+                                   for b in bases):
+            members = frozenset(n for n in namespace
+                                if n not in _non_members and
+                                not n.startswith('_abc_'))
+        self.__protocol_members__ = members
+        # Maps id(cls) to a (weak reference to cls, result) pair.
+        self.__conformance__ = {}
+        if members is not None:
+            _protocols[id(self)] = self
+
+    def __setattr__(self, name, value):
+        members = self.__dict__.get('__protocol_members__')
+        if (members is not None and name not in _non_members and
+                not name.startswith('_abc_')):
+            type.__setattr__(self, '__protocol_members__',
+                             members | {name})
+            _protocol_stats.clear(stats=False)
+            _forget_protocol_subclasses()
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        members = self.__dict__.get('__protocol_members__')
+        if members is not None and name in members:
+            type.__setattr__(self, '__protocol_members__',
+                             members - {name})
+            _protocol_stats.clear(stats=False)
+            _forget_protocol_subclasses()
+        super().__delattr__(name)
+
+    def _all_members(self):
+        members = set()
+        for base in self.__mro__:
+            if isinstance(base, ProtocolMeta):
+                members.update(base.__dict__.get('__protocol_members__') or ())
+        return members
+
+    def _conforms(self, cls):
+        for name in self._all_members():
+            for base in cls.__mro__:
+                if name in base.__dict__:
+                    if base.__dict__[name] is None:
+                        return False  # E.g. __hash__ = None.
+                    break
+            else:
+                return False
+        return True
+
+    def __instancecheck__(self, instance):
+        if self.__protocol_members__ is None:
+            return super().__instancecheck__(instance)
+        # The fast path of __subclasscheck__(), inlined.
+        cls = type(instance)
+        entry = self.__conformance__.get(id(cls))
+        if entry is not None and entry[0]() is cls:
+            _protocol_stats.hits += 1
+            return entry[1]
+        return self.__subclasscheck__(cls)
+
+    def __subclasscheck__(self, cls):
+        if self.__protocol_members__ is None or not isinstance(cls, type):
+            return super().__subclasscheck__(cls)
+        key = id(cls)
+        conformance = self.__conformance__
+        entry = conformance.get(key)
+        if entry is not None and entry[0]() is cls:
+            _protocol_stats.hits += 1
+            return entry[1]
+        _protocol_stats.misses += 1
+        result = self._conforms(cls)
+
+        def remove(ref, key=key):
+            if conformance.get(key, (None,))[0] is ref:
+                del conformance[key]
+
+        conformance[key] = (weakref.ref(cls, remove), result)
+        return result
+
+
+class Protocol(metaclass=ProtocolMeta):
+    """Base class for protocol classes (structural types).
+
+    A protocol class lists members that conforming classes must have,
+    without them having to inherit from it, e.g.::
+
+      class SupportsClose(Protocol):
+          def close(self):
+              ...
+
+      assert isinstance(open(__file__), SupportsClose)
+
+    Protocols may be generic, like Protocol[T]; the parameters aren't
+    checked at runtime.  See ProtocolMeta.
+    """
+
+    __protocol_root__ = True
+
+
+def _memo_safe(tp):
+    """Return whether isinstance(x, tp) can be memoized for tuples and
+    frozensets x.
+
+    That is the case if the result only depends on the elements' types
+    and on immutable containers; e.g. not for Tuple[List[int]] (the
+    list may change), nor for type variables (their binding may).
+    """
+    if tp is Any or not isinstance(tp, TypingMeta):
+        return True
+    if isinstance(tp, UnionMeta):
+        return (tp.__union_params__ is not None and
+                all(map(_memo_safe, tp.__union_params__)))
+    if isinstance(tp, TupleMeta):
+        return (tp.__tuple_params__ is None or
+                all(map(_memo_safe, tp.__tuple_params__)))
+    if isinstance(tp, GenericMeta) and tp.__extra__ is frozenset:
+        return all(isinstance(p, TypeVar) or _memo_safe(p)
+                   for p in tp.__parameters__)
+    return False
+
+
+class _InstanceMemo:
+    """Memo of tuples and frozensets known to be instances of a type.
+
+    Once enabled with set_instance_memo(), isinstance(x, tp) for a
+    Tuple[...] or FrozenSet[...] tp remembers that an (exactly) tuple
+    or frozenset x was an instance of tp, so checking it again is a
+    dictionary lookup.  This is only done for types where the answer
+    can't change (see _memo_safe()), and only for answers computed
+    checking all elements (see ElementCheck).
+
+    Entries are keyed by identity.  Tuples can't be weakly referenced,
+    so the memo holds strong references to the containers (and the
+    types), which also keeps their ids from being reused; at most
+    maxsize entries are kept, the least recently used one is evicted
+    first.
+    """
+
+    def __init__(self, name, maxsize=0):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = _thread.allocate_lock()
+        self.hits = self.misses = self.evictions = 0
+        _caches[name] = self
+
+    def check(self, obj, tp):
+        """Return isinstance(obj, tp), using the memo if possible."""
+        if type(obj) is not tuple and type(obj) is not frozenset:
+            return tp._check_instance(obj)
+        safe = tp.__memo_safe__
+        if safe is None:
+            safe = tp.__memo_safe__ = _memo_safe(tp)
+        if not safe:
+            return tp._check_instance(obj)
+        key = (id(obj), id(tp))
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not tp._check_instance(obj):
+            return False
+        strategy = _element_check_override.get() or _default_element_check
+        if type(strategy).select is not ElementCheck.select:
+            return True  # Some elements weren't checked.
+        with self._lock:
+            self._data[key] = (obj, tp)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._data))
+
+    def clear(self, stats=True):
+        """Drop all entries, and reset the statistics unless told not to."""
+        with self._lock:
+            self._data.clear()
+            if stats:
+                self.hits = self.misses = self.evictions = 0
+
+
+_instance_memo = _InstanceMemo('instance')
+
+
+def set_instance_memo(maxsize):
+    """Remember up to maxsize tuples and frozensets that passed a check.
+
+    This is off (maxsize 0) by default.  It's meant for programs that
+    check the same large immutable containers repeatedly, e.g. when
+    passing them through many @typechecked functions::
+
+      set_instance_memo(10000)
+
+    The memo keeps the containers alive until they are evicted.  It
+    assumes that the elements' classes don't change (through
+    assignment to __class__).  Pass 0 to turn it off and empty it.
+    """
+    if not isinstance(maxsize, int) or maxsize < 0:
+        raise ValueError("set_instance_memo(maxsize): maxsize must be a "
+                         "non-negative integer.  Got %.100r." % (maxsize,))
+    _instance_memo.resize(maxsize)
+
+
 class Undefined:
     """An undefined value.
 
@@ -818,3 +2207,1846 @@ def cast(typ, val):
     """
     _type_check(typ, "cast(t, v): t must be a type.")
     return val
+
+
+# Serialized type expressions; see encode_type().  Both encodings hold
+# a table of names and the expression in prefix form, as a list of
+# ints: each opcode is followed by its operands.  Names are those of
+# classes, as 'module:qualname', and of type variables.
+#
+#   _CLASS name             The class found by that name.
+#   _NONE                   type(None).
+#   _TYPEVAR name n c1..cn  A new type variable with n constraints;
+#                           the first one defined has number 0, etc.
+#   _VAR number             A type variable defined before.
+#   _UNION n t1..tn         A normalized union of n types.
+#   _TUPLE n t1..tn         Tuple[t1, ..., tn].
+#   _CALLABLE n a1..an r    Callable[[a1, ..., an], r].
+#   _GENERIC name n t1..tn  The generic class named, parameterized.
+_ENCODING_VERSION = 1
+_ENCODING_MAGIC = b'TYP'
+_CLASS, _NONE, _TYPEVAR, _VAR, _UNION, _TUPLE, _CALLABLE, _GENERIC = range(8)
+
+
+def _find_name(name, load=False):
+    """Return the object named 'module:qualname', or None.
+
+    Unless load is true, the module must already be imported.
+    """
+    module_name, _, qualname = name.partition(':')
+    obj = sys.modules.get(module_name)
+    if obj is None and load:
+        try:
+            __import__(module_name)
+        except ImportError:
+            return None
+        obj = sys.modules.get(module_name)
+    for part in qualname.split('.'):
+        if obj is None:
+            break
+        obj = getattr(obj, part, None)
+    return obj
+
+
+class _TypeEncoder:
+    """Translate a type expression into names and code."""
+
+    def __init__(self):
+        self.names = []
+        self.code = []
+        self._name_numbers = {}
+        self._type_vars = {}  # id(var) -> (var, number)
+
+    def name(self, name):
+        number = self._name_numbers.get(name)
+        if number is None:
+            number = self._name_numbers[name] = len(self.names)
+            self.names.append(name)
+        return number
+
+    def encode_all(self, types):
+        for t in types:
+            self.encode(t)
+
+    def encode(self, tp):
+        code = self.code
+        if tp is type(None):
+            code.append(_NONE)
+        elif isinstance(tp, UnionMeta) and tp.__union_params__ is not None:
+            code += (_UNION, len(tp.__union_params__))
+            self.encode_all(tp.__union_params__)
+        elif isinstance(tp, TupleMeta) and tp.__tuple_params__ is not None:
+            code += (_TUPLE, len(tp.__tuple_params__))
+            self.encode_all(tp.__tuple_params__)
+        elif isinstance(tp, CallableMeta) and tp.__args__ is not None:
+            code += (_CALLABLE, len(tp.__args__))
+            self.encode_all(tp.__args__)
+            self.encode(tp.__result__)
+        elif isinstance(tp, type):
+            name = '%s:%s' % (tp.__module__, tp.__qualname__)
+            found = _find_name(name)
+            if found is tp:
+                code += (_CLASS, self.name(name))
+            elif isinstance(tp, TypeVar):
+                entry = self._type_vars.get(id(tp))
+                if entry is not None:
+                    code += (_VAR, entry[1])
+                else:
+                    self._type_vars[id(tp)] = (tp, len(self._type_vars))
+                    code += (_TYPEVAR, self.name(tp.__name__),
+                             len(tp.__constraints__))
+                    self.encode_all(tp.__constraints__)
+            elif (isinstance(tp, GenericMeta) and
+                  isinstance(found, GenericMeta) and
+                  tp.__parameters__ is not None):
+                code += (_GENERIC, self.name(name), len(tp.__parameters__))
+                self.encode_all(tp.__parameters__)
+            else:
+                raise TypeError("Cannot encode %r: it isn't found by its "
+                                "name, %r." % (tp, name))
+        else:
+            raise TypeError("Cannot encode %.100r: not a type." % (tp,))
+
+
+def _decode(names, code):
+    """Rebuild a type expression from names (strs) and code (ints)."""
+    ops = iter(code)
+    found = {}
+    type_vars = []
+
+    def named():
+        number = next(ops)
+        obj = found.get(number)
+        if obj is None:
+            obj = _find_name(names[number], load=True)
+            if not isinstance(obj, type):
+                raise ValueError("Type encoding: %r is not a type." %
+                                 (names[number],))
+            found[number] = obj
+        return obj
+
+    def decode_all():
+        return tuple([decode() for i in range(next(ops))])
+
+    def decode():
+        op = next(ops)
+        if op == _CLASS:
+            return named()
+        elif op == _NONE:
+            return type(None)
+        elif op == _TYPEVAR:
+            name = names[next(ops)]
+            var = TypeVar(name, *decode_all())
+            type_vars.append(var)
+            return var
+        elif op == _VAR:
+            return type_vars[next(ops)]
+        elif op == _UNION:
+            params = decode_all()
+            if len(params) < 2:
+                raise ValueError("Type encoding: a union needs two types.")
+            if not _type_var_bindings.get():
+                _check_union_cache_token()
+                union = _union_cache.get(params)
+                if union is not None:
+                    return union
+            # The params should come from a union, so they should be
+            # normalized already; check it, since they are interned
+            # under the same key as Union[params].
+            if (len(set(params)) < len(params) or
+                    len(_remove_subclasses(params)) < len(params)):
+                raise ValueError("Type encoding: the union %r isn't "
+                                 "normalized." % (params,))
+            return UnionMeta._intern(Union.__name__, Union.__bases__,
+                                     dict(Union.__dict__), params)
+        elif op == _TUPLE:
+            return Tuple[decode_all()]
+        elif op == _CALLABLE:
+            args = decode_all()
+            return Callable[list(args), decode()]
+        elif op == _GENERIC:
+            origin = named()
+            return origin[decode_all()]
+        raise ValueError("Type encoding: unknown opcode %r." % (op,))
+
+    try:
+        tp = decode()
+    except (StopIteration, IndexError):
+        raise ValueError("Truncated or corrupt type encoding.") from None
+    if next(ops, None) is not None:
+        raise ValueError("Type encoding: trailing data.")
+    return tp
+
+
+# Pickle types by name, or types made by subscription as that
+# subscription, so that unpickling returns the cached type if there is
+# one.  Pickle saves classes by name without calling __reduce__(),
+# unless their metaclass is in copyreg's dispatch table.
+for _meta in [AnyMeta, TypeVar, ForwardRef, UnionMeta, OptionalMeta,
+              TupleMeta, CallableMeta, GenericMeta, ProtocolMeta]:
+    copyreg.pickle(_meta, _meta.__reduce__)
+del _meta
+
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def encode_type(tp):
+    """Return a compact binary encoding of the type expression tp.
+
+    decode_type() turns it back into the type.  The expression may be
+    made of classes that can be found by their module and qualified
+    name (which includes Any, and unsubscripted Union, Generic etc.),
+    type(None), type variables, and subscriptions of Union, Tuple,
+    Callable and generic classes.  Anything else raises TypeError.
+
+    Type variables are found by name like classes if possible; others
+    are encoded by name and constraints, and decoding creates new ones
+    (shared by all their uses in the expression).
+
+    The encoding starts with b'TYP' and a version byte.  See also
+    encode_type_json().
+    """
+    encoder = _TypeEncoder()
+    encoder.encode(tp)
+    out = bytearray(_ENCODING_MAGIC)
+    out.append(_ENCODING_VERSION)
+    _put_varint(out, len(encoder.names))
+    for name in encoder.names:
+        name = name.encode('utf-8')
+        _put_varint(out, len(name))
+        out += name
+    for n in encoder.code:
+        _put_varint(out, n)
+    return bytes(out)
+
+
+def _get_varint(data, pos):
+    """Return the int encoded at data[pos:] and the position after it.
+
+    Raises IndexError if the data is truncated.
+    """
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def decode_type(data):
+    """Return the type expression encoded by encode_type().
+
+    Unions are rebuilt as they were encoded.  Unless an equal union is
+    cached already, they are checked to be normalized (which costs
+    about as much as normalizing them), and if they aren't, ValueError
+    is raised.  Classes are looked up by name, importing their modules if
+    needed; as with pickle, only decode data from trusted sources.
+    Malformed data raises ValueError.
+    """
+    data = bytes(data)
+    if not data.startswith(_ENCODING_MAGIC):
+        raise ValueError("Not a type encoding.")
+    pos = len(_ENCODING_MAGIC)
+    try:
+        if data[pos] != _ENCODING_VERSION:
+            raise ValueError("Unsupported type encoding version %d." %
+                             data[pos])
+        count, pos = _get_varint(data, pos + 1)
+        names = []
+        for i in range(count):
+            size, pos = _get_varint(data, pos)
+            if pos + size > len(data):
+                raise IndexError
+            names.append(data[pos:pos + size].decode('utf-8'))
+            pos += size
+        code = data[pos:]
+        if code and max(code) >= 0x80:
+            code = []
+            while pos < len(data):
+                n, pos = _get_varint(data, pos)
+                code.append(n)
+        # Else each byte is a whole varint.
+    except IndexError:
+        raise ValueError("Truncated type encoding.") from None
+    return _decode(names, code)
+
+
+def encode_type_json(tp):
+    """Return an encoding of the type expression tp as a JSON string.
+
+    This is the JSON counterpart of encode_type(), for services that
+    exchange JSON; decode it with decode_type_json().  It is an object
+    with the keys 'version', 'names' and 'code'.
+    """
+    import json
+    encoder = _TypeEncoder()
+    encoder.encode(tp)
+    return json.dumps({'version': _ENCODING_VERSION, 'names': encoder.names,
+                       'code': encoder.code}, separators=(',', ':'))
+
+
+def decode_type_json(text):
+    """Return the type expression encoded by encode_type_json().
+
+    See decode_type().
+    """
+    import json
+    try:
+        obj = json.loads(text)
+        version = obj['version']
+        names = obj['names']
+        code = obj['code']
+    except (TypeError, KeyError):
+        raise ValueError("Not a type encoding.") from None
+    if version != _ENCODING_VERSION:
+        raise ValueError("Unsupported type encoding version %r." %
+                         (version,))
+    if not (isinstance(names, list) and isinstance(code, list) and
+            all(type(n) is str for n in names) and
+            all(type(i) is int and i >= 0 for i in code)):
+        raise ValueError("Malformed type encoding.")
+    return _decode(names, code)
+
+
+class _CheckerCompiler:
+    """Translate a type into the source of one checking function.
+
+    Union, Tuple and type variables are expanded inline, so that e.g.
+    checking Tuple[int, Union[str, None]] becomes a single boolean
+    expression instead of a chain of metaclass __instancecheck__()
+    calls.  A type variable's binding is looked up at check time.
+    Parameterized Callable types and generic classes are delegated to
+    isinstance(), and so are tuples while the instance memo is enabled.
+    """
+
+    def __init__(self):
+        self.namespace = {}
+        self._names = {}
+
+    def name(self, obj):
+        """Return the global name under which obj is visible."""
+        name = self._names.get(id(obj))
+        if name is None:
+            name = '_t%d' % len(self._names)
+            self._names[id(obj)] = name
+            self.namespace[name] = obj
+        return name
+
+    def expr(self, tp, var):
+        """Return an expression that is true iff isinstance(var, tp)."""
+        if tp is Any:
+            return 'True'
+        if isinstance(tp, UnionMeta) and tp.__union_params__ is not None:
+            # Classes that aren't typing types can share one
+            # isinstance() call, using a tuple of classes.
+            plain = tuple(t for t in tp.__union_params__
+                          if not isinstance(t, TypingMeta))
+            parts = []
+            if len(plain) == 1:
+                parts.append('isinstance(%s, %s)' %
+                             (var, self.name(plain[0])))
+            elif plain:
+                parts.append('isinstance(%s, %s)' % (var, self.name(plain)))
+            parts.extend(self.expr(t, var) for t in tp.__union_params__
+                         if isinstance(t, TypingMeta))
+            return '(%s)' % ' or '.join(parts)
+        if isinstance(tp, TupleMeta):
+            if tp.__tuple_params__ is None:
+                return 'isinstance(%s, tuple)' % var
+            parts = ['isinstance(%s, tuple)' % var,
+                     'len(%s) == %d' % (var, len(tp.__tuple_params__))]
+            parts.extend(self.expr(p, '%s[%d]' % (var, i))
+                         for i, p in enumerate(tp.__tuple_params__))
+            inline = '(%s)' % ' and '.join(parts)
+            if not _memo_safe(tp):
+                return inline
+            # See set_instance_memo(); it may be enabled later.
+            memo = self.name(_instance_memo)
+            return '(%s if not %s.maxsize else %s.check(%s, %s))' % (
+                inline, memo, memo, var, self.name(tp))
+        if isinstance(tp, TypeVar):
+            # The binding may change after compilation; look it up.
+            if tp.__constraints__:
+                unbound = self.expr(Union[tp.__constraints__], var)
+            else:
+                unbound = 'False'
+            name = self.name(tp)
+            return ('(%s if %s.__binding__ is None else '
+                    'isinstance(%s, %s.__binding__))' %
+                    (unbound, name, var, name))
+        if (isinstance(tp, CallableMeta) and
+                tp.__args__ is None and tp.__result__ is None):
+            return 'callable(%s)' % var
+        return 'isinstance(%s, %s)' % (var, self.name(tp))
+
+    def compile(self, tp):
+        source = 'def check(x):\n    return %s\n' % self.expr(tp, 'x')
+        exec(source, self.namespace)
+        check = self.namespace['check']
+        check.__doc__ = 'Return isinstance(x, %s).' % _type_repr(tp)
+        check.__source__ = source
+        return check
+
+
+_checker_cache = _TypeCache('checker', maxsize=1024, weak_values=True)
+
+
+def compile_checker(typ):
+    """Return a function equivalent to lambda x: isinstance(x, typ).
+
+    The function is generated specifically for typ, which may be
+    built from Any, type variables, Union, Optional, Tuple, Callable,
+    Generic and ordinary classes.  This avoids the metaclass dispatch
+    that isinstance() goes through for each nested type, e.g.::
+
+      check = compile_checker(Tuple[int, Optional[str]])
+      assert check((1, None))
+      assert not check((1, 2))
+
+    Checkers are cached, so calling this repeatedly for the same type
+    is cheap.
+    """
+    typ = _type_check(typ, "compile_checker(t): t must be a type.")
+    check = _checker_cache.get((typ,))
+    if check is None:
+        check = _checker_cache.add((typ,), _CheckerCompiler().compile(typ))
+    return check
+
+
+CheckResult = collections.namedtuple('CheckResult', ['count', 'failures'])
+
+
+def check_many(typ, iterable, *, bitmask=False):
+    """Check every value in iterable against typ.
+
+    This is equivalent to calling isinstance(value, typ) for each
+    value, but resolves how to check typ only once (see
+    compile_checker()).  Return a CheckResult(count, failures) tuple,
+    where count is the number of values checked.  By default failures
+    is an array of the indices of the values that aren't instances of
+    typ, e.g.::
+
+      check_many(int, [1, 'a', 2, None]) == (4, array('q', [1, 3]))
+
+    With bitmask=True, failures is instead a bytearray with one bit
+    per value, set for the values that aren't instances of typ; the
+    bit for the value at index i is (failures[i // 8] >> (i % 8)) & 1.
+    """
+    check = compile_checker(typ)
+    count = 0
+    if not bitmask:
+        failures = array.array('q')
+        for count, ok in enumerate(map(check, iterable), 1):
+            if not ok:
+                failures.append(count - 1)
+        return CheckResult(count, failures)
+    failures = bytearray()
+    byte = bit = 0
+    for ok in map(check, iterable):
+        if not ok:
+            byte |= 1 << bit
+        bit += 1
+        count += 1
+        if bit == 8:
+            failures.append(byte)
+            byte = bit = 0
+    if bit:
+        failures.append(byte)
+    return CheckResult(count, failures)
+
+
+def iter_failures(typ, iterable):
+    """Yield (index, value) for each value that isn't an instance of typ.
+
+    Like check_many(), but lazy, so that it can be used on streams.
+    """
+    check = compile_checker(typ)
+    for index, value in enumerate(iterable):
+        if not check(value):
+            yield index, value
+
+
+def checked_iter(typ, iterable):
+    """Return an iterator over iterable that checks each value against typ.
+
+    Like iter_failures(), this is lazy, so it can be used on streams
+    and generator pipelines without holding on to their values: each
+    value is checked as it is consumed, and the first one that isn't
+    an instance of typ raises TypeError giving its index, e.g.::
+
+      for row in checked_iter(Tuple[int, str], read_rows()):
+          ...
+
+    After a failure, iteration may continue with the next value.
+    """
+    check = compile_checker(typ)
+    return _CheckedIterator(iter(iterable), check, None, typ, None, ())
+
+
+# The checker of a validate_parallel() worker process.
+_parallel_check = None
+
+
+def _init_parallel_worker(typ, strategy, bindings):
+    global _parallel_check
+    # Check like the caller: with its element checks and bindings,
+    # for the life of the worker.
+    set_element_check(strategy)
+    for var, binding in bindings.items():
+        VarBinding(var, binding).__enter__()
+    _parallel_check = compile_checker(typ)
+
+
+def _check_chunk(chunk, initargs=None):
+    if initargs is not None and _parallel_check is None:
+        _init_parallel_worker(*initargs)  # No pool initializers (3.6).
+    check = _parallel_check
+    return array.array('q', [i for i, value in enumerate(chunk)
+                             if not check(value)])
+
+
+def validate_parallel(typ, iterable, *, workers=None, chunksize=10000):
+    """Like check_many(), but check the values in worker processes.
+
+    This is meant for checking very many values in bulk.  The values
+    are read from iterable in chunks of chunksize values, which are
+    sent to a pool of worker processes (by default, one per CPU); at
+    most two chunks per worker are pending at a time, so iterable can
+    be a stream.  The type is sent to each worker once, along with
+    the element check strategy (see element_check()) and the type
+    variable bindings in effect, so they must be picklable, and so
+    must the values.  (Before Python 3.7, they are sent with each
+    chunk.)  Return a CheckResult(count, failures) tuple, where
+    failures is an array of the indices of the values that aren't
+    instances of typ, in order.
+
+    With a single worker, this is check_many() in this process.
+    """
+    import os
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("validate_parallel(): workers must be positive")
+    if chunksize < 1:
+        raise ValueError("validate_parallel(): chunksize must be positive")
+    if workers == 1:
+        return check_many(typ, iterable)
+    import concurrent.futures
+    iterator = iter(iterable)
+    count = 0
+    failures = array.array('q')
+    pending = collections.deque()  # (start index, future), in order.
+
+    def collect():
+        start, future = pending.popleft()
+        failures.extend(i + start for i in future.result())
+
+    strategy = _element_check_override.get() or _default_element_check
+    initargs = (typ, strategy, dict(_type_var_bindings.get()))
+    if sys.version_info >= (3, 7):
+        pool = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_parallel_worker, initargs=initargs)
+        initargs = None
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(workers)
+    with pool:
+        while True:
+            chunk = list(itertools.islice(iterator, chunksize))
+            if not chunk:
+                break
+            pending.append((count, pool.submit(_check_chunk, chunk,
+                                               initargs)))
+            count += len(chunk)
+            if len(pending) >= 2 * workers:
+                collect()
+        while pending:
+            collect()
+    return CheckResult(count, failures)
+
+
+def _erase_type_vars(typ, keep):
+    """Replace type variables not in keep by what they may stand for.
+
+    An unconstrained type variable becomes Any, a constrained one the
+    union of its constraints.
+    """
+    if isinstance(typ, TypeVar):
+        if typ in keep:
+            return typ
+        if typ.__constraints__:
+            return Union[typ.__constraints__]
+        return Any
+    if isinstance(typ, UnionMeta) and typ.__union_params__ is not None:
+        return Union[tuple(_erase_type_vars(t, keep)
+                           for t in typ.__union_params__)]
+    if isinstance(typ, TupleMeta) and typ.__tuple_params__ is not None:
+        return Tuple[tuple(_erase_type_vars(t, keep)
+                           for t in typ.__tuple_params__)]
+    if isinstance(typ, CallableMeta) and typ.__args__ is not None:
+        return Callable[[_erase_type_vars(t, keep) for t in typ.__args__],
+                        _erase_type_vars(typ.__result__, keep)]
+    if isinstance(typ, GenericMeta) and '__origin__' in typ.__dict__:
+        return typ.__origin__[tuple(_erase_type_vars(t, keep)
+                                    for t in typ.__parameters__)]
+    return typ
+
+
+def _type_vars(typ):
+    """Yield the type variables typ is built from."""
+    if isinstance(typ, TypeVar):
+        yield typ
+    elif isinstance(typ, UnionMeta) and typ.__union_params__ is not None:
+        for t in typ.__union_params__:
+            yield from _type_vars(t)
+    elif isinstance(typ, TupleMeta) and typ.__tuple_params__ is not None:
+        for t in typ.__tuple_params__:
+            yield from _type_vars(t)
+    elif isinstance(typ, CallableMeta) and typ.__args__ is not None:
+        for t in typ.__args__:
+            yield from _type_vars(t)
+        yield from _type_vars(typ.__result__)
+    elif isinstance(typ, GenericMeta):
+        for t in typ.__parameters__ or ():
+            yield from _type_vars(t)
+
+
+def _bound_repr(typ):
+    """Return the repr() of typ, with the current bindings of its
+    type variables, e.g. "~T (~T is int)".
+    """
+    r = _type_repr(typ)
+    bindings = _type_var_bindings.get()
+    if bindings:
+        bound = []
+        for var in _type_vars(typ):
+            binding = bindings.get(var)
+            if binding is not None and var not in bound:
+                bound.append(var)
+                r += '%s%r is %s' % (' (' if len(bound) == 1 else ', ',
+                                     var, _type_repr(binding))
+        if bound:
+            r += ')'
+    return r
+
+
+def _argument_error(func, name, typ, value):
+    return TypeError("%s(): argument %r must be %s, got %.100r" %
+                     (func.__qualname__, name, _bound_repr(typ), value))
+
+
+def _return_error(func, typ, value):
+    return TypeError("%s(): return value must be %s, got %.100r" %
+                     (func.__qualname__, _bound_repr(typ), value))
+
+
+def _bind_type(func, var, names, values):
+    """Return the type to bind var to, for the arguments it annotates.
+
+    This is the type of one of the values that the types of all the
+    others are subclasses of, so that the order of the arguments
+    doesn't matter: e.g. both add(1, True) and add(True, 1) bind T to
+    int for "def add(a: T, b: T)".  If there is none, raise TypeError
+    for the first argument that doesn't fit.
+    """
+    types = [type(v) for v in values]
+    best = 0
+    for i in range(1, len(types)):
+        if issubclass(types[best], types[i]):
+            best = i
+        elif not issubclass(types[i], types[best]):
+            raise TypeError(
+                "%s(): argument %r must be %s (%r, bound by argument %r), "
+                "got %.100r" % (func.__qualname__, names[i],
+                                _type_repr(types[best]), var, names[best],
+                                values[i]))
+    return types[best]
+
+
+def _element_error(func, typ, index, value, what='yielded value %d'):
+    if func is None:
+        return TypeError("value %d must be %s, got %.100r" %
+                         (index, _type_repr(typ), value))
+    return TypeError("%s(): %s must be %s, got %.100r" %
+                     (func.__qualname__, what % index, _type_repr(typ),
+                      value))
+
+
+def _check_bound(check, value, bindings):
+    """Return check(value), with the VarBindings in bindings entered.
+
+    The checks of a coroutine's result or of a generator's values run
+    after the call returned, so its type variable bindings are entered
+    again.
+    """
+    if not bindings:
+        return check(value)
+    with bindings[0]:
+        return _check_bound(check, value, bindings[1:])
+
+
+async def _checked_coroutine(coro, check, func, typ, sampler, bindings):
+    """Await coro in place of a @typechecked coroutine, checking its result.
+
+    This runs in the awaiting task, like coro itself would.
+    """
+    result = await coro
+    if sampler is not None:
+        t = time.perf_counter()
+    if not _check_bound(check, result, bindings):
+        raise _return_error(func, typ, result)
+    if sampler is not None:
+        sampler.record(time.perf_counter() - t)
+    return result
+
+
+class _CheckedIterator:
+    """Wrapper of an iterator checking each value it produces.
+
+    See checked_iter().  A failed check raises TypeError in the
+    consumer, giving the index of the value; func is the
+    @typechecked function that returned the iterator or was given it
+    as an argument, or None.  What the values are is given by what,
+    with a %d for the index.
+    """
+
+    __slots__ = ['_iterator', '_check', '_func', '_type', '_sampler',
+                 '_bindings', '_index', '_what']
+
+    def __init__(self, iterator, check, func, typ, sampler, bindings,
+                 what='yielded value %d'):
+        self._iterator = iterator
+        self._check = check
+        self._func = func
+        self._type = typ
+        self._sampler = sampler
+        self._bindings = bindings
+        self._index = 0
+        self._what = what
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = next(self._iterator)
+        if self._sampler is None and not self._bindings:
+            # The common case, inlined.
+            index = self._index
+            self._index = index + 1
+            if not self._check(value):
+                raise _element_error(self._func, self._type, index, value,
+                                 self._what)
+            return value
+        return self._checked(value)
+
+    def _checked(self, value):
+        index = self._index
+        self._index = index + 1
+        sampler = self._sampler
+        if sampler is not None:
+            t = time.perf_counter()
+        if self._bindings:
+            ok = _check_bound(self._check, value, self._bindings)
+        else:
+            ok = self._check(value)
+        if not ok:
+            raise _element_error(self._func, self._type, index, value,
+                                 self._what)
+        if sampler is not None:
+            sampler.record(time.perf_counter() - t)
+        return value
+
+
+class _CheckedGenerator(_CheckedIterator):
+    """Wrapper of a generator checking each value it yields.
+
+    @typechecked generator functions annotated to return Iterator[T]
+    or Iterable[T] return this.  Like _CheckedAsyncGenerator, values
+    produced by send() and throw() are checked too.
+    """
+
+    __slots__ = []
+
+    def send(self, value):
+        return self._checked(self._iterator.send(value))
+
+    def throw(self, *args):
+        return self._checked(self._iterator.throw(*args))
+
+    def close(self):
+        return self._iterator.close()
+
+
+class _CheckedAsyncGenerator:
+    """Wrapper of an async generator checking each value it yields.
+
+    @typechecked async generator functions annotated to return
+    AsyncIterator[T] or AsyncIterable[T] return this.  Each value is
+    checked as it is produced, in the consumer's task; a failed check
+    raises TypeError there, and leaves the generator suspended.
+    """
+
+    __slots__ = ['_agen', '_check', '_func', '_type', '_sampler',
+                 '_bindings', '_index']
+
+    def __init__(self, agen, check, func, typ, sampler, bindings):
+        self._agen = agen
+        self._check = check
+        self._func = func
+        self._type = typ
+        self._sampler = sampler
+        self._bindings = bindings
+        self._index = 0
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._checked(self._agen.__anext__())
+
+    def asend(self, value):
+        return self._checked(self._agen.asend(value))
+
+    def athrow(self, *args):
+        return self._checked(self._agen.athrow(*args))
+
+    def aclose(self):
+        return self._agen.aclose()
+
+    async def _checked(self, awaitable):
+        value = await awaitable
+        index = self._index
+        self._index = index + 1
+        sampler = self._sampler
+        if sampler is not None:
+            t = time.perf_counter()
+        if not _check_bound(self._check, value, self._bindings):
+            raise _element_error(self._func, self._type, index, value)
+        if sampler is not None:
+            sampler.record(time.perf_counter() - t)
+        return value
+
+
+def _item_type(typ, kinds):
+    """Return T for typ like K[T], K being the ABC of one of kinds.
+
+    Return None for other types.
+    """
+    if isinstance(typ, GenericMeta) and typ.__extra__ in kinds:
+        return typ.__parameters__[0]
+    return None
+
+
+class _Name:
+    """Object whose repr() is a given name, for generating source code."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+class Sampler:
+    """Sampling policy for @typechecked functions.
+
+    This base class checks every call.  Subclasses override sample(),
+    which is asked whether to check a call.  To make unchecked calls
+    cheap, a policy can also set the attribute skip to a number of
+    calls that are to be let through unchecked without asking it.
+    record() is told how many seconds the checks of a sampled call
+    took.
+
+    A policy's state is shared by all functions using it; with
+    threads the counts are approximate.
+    """
+
+    skip = 0
+
+    def sample(self):
+        return True
+
+    def record(self, elapsed):
+        pass
+
+    def __repr__(self):
+        return '%s()' % self.__class__.__name__
+
+
+class EveryNth(Sampler):
+    """Check one in every n calls (starting with the first)."""
+
+    def __init__(self, n):
+        if n < 1:
+            raise ValueError("EveryNth(n): n must be at least 1.")
+        self.n = n
+
+    def sample(self):
+        self.skip = self.n - 1
+        return True
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.n)
+
+
+class FirstThenEveryNth(Sampler):
+    """Check the first calls, then one in every n calls."""
+
+    def __init__(self, first, n):
+        if n < 1:
+            raise ValueError("FirstThenEveryNth(first, n): "
+                             "n must be at least 1.")
+        self.first = first
+        self.n = n
+        self.seen = 0
+
+    def sample(self):
+        if self.seen < self.first:
+            self.seen += 1
+        else:
+            self.skip = self.n - 1
+        return True
+
+    def __repr__(self):
+        return '%s(%d, %d)' % (self.__class__.__name__, self.first, self.n)
+
+
+class TimeBudget(Sampler):
+    """Check calls while their checks took less than budget per second.
+
+    The budget is in seconds of checking per second of wall clock time,
+    e.g. TimeBudget(0.01) allows about 1% overhead.  Once the budget of
+    the current second is spent, calls are let through unchecked with
+    exponentially fewer looks at the clock: the number of calls let
+    through without looking doubles each time, until a look finds
+    that a new second has started.  It is capped at the number of
+    calls expected in the rest of the second at the rate seen so far,
+    so that the clock is still looked at about once a second when
+    calls become rarer.
+    """
+
+    def __init__(self, budget, clock=time.perf_counter):
+        self.budget = budget
+        self.clock = clock
+        self._window_start = 0.0
+        self._window_end = 0.0
+        self._spent = 0.0
+        self._backoff = 0
+        self._calls = 0
+
+    def sample(self):
+        now = self.clock()
+        if now >= self._window_end:
+            self._window_start = now
+            self._window_end = now + 1.0
+            self._spent = 0.0
+            self._backoff = 0
+            self._calls = 0
+        self._calls += 1
+        if self._spent < self.budget:
+            return True
+        skip = 2 * self._backoff + 1
+        elapsed = now - self._window_start
+        if elapsed > 0:
+            skip = min(skip, int(self._calls * (self._window_end - now) /
+                                 elapsed) + 1)
+        self._backoff = self.skip = skip
+        self._calls += skip
+        return False
+
+    def record(self, elapsed):
+        self._spent += elapsed
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.budget)
+
+
+class _CheckState:
+    """Sampling state of a @typechecked function."""
+
+    __slots__ = ['module', 'own', 'sampler', 'namespace', 'checks',
+                 '__weakref__']
+
+    def __init__(self, module):
+        self.module = module
+        self.own = None
+        self.sampler = None
+        # The wrapper's globals, and (name, checker, function, label,
+        # type) for each checker in them; see set_profiling().
+        self.namespace = None
+        self.checks = []
+        self.update()
+
+    def update(self):
+        if self.own is not None:
+            self.sampler = self.own
+        else:
+            self.sampler = _module_samplers.get(self.module, _default_sampler)
+
+
+_default_sampler = None
+_module_samplers = {}
+_check_states = weakref.WeakSet()
+
+
+def set_sampling(sampler, *, func=None, module=None):
+    """Set the sampling policy of @typechecked functions.
+
+    The sampler is a Sampler instance, or None.  With func (a
+    @typechecked function), set the policy of that function; with
+    module (a module or module name), set the default for the
+    functions defined in that module; with neither, set the default
+    for all functions.  The most specific policy that is set applies:
+    None for func or module removes their policy, so that the next
+    one applies, and None as the default checks every call.  To check
+    every call of some functions regardless, give them Sampler().
+    This may be changed at any time, e.g.::
+
+      set_sampling(EveryNth(100), module=__name__)
+      set_sampling(Sampler(), func=critical_function)
+    """
+    global _default_sampler
+    if sampler is not None and not isinstance(sampler, Sampler):
+        raise TypeError("set_sampling(sampler): sampler must be a Sampler "
+                        "or None.  Got %.100r." % (sampler,))
+    if func is not None:
+        try:
+            state = func.__check_state__
+        except AttributeError:
+            raise TypeError("set_sampling(func=f): f must be a "
+                            "@typechecked function.") from None
+        state.own = sampler
+        state.update()
+        return
+    if module is not None:
+        if isinstance(module, types.ModuleType):
+            module = module.__name__
+        if sampler is None:
+            _module_samplers.pop(module, None)
+        else:
+            _module_samplers[module] = sampler
+    else:
+        _default_sampler = sampler
+    for state in list(_check_states):
+        state.update()
+
+
+def typechecked(func):
+    """Decorator checking arguments and return value at call time.
+
+    The annotations of func are read once, when it is decorated.  The
+    decorator then generates a wrapper with the same signature that
+    checks each annotated argument (using compile_checker()), calls
+    func and checks the result.  A failed check raises TypeError.
+    Arguments left at their default value are not checked, so that
+    e.g. "x: int = None" doesn't fail when x is omitted.  Annotations
+    of *args and **kwargs apply to each extra argument.  String
+    annotations (e.g. with "from __future__ import annotations") are
+    evaluated right away if they can be; those naming something not
+    defined yet become a ForwardRef, resolved at the first check.
+
+    A type variable directly annotating arguments without a default
+    is bound for the rest of the call to the type of one of these
+    arguments, which the types of the others must be subclasses of,
+    so that e.g. both arguments and the result of::
+
+      @typechecked
+      def add(a: T, b: T) -> T:
+          return a + b
+
+    must have the same type, or be a bool and an int (in any order)
+    for an int result.  Other type variables (e.g. in "x: Tuple[T,
+    int]" only) stand for their constraints, or for Any if they have
+    none.
+
+    Coroutine functions (async def) and async generator functions get
+    a wrapper that checks the arguments when it is called, like any
+    other, and returns the coroutine or async generator.  The result
+    of a coroutine is checked when it is awaited, e.g. "-> int" when
+    it returns an int.  An async generator annotated to return
+    AsyncIterator[T] or AsyncIterable[T] has each value it yields
+    checked against T as it is consumed.  This adds no task or event
+    loop iteration: the checks run in the awaiting task.
+
+    Likewise, a generator function annotated to return Iterator[T] or
+    Iterable[T] returns a generator that checks each value it yields,
+    so that generator pipelines stay lazy; see checked_iter() for
+    other iterators.  An argument annotated Iterator[T] is replaced by
+    an iterator that checks each value as the function consumes it.
+    Arguments annotated Iterable[T] are only checked to be iterables,
+    as checking their values would consume them.
+
+    By default every call is checked; see set_sampling() to only
+    check some of them.
+    """
+    import inspect
+    sig = inspect.signature(func)
+    msg = "@typechecked: annotations must be types."
+    annotations = {}
+    for name, t in func.__annotations__.items():
+        if isinstance(t, str):
+            t = ForwardRef(t, func.__globals__)
+            try:
+                t = t.__forward_value__
+            except NameError:
+                pass
+        annotations[name] = _type_check(t, msg)
+    P = inspect.Parameter
+    # Pick names for the wrapper's globals that can't shadow arguments.
+    prefix = '_tc'
+    while any(name.startswith(prefix) for name in sig.parameters):
+        prefix += '_'
+    state = _CheckState(func.__module__)
+    _check_states.add(state)
+    namespace = {prefix + 'func': func,
+                 prefix + 'state': state,
+                 prefix + 'clock': time.perf_counter,
+                 prefix + 'error': _argument_error,
+                 prefix + 'return_error': _return_error,
+                 prefix + 'type': type,
+                 prefix + 'bind_type': _bind_type,
+                 prefix + 'var_binding': VarBinding,
+                 prefix + 'checked_coroutine': _checked_coroutine,
+                 prefix + 'checked_async_gen': _CheckedAsyncGenerator,
+                 prefix + 'checked_gen': _CheckedGenerator,
+                 prefix + 'checked_iter': _CheckedIterator}
+
+    def name_for(obj):
+        name = '%s%d' % (prefix, len(namespace))
+        namespace[name] = obj
+        return name
+
+    def checker_for(typ, keep, label):
+        check = compile_checker(_erase_type_vars(typ, keep))
+        name = name_for(check)
+        state.checks.append((name, check, func, label, typ))
+        return name
+
+    # Type variables bound during the call, and the names of the
+    # arguments binding each of them.
+    bindings = collections.OrderedDict()
+    for name, p in sig.parameters.items():
+        typ = annotations.get(name)
+        if (isinstance(typ, TypeVar) and p.default is P.empty and
+                p.kind not in (P.VAR_POSITIONAL, P.VAR_KEYWORD)):
+            bindings.setdefault(typ, []).append(name)
+
+    params = []
+    args = []
+    checks = []
+    # Iterator arguments to wrap: name, item type and default.
+    iterators = []
+    for name, p in sig.parameters.items():
+        if p.default is not P.empty:
+            default = name_for(p.default)
+            p = p.replace(default=_Name(default))
+        params.append(p.replace(annotation=P.empty))
+        if p.kind == P.VAR_POSITIONAL:
+            args.append('*' + name)
+        elif p.kind == P.VAR_KEYWORD:
+            args.append('**' + name)
+        elif p.kind == P.KEYWORD_ONLY:
+            args.append('%s=%s' % (name, name))
+        else:
+            args.append(name)
+        if name not in annotations or name in bindings.get(annotations[name],
+                                                           ()):
+            continue
+        typ = annotations[name]
+        check = checker_for(typ, bindings, name)
+        error = ('raise %serror(%sfunc, %r, %s, %%s)' %
+                 (prefix, prefix, name, name_for(typ)))
+        if p.kind in (P.VAR_POSITIONAL, P.VAR_KEYWORD):
+            if p.kind == P.VAR_POSITIONAL:
+                checks.append('for %sv in %s:' % (prefix, name))
+                checks.append('    if not %s(%sv): %s' %
+                              (check, prefix, error % (prefix + 'v')))
+            else:
+                # Report the keyword rather than the parameter name.
+                checks.append('for %sk, %sv in %s.items():' %
+                              (prefix, prefix, name))
+                checks.append('    if not %s(%sv): raise %serror(%sfunc, '
+                              '%sk, %s, %sv)' %
+                              (check, prefix, prefix, prefix, prefix,
+                               name_for(typ), prefix))
+        elif p.default is P.empty:
+            checks.append('if not %s(%s): %s' % (check, name, error % name))
+        else:
+            checks.append('if %s is not %s and not %s(%s): %s' %
+                          (name, default, check, name, error % name))
+        if p.kind not in (P.VAR_POSITIONAL, P.VAR_KEYWORD):
+            item = _item_type(typ, (collections.abc.Iterator,))
+            if (item is not None and
+                    _erase_type_vars(item, bindings) is not Any):
+                iterators.append((name, item, p.default is not P.empty and
+                                  default))
+    call = '%sfunc(%s)' % (prefix, ', '.join(args))
+
+    # The rest of the wrapper; %(...)s stands for a prefixed name.  The
+    # checks above contain no '%'.
+    lines = ['%(s)s = %(state)s.sampler',
+             'if %(s)s is not None:',
+             '    if %(s)s.skip:',
+             '        %(s)s.skip -= 1',
+             '        return ' + call,
+             '    if not %(s)s.sample():',
+             '        return ' + call,
+             '    %(t)s = %(clock)s()']
+    indent = ''
+    # Names of the bound variables, their bindings and the tokens to
+    # unbind them, for checks after the call.
+    bound = []
+    for var, names in bindings.items():
+        var_name = name_for(var)
+        for name in names:
+            lines.append(indent + 'if not %s(%s): %s' % (
+                checker_for(var, (), name), name,
+                'raise %%(error)s(%%(func)s, %r, %s, %s)' % (
+                    name, var_name, name)))
+        b = '%sb%d' % (prefix, len(bound))
+        token = '%sk%d' % (prefix, len(bound))
+        lines.append(indent + '%s = %%(type)s(%s)' % (b, names[0]))
+        if len(names) > 1:
+            # Usually the arguments all have the same type.
+            lines.append(indent + 'if %s: %s = %%(bind_type)s(%%(func)s, '
+                         '%s, %r, (%s))' % (
+                             ' or '.join('%%(type)s(%s) is not %s' % (name, b)
+                                         for name in names[1:]),
+                             b, var_name, tuple(names), ', '.join(names)))
+        if var.__constraints__:
+            # Like var.bind(); usually the type is one of the
+            # constraints, found in a dict.
+            constraints = name_for({t: t for t in var.__constraints__})
+            lines.append(indent + '%s = %s.get(%s) or %s._constraint_for(%s)'
+                         % (b, constraints, b, var_name, b))
+        # Everything after this is checked with the variable bound.
+        lines.append(indent + '%s = %s._bind(%s)' % (token, var_name, b))
+        lines.append(indent + 'try:')
+        bound.append((var_name, b, token))
+        indent += '    '
+    lines.extend(indent + line for line in checks)
+    for name, item, default in iterators:
+        # The iterator's values are checked as the function takes them.
+        wrap = ('%s = %%(checked_iter)s(%s, %s, %%(func)s, %s, %%(s)s, '
+                '(%s), %s)' % (
+                    name, name, checker_for(item, bindings, name),
+                    name_for(item),
+                    ''.join('%%(var_binding)s(%s, %s), ' % (var_name, b)
+                            for var_name, b, token in bound),
+                    name_for('value %%d of argument %r' % name)))
+        if default:
+            lines.append(indent + 'if %s is not %s:' % (name, default))
+            lines.append(indent + '    ' + wrap)
+        else:
+            lines.append(indent + wrap)
+    returns = None
+    if inspect.iscoroutinefunction(func):
+        returns = annotations.get('return')
+        helper, label = '%(checked_coroutine)s', 'return'
+    elif inspect.isasyncgenfunction(func):
+        returns = _item_type(annotations.get('return'),
+                             (collections.abc.AsyncIterator,
+                              collections.abc.AsyncIterable))
+        helper, label = '%(checked_async_gen)s', 'yield'
+    elif inspect.isgeneratorfunction(func):
+        returns = _item_type(annotations.get('return'),
+                             (collections.abc.Iterator,
+                              collections.abc.Iterable))
+        helper, label = '%(checked_gen)s', 'yield'
+    if returns is not None:
+        # The result is checked later, by the helper.
+        check = checker_for(returns, bindings, label)
+        lines.extend(indent + line for line in [
+            'if %(s)s is not None: %(s)s.record(%(clock)s() - %(t)s)',
+            'return %s(%s, %s, %%(func)s, %s, %%(s)s, (%s))' % (
+                helper, call, check, name_for(returns),
+                ''.join('%%(var_binding)s(%s, %s), ' % (var_name, b)
+                        for var_name, b, token in bound))])
+    elif 'return' in annotations:
+        typ = annotations['return']
+        check = checker_for(typ, bindings, 'return')
+        # Measure the checks, not the call: t = t_args - t_call_end.
+        lines.extend(indent + line for line in [
+            'if %(s)s is not None: %(t)s = %(clock)s() - %(t)s',
+            '%(result)s = ' + call,
+            'if %(s)s is not None: %(t)s -= %(clock)s()',
+            'if not %s(%%(result)s):' % check,
+            '    raise %%(return_error)s(%%(func)s, %s, %%(result)s)' %
+            name_for(typ),
+            'if %(s)s is not None: %(s)s.record(%(t)s + %(clock)s())',
+            'return %(result)s'])
+    else:
+        lines.extend(indent + line for line in [
+            'if %(s)s is not None: %(s)s.record(%(clock)s() - %(t)s)',
+            'return ' + call])
+    for var_name, b, token in reversed(bound):
+        indent = indent[4:]
+        lines.append(indent + 'finally:')
+        lines.append(indent + '    %s._unbind(%s)' % (var_name, token))
+    names = {name: prefix + name
+             for name in ['s', 't', 'result', 'state', 'clock', 'func',
+                          'error', 'return_error', 'type', 'bind_type',
+                          'var_binding', 'checked_coroutine',
+                          'checked_async_gen', 'checked_gen',
+                          'checked_iter']}
+    source = 'def %swrapper%s:\n%s\n' % (
+        prefix, sig.replace(parameters=params, return_annotation=P.empty),
+        '\n'.join('    ' + line % names for line in lines))
+    exec(source, namespace)
+    wrapper = functools.update_wrapper(namespace[prefix + 'wrapper'], func)
+    wrapper.__source__ = source
+    wrapper.__check_state__ = state
+    if (inspect.iscoroutinefunction(func) and
+            hasattr(inspect, 'markcoroutinefunction')):  # Python 3.12+.
+        inspect.markcoroutinefunction(wrapper)
+    state.namespace = namespace
+    if _profiler is not None:
+        _profiler.install(state)
+    return wrapper
+
+
+ProfileEntry = collections.namedtuple('ProfileEntry', [
+    'filename', 'lineno', 'caller', 'function', 'argument', 'type',
+    'calls', 'seconds', 'error'])
+
+
+class _Profiler:
+    """Time spent in the checks of @typechecked functions, by call site.
+
+    Entries are keyed by the call site (file, line and function
+    calling the checked function) and the check (function, argument
+    and type).  To bound memory use, at most capacity entries are
+    kept, using the Space-Saving algorithm: a new entry replaces the
+    one with the least time, and inherits its time (recorded as the
+    entry's error).  The entries with the most time are then reported
+    with a time that overestimates the true one by at most their
+    error; entries that never needed to replace another are exact.
+
+    The entry with the least time is found with a heap of (seconds,
+    key) pairs, one per entry.  Times only grow, so the heap isn't
+    updated as they do; an outdated pair is only fixed when it reaches
+    the top.  Each record() then costs O(log capacity), amortized.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = {}  # key -> [calls, seconds, error]
+        self._heap = []  # (seconds, key), with seconds possibly outdated
+        self._lock = _thread.allocate_lock()
+
+    def record(self, key, elapsed):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                if len(self._data) < self.capacity:
+                    entry = self._data[key] = [0, 0.0, 0.0]
+                else:
+                    seconds = self._evict()
+                    entry = self._data[key] = [0, seconds, seconds]
+                heapq.heappush(self._heap, (entry[1], key))
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def _evict(self):
+        """Drop the entry with the least time and return its time."""
+        heap = self._heap
+        while True:
+            seconds, key = heap[0]
+            current = self._data[key][1]
+            if current == seconds:
+                # Up to date, so no entry has less time.
+                heapq.heappop(heap)
+                return self._data.pop(key)[1]
+            heapq.heapreplace(heap, (current, key))
+
+    def profiled(self, check, func, label, typ):
+        """Return a wrapper of check recording its time under the caller
+        of the @typechecked function that calls it.
+
+        The checks of coroutine results and of generated values run
+        in helpers of this module (see _checked_coroutine()), after
+        the call; they're recorded under the code awaiting or
+        consuming the values instead.
+        """
+        clock = time.perf_counter
+        getframe = sys._getframe
+        module_globals = globals()
+        record = self.record
+        site = (getattr(func, '__qualname__', repr(func)), label,
+                _type_repr(typ))
+
+        def profiled(x):
+            start = clock()
+            try:
+                return check(x)
+            finally:
+                elapsed = clock() - start
+                # 1 is the @typechecked wrapper, or a helper.
+                caller = getframe(2)
+                while (caller.f_globals is module_globals and
+                       caller.f_back is not None):
+                    caller = caller.f_back
+                code = caller.f_code
+                record((code.co_filename, caller.f_lineno,
+                        getattr(code, 'co_qualname', code.co_name)) + site,
+                       elapsed)
+
+        return profiled
+
+    def install(self, state):
+        for name, check, func, label, typ in state.checks:
+            state.namespace[name] = self.profiled(check, func, label, typ)
+
+    def report(self, n):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._data.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [ProfileEntry(*(key + tuple(value)))
+                for key, value in items[:n]]
+
+
+_profiler = None
+_last_profiler = None  # The profile kept after turning profiling off.
+
+
+def set_profiling(enabled, *, capacity=1000):
+    """Turn profiling of @typechecked checks on or off.
+
+    This is off by default, and then costs nothing.  While it's on,
+    the time each check of a @typechecked function takes is recorded
+    under the call site (the file, line and function calling the
+    checked function) and the check (the checked function, argument
+    and type).  Memory use is bounded by keeping at most capacity
+    entries; see profile_report().  Turning it on again starts a new
+    profile.
+    """
+    global _profiler, _last_profiler
+    states = list(_check_states)
+    if enabled:
+        if capacity < 1:
+            raise ValueError("set_profiling(capacity=n): n must be at "
+                             "least 1.")
+        _profiler = _Profiler(capacity)
+        for state in states:
+            _profiler.install(state)
+    else:
+        if _profiler is not None:
+            _last_profiler = _profiler
+        _profiler = None
+        for state in states:
+            for name, check, func, label, typ in state.checks:
+                state.namespace[name] = check
+
+
+def profile_report(n=20):
+    """Return the n ProfileEntry tuples with the most time, most first.
+
+    Each has the fields filename, lineno and caller (the call site),
+    function, argument ('return' for the return value) and type (the
+    check), calls, seconds and error.  When more distinct entries were
+    seen than set_profiling() was told to keep, seconds can be an
+    overestimate by up to error (and calls are counted since the
+    entry was last added).  This returns [] if profiling was never
+    turned on; after it is turned off, the last profile is kept.
+    """
+    profiler = _profiler or _last_profiler
+    if profiler is None:
+        return []
+    return profiler.report(n)
+
+
+def format_profile_report(n=20):
+    """Return profile_report(n) as a text table."""
+    lines = ['%10s %8s %10s  %s' % ('seconds', 'calls', 'error', 'site')]
+    for e in profile_report(n):
+        lines.append('%10.6f %8d %10.6f  %s:%d(%s) -> %s(%s: %s)' % (
+            e.seconds, e.calls, e.error, e.filename, e.lineno, e.caller,
+            e.function, e.argument, e.type))
+    return '\n'.join(lines) + '\n'
+
+
+# Instrumentation of the metaclass checks; see set_instrumentation().
+# While it's enabled, the __instancecheck__() and __subclasscheck__()
+# methods of the metaclasses below are replaced by wrappers that
+# count calls and time; while it's disabled, nothing is changed.
+_instrumented_originals = {}
+_instrument_lock = _thread.allocate_lock()
+_instrument_local = _thread._local()
+# (metaclass name, method) -> [calls, seconds, cache hits, cache misses]
+_metaclass_stats = {}
+# (id(type), method) -> [type, calls, seconds, cache hits, cache misses]
+_type_stats = {}
+_MAX_TYPE_STATS = 1000
+_untracked_calls = 0
+
+
+def _instrumented_metaclasses():
+    return [AnyMeta, TypeVar, ForwardRef, UnionMeta, TupleMeta,
+            CallableMeta, GenericMeta, ProtocolMeta]
+
+
+def _cache_lookups():
+    """Return the total number of hits and misses of all caches."""
+    hits = misses = 0
+    for cache in list(_caches.values()):
+        hits += cache.hits
+        misses += cache.misses
+    return hits, misses
+
+
+def _instrumented(func, method):
+    """Return a wrapper of the metaclass method func that records calls.
+
+    Time and cache lookups are inclusive: a Union check includes the
+    checks of its members, which are recorded too.  A method calling
+    the same method of its base metaclass (through super()) counts
+    once.
+    """
+    clock = time.perf_counter
+
+    @functools.wraps(func)
+    def wrapper(self, arg):
+        outer = getattr(_instrument_local, 'current', None)
+        key = (id(self), method)
+        if outer == key:
+            return func(self, arg)
+        _instrument_local.current = key
+        hits, misses = _cache_lookups()
+        start = clock()
+        try:
+            return func(self, arg)
+        finally:
+            elapsed = clock() - start
+            _instrument_local.current = outer
+            new_hits, new_misses = _cache_lookups()
+            _record_check(self, key, elapsed, new_hits - hits,
+                          new_misses - misses)
+
+    return wrapper
+
+
+def _record_check(tp, key, elapsed, hits, misses):
+    global _untracked_calls
+    method = key[1]
+    with _instrument_lock:
+        stats = _metaclass_stats.get((type(tp).__name__, method))
+        if stats is None:
+            stats = _metaclass_stats[type(tp).__name__, method] = [
+                0, 0.0, 0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += hits
+        stats[3] += misses
+        stats = _type_stats.get(key)
+        if stats is None:
+            if len(_type_stats) >= _MAX_TYPE_STATS:
+                _untracked_calls += 1
+                return
+            # Holding on to tp keeps its id from being reused.
+            stats = _type_stats[key] = [tp, 0, 0.0, 0, 0]
+        stats[1] += 1
+        stats[2] += elapsed
+        stats[3] += hits
+        stats[4] += misses
+
+
+def set_instrumentation(enabled):
+    """Turn counting of instance and subclass checks on or off.
+
+    This is off by default, and then costs nothing.  While it's on,
+    each call of a typing metaclass's __instancecheck__() or
+    __subclasscheck__() is counted and timed, per metaclass and per
+    type (for up to 1000 types), along with the cache hits and misses
+    during the calls (approximately, with threads).  Checks done by
+    compile_checker() functions (and so @typechecked) only count where
+    they delegate to isinstance().  The counters are kept when this is
+    turned off; see instrumentation_snapshot() and
+    export_instrumentation().
+    """
+    if enabled:
+        if _instrumented_originals:
+            return
+        for meta in _instrumented_metaclasses():
+            for name in ['__instancecheck__', '__subclasscheck__']:
+                func = meta.__dict__.get(name)
+                if func is not None:
+                    _instrumented_originals[meta, name] = func
+                    setattr(meta, name, _instrumented(func, name[2:-2]))
+    else:
+        for (meta, name), func in _instrumented_originals.items():
+            setattr(meta, name, func)
+        _instrumented_originals.clear()
+
+
+def instrumentation_snapshot(reset=False):
+    """Return the instrumentation counters as a plain dict.
+
+    The dict has these keys:
+
+    - 'enabled': whether set_instrumentation() is on;
+    - 'metaclasses': maps metaclass names to dicts mapping
+      'instancecheck' and 'subclasscheck' to dicts with the keys
+      'calls', 'seconds', 'cache_hits', 'cache_misses' and
+      'cache_hit_rate' (the hits and misses of all caches during the
+      calls; the rate is None without lookups);
+    - 'types': the same, by repr() of the checked types (with an
+      extra 'metaclass' key);
+    - 'untracked_calls': calls on types beyond the first 1000;
+    - 'caches': maps cache names (see cache_info()) to dicts with the
+      keys 'hits', 'misses', 'hit_rate', 'evictions', 'maxsize' and
+      'size'.
+
+    With reset, the check counters (not the caches' statistics) are
+    reset to zero afterwards.
+    """
+    global _untracked_calls
+    with _instrument_lock:
+        metaclass_stats = [(k, list(v)) for k, v in _metaclass_stats.items()]
+        type_stats = [(k, list(v)) for k, v in _type_stats.items()]
+        untracked = _untracked_calls
+        if reset:
+            _metaclass_stats.clear()
+            _type_stats.clear()
+            _untracked_calls = 0
+    metaclasses = {}
+    for (meta, method), (calls, seconds, hits, misses) in metaclass_stats:
+        metaclasses.setdefault(meta, {})[method] = {
+            'calls': calls, 'seconds': seconds,
+            'cache_hits': hits, 'cache_misses': misses,
+            'cache_hit_rate': _hit_rate(hits, misses)}
+    types_ = {}
+    for (_, method), (tp, calls, seconds, hits, misses) in type_stats:
+        # Distinct types may have the same repr(); add them up.
+        entry = types_.setdefault(_type_repr(tp),
+                                  {'metaclass': type(tp).__name__})
+        stats = entry.setdefault(method, {'calls': 0, 'seconds': 0.0,
+                                          'cache_hits': 0,
+                                          'cache_misses': 0})
+        stats['calls'] += calls
+        stats['seconds'] += seconds
+        stats['cache_hits'] += hits
+        stats['cache_misses'] += misses
+        stats['cache_hit_rate'] = _hit_rate(stats['cache_hits'],
+                                            stats['cache_misses'])
+    caches = {}
+    for name, info in cache_info().items():
+        caches[name] = {
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': _hit_rate(info.hits, info.misses),
+            'evictions': info.evictions,
+            'maxsize': info.maxsize,
+            'size': info.currsize,
+        }
+    return {
+        'enabled': bool(_instrumented_originals),
+        'metaclasses': metaclasses,
+        'types': types_,
+        'untracked_calls': untracked,
+        'caches': caches,
+    }
+
+
+def _hit_rate(hits, misses):
+    lookups = hits + misses
+    return hits / lookups if lookups else None
+
+
+def _label(value):
+    return '"%s"' % (str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+
+
+def format_instrumentation(snapshot=None):
+    """Return an instrumentation snapshot in a text exposition format.
+
+    This is the Prometheus text format: one 'name{labels} value' line
+    per sample, with # HELP and # TYPE comments.  The snapshot
+    defaults to a new one.
+    """
+    if snapshot is None:
+        snapshot = instrumentation_snapshot()
+    metrics = collections.OrderedDict()
+
+    def add(name, kind, doc, labels, value):
+        if name not in metrics:
+            metrics[name] = ['# HELP %s %s' % (name, doc),
+                             '# TYPE %s %s' % (name, kind)]
+        if labels:
+            name_labels = '%s{%s}' % (
+                name, ','.join('%s=%s' % (k, _label(v)) for k, v in labels))
+        else:
+            name_labels = name
+        metrics[name].append('%s %s' % (name_labels, value))
+
+    for meta, methods in sorted(snapshot['metaclasses'].items()):
+        for method, stats in sorted(methods.items()):
+            labels = [('metaclass', meta), ('method', method)]
+            add('typing_checks_total', 'counter',
+                'Calls of typing metaclass checks.', labels, stats['calls'])
+            add('typing_check_seconds_total', 'counter',
+                'Time spent in typing metaclass checks.', labels,
+                repr(stats['seconds']))
+            if 'cache_hits' in stats:
+                add('typing_check_cache_hits_total', 'counter',
+                    'Cache hits during typing metaclass checks.', labels,
+                    stats['cache_hits'])
+                add('typing_check_cache_misses_total', 'counter',
+                    'Cache misses during typing metaclass checks.', labels,
+                    stats['cache_misses'])
+    for tp, entry in sorted(snapshot['types'].items()):
+        for method in ['instancecheck', 'subclasscheck']:
+            stats = entry.get(method)
+            if stats is None:
+                continue
+            labels = [('type', tp), ('metaclass', entry['metaclass']),
+                      ('method', method)]
+            add('typing_type_checks_total', 'counter',
+                'Calls of typing metaclass checks, by type.', labels,
+                stats['calls'])
+            add('typing_type_check_seconds_total', 'counter',
+                'Time spent in typing metaclass checks, by type.', labels,
+                repr(stats['seconds']))
+            if 'cache_hits' in stats:
+                add('typing_type_check_cache_hits_total', 'counter',
+                    'Cache hits during typing metaclass checks, by type.',
+                    labels, stats['cache_hits'])
+                add('typing_type_check_cache_misses_total', 'counter',
+                    'Cache misses during typing metaclass checks, by type.',
+                    labels, stats['cache_misses'])
+    for name, stats in sorted(snapshot['caches'].items()):
+        labels = [('cache', name)]
+        add('typing_cache_hits_total', 'counter', 'Cache hits.', labels,
+            stats['hits'])
+        add('typing_cache_misses_total', 'counter', 'Cache misses.', labels,
+            stats['misses'])
+        add('typing_cache_size', 'gauge', 'Cache entries.', labels,
+            stats['size'])
+    add('typing_untracked_calls_total', 'counter',
+        'Calls of typing metaclass checks on types not tracked by type.',
+        [], snapshot['untracked_calls'])
+    lines = []
+    for samples in metrics.values():
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def export_instrumentation(path):
+    """Write format_instrumentation() to the file path.
+
+    The file is replaced atomically, so that a scraper never sees a
+    partial file.
+    """
+    import os
+    text = format_instrumentation()
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+MemoryInfo = collections.namedtuple(
+    'MemoryInfo', ['count', 'size', 'namespace_size', 'abc_cache_size'])
+MemoryInfo.__doc__ = """Memory used by the live instances of a metaclass.
+
+count is the number of instances (i.e. of types).  size is their total
+size in bytes, which includes namespace_size (the class dicts and the
+tuples, sets and dicts stored in them, e.g. type parameters) and
+abc_cache_size (the ABC registries and caches of generic types).
+"""
+
+# Containers whose size memory_info() counts, recursively.  Anything
+# else stored in a class (strings, functions, other types) is either
+# shared with the type it was parameterized from or counted on its own.
+_sized_types = (tuple, list, dict, set, frozenset, weakref.ref)
+
+
+def _sizeof(obj, seen):
+    """Return the size of the container obj and the containers in it.
+
+    Objects whose id is in the set seen are skipped, and objects that
+    are counted are added to it, so shared objects are counted once.
+    """
+    if not isinstance(obj, _sized_types) or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        obj = obj.values()
+    if not isinstance(obj, weakref.ref):
+        for item in obj:
+            size += _sizeof(item, seen)
+    return size
+
+
+def _abc_cache_size(cls, seen):
+    impl = cls.__dict__.get('_abc_impl')
+    if impl is None:
+        # Not an ABC, or the pure Python implementation (the only one
+        # before Python 3.7), which keeps WeakSets in the class.
+        size = 0
+        for name in ['_abc_registry', '_abc_cache', '_abc_negative_cache']:
+            refs = cls.__dict__.get(name)
+            if isinstance(refs, weakref.WeakSet) and id(refs) not in seen:
+                seen.add(id(refs))
+                size += sys.getsizeof(refs) + _sizeof(refs.data, seen)
+        return size
+    if not hasattr(abc, '_get_dump'):
+        return 0
+    size = sys.getsizeof(impl)
+    # The registry, the cache and the negative cache, as sets of
+    # weak references.  The sets are copies, of the same size.
+    for refs in abc._get_dump(cls)[:3]:
+        size += _sizeof(refs, seen)
+    return size
+
+
+def memory_info():
+    """Return a dict mapping metaclass names to MemoryInfo tuples.
+
+    This reports how many types of each kind exist and how much memory
+    they take, to spot leaks and track the growth of large schemas.
+    The keys are 'UnionMeta', 'TupleMeta', 'CallableMeta',
+    'GenericMeta' (which includes protocols) and 'TypeVar'.  Types are
+    found through the garbage collector, after a collection so that
+    only live ones are counted, and sized with sys.getsizeof(); shared
+    objects are counted once.  Collection
+    types that haven't been used yet (see _lazy()) don't exist, so
+    they aren't counted.
+    """
+    gc.collect()
+    kinds = [UnionMeta, TupleMeta, CallableMeta, GenericMeta, TypeVar]
+    totals = {kind: [0, 0, 0, 0] for kind in kinds}
+    seen = set()
+    for obj in gc.get_objects():
+        for kind in kinds:
+            if isinstance(obj, kind):
+                break
+        else:
+            continue
+        abc_cache_size = _abc_cache_size(obj, seen)
+        # The class dict proper, behind the read-only proxy.
+        namespace, = gc.get_referents(obj.__dict__)
+        namespace_size = _sizeof(namespace, seen)
+        total = totals[kind]
+        total[0] += 1
+        total[1] += (sys.getsizeof(obj) + _sizeof(obj.__mro__, seen) +
+                     _sizeof(obj.__bases__, seen) + namespace_size +
+                     abc_cache_size)
+        total[2] += namespace_size
+        total[3] += abc_cache_size
+    return {kind.__name__: MemoryInfo(*totals[kind]) for kind in kinds}
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__() (PEP 562) is ignored before Python 3.7, so
+    # lazy members are built right away.
+    for _name in list(_lazy_members):
+        __getattr__(_name)
+    del _name